@@ -1,11 +1,19 @@
 from flask import Flask, jsonify, request
 from flask import make_response
 from json import loads, dumps
-from idc_index import index
 from flask import Flask
 from flask_cors import CORS 
 import subprocess
 import sys
+import os
+import time
+
+# The similarity search modules import each other as top-level modules.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "search"))
+import service as similarity
+import gdc_proxy
+import idc_sql
+from compression import accepted_encoding, encode_body
 
 app = Flask(__name__)
 CORS(app)
@@ -44,16 +52,51 @@ def filter_experimental_strategies(patient_ids, experimental_strategies):
 	output = subprocess.check_output(command, shell=True, text=True, stderr=subprocess.STDOUT)
 	return output.strip()
 
-def query(sql):
-	client = index.IDCClient()
-	df = client.sql_query(sql)
-	return df
-	
-def safe_sql_value(value):
-    return "'" + str(value).replace("'", "''") + "'"
+def query(sql, params=()):
+	"""Run a parameterised query ($1, $2, ...) on the shared idc-index connection."""
+	return idc_sql.sql_query(sql, params)
+
+DATA_FORMATS = ("json", "compact")
+# Columns the viewer URLs are built from, and the URLs added to each record.
+VIEWER_URL_COLUMNS = ('StudyInstanceUID', 'SeriesInstanceUID', 'series_aws_url')
+VIEWER_URL_FIELDS = ('ohif_v2_url', 'ohif_v3_url', 'slim_url')
+# Returned when select is missing or *: the series fields the imaging cards show.
+DEFAULT_DATA_COLUMNS = ('PatientID', 'Modality', 'SeriesDescription', 'SeriesNumber',
+						'StudyDate', 'StudyDescription', 'series_aws_url')
+SELECTABLE_COLUMNS = {'PatientID', 'StudyInstanceUID', 'SeriesInstanceUID', 'gcs_url', 'collection_id',
+					  *DEFAULT_DATA_COLUMNS}
+
+def compact_records(records, columns):
+	"""
+	Columnar form of records: column names once and each row as an array.
+	String columns that repeat (at most one distinct value per two rows) are
+	dictionary-encoded: their cells hold indexes into dictionaries[column].
+	"""
+	dictionaries = {}
+	for col in columns:
+		values = [record.get(col) for record in records]
+		distinct = set(values) - {None}
+		if distinct and all(isinstance(value, str) for value in distinct) and len(distinct) * 2 <= len(values):
+			dictionaries[col] = sorted(distinct)
+	codes = {col: {value: i for i, value in enumerate(values)} for col, values in dictionaries.items()}
+	rows = [
+		[codes[col].get(record.get(col)) if col in codes else record.get(col) for col in columns]
+		for record in records
+	]
+	return {"columns": columns, "dictionaries": dictionaries, "rows": rows}
+
+def compress_response(response):
+	"""gzip/brotli-encode a response body when the client accepts it."""
+	body, encoding = encode_body(response.get_data(), request.headers.get("Accept-Encoding"))
+	if encoding is not None:
+		response.set_data(body)
+		response.headers["Content-Encoding"] = encoding
+	response.headers["Vary"] = "Accept-Encoding"
+	return response
 
 # http://index:5000/data?PatientID=TCGA-13-0921&primary_sites=Ovary (WRONG ONE)
 # index:5000/data?primary_sites=Ovary&PatientID=TCGA-13-0921
+# index:5000/data?format=compact&select=Modality,StudyDate&PatientID=TCGA-13-0921 (columnar, dictionary-encoded)
 @app.route('/data', methods=['GET', 'POST'])
 def get_data():
 	#test = ""
@@ -74,7 +117,6 @@ def get_data():
 	limit = 10
 	_format = "json"
 	select = "*"
-	where = "1 = 1"
 	_filter = {}
 	field_list = []
 	experimental_strategies = ""
@@ -82,8 +124,7 @@ def get_data():
 	primary_sites = ""
 	key = ""
 	value = ""
-	
-	client = index.IDCClient()
+
 	# GET or POST limit the length of parameters
 	# This should be only for debugging purpose
 	if request.method == "GET":
@@ -113,6 +154,10 @@ def get_data():
 				limit = int(value)
 			elif key == "page":
 				page = int(value)
+
+		# Reject the format before the filters below shell out to GDC.
+		if _format not in DATA_FORMATS:
+			return jsonify({"error": f"Unsupported format: {_format}"}), 400
 		
 		# patients
 		#print("patient_ids: " + patient_ids, file=sys.stderr)
@@ -121,76 +166,46 @@ def get_data():
 		values = filter_experimental_strategies(values, experimental_strategies) # Assuming filter_primary_sites is defined elsewhere
 		# print("patient_ids_filtered: " + values, file=sys.stderr) # index:5000/data?primary_sites=Ovary&PatientID=TCGA-13-0921
 		# values = patient_ids # DEBUGGING
-		values = values.split(',')
-		if len(values) > 0:
-			where += ' and ' + key + ' in (\'' + '\',\''.join(values) + '\')'
-		else:
-			where += ' and ' + key + ' = ' + value + '"'
+		patient_list = [pid.strip() for pid in values.split(',') if pid.strip()]
 	except Exception as e:
 		return str(e)
 
 	try:
-		if where == "":
-			# set up response
-			response["code"] = 204
-			response["message"] = "Must specify field(s) to filter"
-			return jsonify(response)
-
-		allowed_columns = {'PatientID', 'StudyInstanceUID', 'SeriesInstanceUID', 'gcs_url', 'collection_id'}
-		select_columns = [col.strip() for col in select.split(',') if col.strip() in allowed_columns]
-        
-		if not select_columns:
-			select_columns = ['*']
+		# Select exactly what the response needs: the requested (or default)
+		# columns plus the ones the viewer URLs are built from.
+		requested = [col.strip() for col in select.split(',') if col.strip() in SELECTABLE_COLUMNS]
+		response_columns = list(dict.fromkeys(requested or DEFAULT_DATA_COLUMNS))
+		query_columns = list(dict.fromkeys(response_columns + list(VIEWER_URL_COLUMNS)))
 		offset = limit * page
-        # Construct the SQL query with validated columns
-		select_clause = ', '.join(select_columns)
-		query = f"""
-        SELECT 
-            {select_clause}, 
-            collection_id, 
-            StudyInstanceUID, 
-            SeriesInstanceUID, 
-            series_aws_url
-        FROM 
-            index 
-        WHERE 
-            {where} 
-        LIMIT {limit} 
-        OFFSET {offset}
+		# Column names come from SELECTABLE_COLUMNS; every value is a bound parameter
+		# and the patient list is one LIST, so the statement text stays the same.
+		sql = f"""
+        SELECT {', '.join(query_columns)}
+        FROM index
+        WHERE PatientID = ANY($1)
+        LIMIT $2
+        OFFSET $3
         """
-        
-		print("Debug: Constructed SQL query:", query, file=sys.stderr)
-        
-		df = client.sql_query(query)
-    
-		print("Debug: Query executed successfully", file=sys.stderr)
+
+		df = query(sql, [patient_list, limit, offset])
 
 		records = df.to_dict(orient="records")
-		print("Debug: after records declared", records, file=sys.stderr)
-		collection_data = {}
 		for record in records:
-			viewer_urls = generate_viewer_urls(record)
-			record.update(viewer_urls)
-            # Remove StudyInstanceUID and SeriesInstanceUID if you don't want them in the output
-			record.pop('collection_id', None)
-			record.pop('StudyInstanceUID', None)
-			record.pop('SeriesInstanceUID', None)
-
-            
+			record.update(generate_viewer_urls(record))
+			# Columns only selected to build the viewer URLs are not returned.
+			for col in VIEWER_URL_COLUMNS:
+				if col not in response_columns:
+					record.pop(col, None)
+
 		response["result_count"] = len(records)
 		response["result_set"] = records
 		#command = "bq query --format=json --use_legacy_sql=false 'select " + select + " from bigquery-public-data.idc_current.dicom_all where " + where + " limit " + str(limit) + " offset " + str(offset) + "'"
 		#output = subprocess.check_output(command, shell=True, text=True, stderr=subprocess.STDOUT)
 		#records = json.loads(output)
 
-		if _format not in ["json"]:
-			return jsonify({"error": f"Unsupported format: {_format}"}), 400
-
-		if _format == "json":
-			print("Debug: Records before jsonify:", records, file=sys.stderr)
-			json_response = jsonify(records)
-			print("Debug: JSON response:", json_response.get_data(as_text=True), file=sys.stderr)
-			return json_response
+		if _format == "compact":
+			return compress_response(jsonify(compact_records(records, response_columns + list(VIEWER_URL_FIELDS))))
+		return compress_response(jsonify(records))
 	
 	except Exception as e:
 		print(f"Error in get_data: {str(e)}", file=sys.stderr)
@@ -216,14 +231,12 @@ def add_cors_headers(response):
 
 @app.route('/collections', methods=["GET"])
 def get_collections():
-	client = index.IDCClient()
-	query = f"""
+	df = query("""
 	select collection_id
 	from index
 	group by collection_id
 	order by collection_id asc
-	"""
-	df = client.sql_query(query)
+	""")
 	result = df.to_json(orient="records")
 	return result
 	#return client.get_collections()
@@ -233,15 +246,12 @@ def get_collections():
 @app.route('/patients/<collection>/', defaults={'filters': None}, methods=["GET"])
 @app.route('/patients/<collection>/<filters>', methods=["GET"])
 def get_patients(collection, filters):
-	client = index.IDCClient()
 	print("iam here", file=sys.stderr)
-	query = f"""
+	df = query("""
 	select PatientID
 	from index
-	where collection_id = '{collection}'
-	""" 
-	
-	df = client.sql_query(query)
+	where collection_id = $1
+	""", [collection])
 	df_unique = df.drop_duplicates()
 	patient_ids = df_unique['PatientID'].tolist()
 
@@ -278,32 +288,26 @@ def get_patients_with_params():
 		if not collection:
 			return jsonify({"error": "Collection parameter is required."}), 400
 		
-		client = index.IDCClient()
-
         # Split patient_ids string into a list
 		patient_id_list = [pid.strip() for pid in patient_ids.split(',') if pid.strip()]
 		
 		if patient_id_list:
-			placeholders = ','.join(['%s'] * len(patient_id_list))
-			query = f"""
+			sql = """
             SELECT DISTINCT PatientID
             FROM index
-            WHERE collection_id = %s
-                AND PatientID IN ({placeholders})
+            WHERE collection_id = $1
+                AND PatientID = ANY($2)
             """
-			params = [collection] + patient_id_list
+			params = [collection, patient_id_list]
 		else:
-			query = """
+			sql = """
             SELECT DISTINCT PatientID
             FROM index
-            WHERE collection_id = %s
+            WHERE collection_id = $1
             """
 			params = [collection]
-		
-		print(f"Debug: SQL Query: {query}", file = sys.stderr)
-		print(f"Debug: Query Parameters: {params}", file = sys.stderr)
-		
-		df = client.sql_query(query, params)
+
+		df = query(sql, params)
 		patient_ids = df['PatientID'].tolist()
 		
 		filtered_patient_ids = filter_primary_sites(patient_ids, primary_sites)
@@ -313,11 +317,244 @@ def get_patients_with_params():
 		print(f"Error in get_patients_with_params: {str(e)}", file=sys.stderr)
 		return jsonify({"error": str(e)}), 500
 
+def similarity_filters(raw):
+	"""
+	Read metadata filters ({field: "a,b" or [a, b]}) for the similarity endpoints.
+	Only the known metadata fields are taken; values of a field are OR-ed.
+	"""
+	filters = {}
+	for field in similarity.METADATA_FIELDS:
+		values = raw.get(field)
+		if not values:
+			continue
+		if isinstance(values, str):
+			values = values.split(',')
+		filters[field] = [str(value).strip() for value in values if str(value).strip()]
+	return filters
+
+# index:5000/similar/d420e653-3fb2-432b-9e81-81232a80264d?k=10&project_id=TCGA-BRCA,TCGA-LUAD
+@app.route('/similar/<case_id>', methods=["GET"])
+def get_similar(case_id):
+	try:
+		k = int(request.args.get('k', 5))
+	except ValueError:
+		return jsonify({"error": "k must be an integer"}), 400
+	if k < 1 or k > similarity.MAX_K:
+		return jsonify({"error": f"k must be between 1 and {similarity.MAX_K}"}), 400
+
+	try:
+		start = time.perf_counter()
+		results = similarity.similar_cases(case_id, k, similarity_filters(request.args))
+		took_us = (time.perf_counter() - start) * 1e6
+	except KeyError:
+		return jsonify({"error": f"Case {case_id} is not in the similarity index"}), 404
+	except ValueError as e:
+		return jsonify({"error": str(e)}), 400
+	except Exception as e:
+		print(f"Error in get_similar: {str(e)}", file=sys.stderr)
+		return jsonify({"error": str(e)}), 500
+
+	if results is None:
+		return jsonify({"error": "Similarity index is not available"}), 503
+
+	return jsonify({
+		"case_id": case_id,
+		"k": k,
+		"results": [{"case_id": cid, "score": score} for cid, score in results],
+		"took_us": round(took_us, 1)
+	})
+
+# POST index:5000/similar/batch {"case_ids": ["..."], "vectors": [[...]], "k": 10, "filters": {"primary_site": ["Breast"]}}
+@app.route('/similar/batch', methods=["POST"])
+def get_similar_batch():
+	body = request.get_json(silent=True) or {}
+	case_ids = body.get('case_ids') or []
+	vectors = body.get('vectors') or None
+	filters = body.get('filters') or {}
+	try:
+		k = int(body.get('k', 5))
+	except (TypeError, ValueError):
+		return jsonify({"error": "k must be an integer"}), 400
+	if k < 1 or k > similarity.MAX_K:
+		return jsonify({"error": f"k must be between 1 and {similarity.MAX_K}"}), 400
+	if not isinstance(case_ids, list) or (vectors is not None and not isinstance(vectors, list)):
+		return jsonify({"error": "case_ids and vectors must be lists"}), 400
+	if not isinstance(filters, dict):
+		return jsonify({"error": "filters must be an object"}), 400
+	if len(case_ids) + len(vectors or []) > similarity.MAX_BATCH:
+		return jsonify({"error": f"At most {similarity.MAX_BATCH} queries per batch"}), 400
+
+	try:
+		start = time.perf_counter()
+		batch = similarity.similar_cases_batch(case_ids, vectors, k, similarity_filters(filters))
+		took_us = (time.perf_counter() - start) * 1e6
+	except ValueError as e:
+		return jsonify({"error": str(e)}), 400
+	except Exception as e:
+		print(f"Error in get_similar_batch: {str(e)}", file=sys.stderr)
+		return jsonify({"error": str(e)}), 500
+
+	if batch is None:
+		return jsonify({"error": "Similarity index is not available"}), 503
+
+	queries = [{"case_id": cid} for cid in case_ids] + [{"vector": i} for i in range(len(vectors or []))]
+	results = []
+	missing = []
+	for query, neighbours in zip(queries, batch):
+		if neighbours is None:
+			missing.append(query["case_id"])
+			continue
+		query["results"] = [{"case_id": cid, "score": score} for cid, score in neighbours]
+		results.append(query)
+
+	return jsonify({
+		"k": k,
+		"results": results,
+		"missing": missing,
+		"took_us": round(took_us, 1)
+	})
+
+# POST index:5000/similar/upload?k=10 with the STAR counts TSV as the raw body:
+# curl --data-binary @counts.tsv -H "Content-Type: text/tab-separated-values" index:5000/similar/upload
+@app.route('/similar/upload', methods=["POST"])
+def get_similar_upload():
+	try:
+		k = int(request.args.get('k', 5))
+	except ValueError:
+		return jsonify({"error": "k must be an integer"}), 400
+	if k < 1 or k > similarity.MAX_K:
+		return jsonify({"error": f"k must be between 1 and {similarity.MAX_K}"}), 400
+	if request.content_length is None or request.content_length > similarity.MAX_UPLOAD_BYTES:
+		return jsonify({"error": f"Upload must have a Content-Length of at most {similarity.MAX_UPLOAD_BYTES} bytes"}), 413
+
+	try:
+		start = time.perf_counter()
+		# Parse the body straight off the request stream; it is never buffered to disk.
+		results = similarity.similar_to_counts(request.stream, k, similarity_filters(request.args))
+		took_us = (time.perf_counter() - start) * 1e6
+	except ValueError as e:
+		return jsonify({"error": str(e)}), 400
+	except Exception as e:
+		print(f"Error in get_similar_upload: {str(e)}", file=sys.stderr)
+		return jsonify({"error": str(e)}), 500
+
+	if results is None:
+		return jsonify({"error": "Similarity index is not available"}), 503
+
+	return jsonify({
+		"k": k,
+		"results": [{"case_id": cid, "score": score} for cid, score in results],
+		"took_us": round(took_us, 1)
+	})
+
+MAX_SERIES_PER_PATIENT = 100
+
+def imaging_series(patient_ids, series_limit):
+	"""
+	Fetch the imaging series of many IDC patients with a single query.
+	Returns {PatientID: [series records with viewer URLs]}, at most series_limit per patient.
+	"""
+	if not patient_ids:
+		return {}
+	sql = """
+	SELECT PatientID, collection_id, Modality, StudyInstanceUID, SeriesInstanceUID, series_aws_url
+	FROM index
+	WHERE PatientID = ANY($1)
+	QUALIFY row_number() OVER (PARTITION BY PatientID ORDER BY StudyInstanceUID, SeriesInstanceUID) <= $2
+	ORDER BY PatientID, StudyInstanceUID, SeriesInstanceUID
+	"""
+	series = {}
+	for record in query(sql, [list(patient_ids), int(series_limit)]).to_dict(orient="records"):
+		record.update(generate_viewer_urls(record))
+		series.setdefault(record.pop('PatientID'), []).append(record)
+	return series
+
+# Expression neighbours of a case together with their IDC imaging, in one call.
+# index:5000/similar/d420e653-3fb2-432b-9e81-81232a80264d/imaging?k=10&series_limit=20&primary_site=Lung
+@app.route('/similar/<case_id>/imaging', methods=["GET"])
+def get_similar_imaging(case_id):
+	try:
+		k = int(request.args.get('k', 5))
+		series_limit = int(request.args.get('series_limit', 20))
+	except ValueError:
+		return jsonify({"error": "k and series_limit must be integers"}), 400
+	if k < 1 or k > similarity.MAX_K:
+		return jsonify({"error": f"k must be between 1 and {similarity.MAX_K}"}), 400
+	if series_limit < 1 or series_limit > MAX_SERIES_PER_PATIENT:
+		return jsonify({"error": f"series_limit must be between 1 and {MAX_SERIES_PER_PATIENT}"}), 400
+
+	try:
+		start = time.perf_counter()
+		results = similarity.similar_cases(case_id, k, similarity_filters(request.args))
+		took_us = (time.perf_counter() - start) * 1e6
+	except KeyError:
+		return jsonify({"error": f"Case {case_id} is not in the similarity index"}), 404
+	except ValueError as e:
+		return jsonify({"error": str(e)}), 400
+	except Exception as e:
+		print(f"Error in get_similar_imaging: {str(e)}", file=sys.stderr)
+		return jsonify({"error": str(e)}), 500
+
+	if results is None:
+		return jsonify({"error": "Similarity index is not available"}), 503
+
+	# GDC submitter_ids are the PatientIDs IDC uses for the same cases.
+	fields = similarity.case_metadata([case_id] + [cid for cid, _ in results])
+	submitter_ids = {cid: meta.get('submitter_id') for cid, meta in fields.items()}
+	try:
+		start = time.perf_counter()
+		series = imaging_series(sorted({sid for sid in submitter_ids.values() if sid}), series_limit)
+		imaging_took_us = (time.perf_counter() - start) * 1e6
+	except Exception as e:
+		print(f"Error in get_similar_imaging: {str(e)}", file=sys.stderr)
+		return jsonify({"error": str(e)}), 500
+
+	def with_imaging(cid):
+		sid = submitter_ids.get(cid)
+		return {"case_id": cid, "submitter_id": sid, "imaging": series.get(sid, []) if sid else []}
+
+	return jsonify({
+		**with_imaging(case_id),
+		"k": k,
+		"results": [{**with_imaging(cid), "score": score} for cid, score in results],
+		"took_us": round(took_us, 1),
+		"imaging_took_us": round(imaging_took_us, 1)
+	})
+
+# Cached, field-trimmed GDC metadata for the UI, so browsers do not each query GDC.
+# index:5000/gdc/projects?fields=project_id&size=10000
+@app.route('/gdc/<endpoint>', methods=["GET"])
+def get_gdc(endpoint):
+	try:
+		entry, cache_status = gdc_proxy.cached_get(endpoint, request.args)
+	except ValueError as e:
+		return jsonify({"error": str(e)}), 400
+	except gdc_proxy.UpstreamError as e:
+		return make_response(e.body, e.status, {"Content-Type": "application/json"})
+	except Exception as e:
+		print(f"Error in get_gdc: {str(e)}", file=sys.stderr)
+		return jsonify({"error": f"GDC request failed: {str(e)}"}), 502
+
+	headers = {
+		"Content-Type": "application/json",
+		"ETag": f'"{entry.etag}"',
+		"Cache-Control": f"public, max-age={int(gdc_proxy.CACHE_TTL)}",
+		"Vary": "Accept-Encoding",
+		"X-Cache": cache_status,
+	}
+	if entry.etag in request.if_none_match:
+		return make_response("", 304, headers)
+	encoding = accepted_encoding(request.headers.get("Accept-Encoding"))
+	body = entry.encoded.get(encoding)
+	if body is None:
+		body = entry.body
+	else:
+		headers["Content-Encoding"] = encoding
+	return make_response(body, 200, headers)
+
 @app.route('/', methods=["GET"])
 def root():
-	client = index.IDCClient()
-	
-	query = """
+	df = query("""
 	SELECT
 	  collection_id,
 	  STRING_AGG(DISTINCT(Modality)) as modalities,
@@ -328,9 +565,7 @@ def root():
 	  collection_id
 	ORDER BY
 	  collection_id ASC
-	"""
-
-	df = client.sql_query(query)
+	""")
 	result = df.to_json(orient="records")
 	#parsed = loads(result)
 
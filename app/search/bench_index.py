@@ -0,0 +1,96 @@
+import argparse
+import json
+import time
+import faiss
+import numpy as np
+from index_factory import INDEX_TYPES, build_index, normalize_rows, prepare_for_search, sample_rows
+
+
+def load_vectors(index_path):
+    """Read every vector from an existing (exact) index file."""
+    index = faiss.read_index(index_path)
+    return normalize_rows(index.reconstruct_n(0, index.ntotal))
+
+
+def exact_neighbours(vectors, queries, k):
+    """Ground-truth top-k ids from an exact inner-product search."""
+    exact = faiss.IndexFlatIP(vectors.shape[1])
+    exact.add(vectors)
+    _, ids = exact.search(queries, k)
+    return ids
+
+
+def recall_at_k(found, truth):
+    """Fraction of the true top-k neighbours returned, averaged over queries."""
+    hits = sum(len(set(f) & set(t)) for f, t in zip(found, truth))
+    return hits / truth.size
+
+
+def benchmark_index_type(index_type, vectors, queries, truth, k, batch_size=1000):
+    """
+    Build one index type over vectors and measure it against the exact result.
+
+    Returns:
+        dict: build time, serialized size, recall@k and query latencies
+    """
+    start = time.perf_counter()
+    index = build_index(
+        (vectors[i:i + batch_size] for i in range(0, len(vectors), batch_size)),
+        len(vectors), index_type,
+    )
+    build_s = time.perf_counter() - start
+    prepare_for_search(index)
+
+    latencies = []
+    found = []
+    for query in queries:
+        start = time.perf_counter()
+        _, ids = index.search(query.reshape(1, -1), k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        found.append(ids[0])
+
+    start = time.perf_counter()
+    index.search(queries, k)
+    batch_ms = (time.perf_counter() - start) * 1000
+
+    return {
+        "index_type": index_type,
+        "n": len(vectors),
+        "d": vectors.shape[1],
+        "build_s": round(build_s, 3),
+        "memory_mb": round(faiss.serialize_index(index).nbytes / 1e6, 2),
+        f"recall@{k}": round(recall_at_k(found, truth), 4),
+        "query_p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "query_p95_ms": round(float(np.percentile(latencies, 95)), 3),
+        "batch_ms_per_query": round(batch_ms / len(queries), 4),
+    }
+
+
+def run_benchmark(vectors, index_types=INDEX_TYPES, k=10, n_queries=200):
+    """Benchmark every index type on the same vectors and query sample."""
+    vectors = normalize_rows(vectors)
+    queries = vectors[sample_rows(len(vectors), n_queries, seed=1)]
+    truth = exact_neighbours(vectors, queries, k)
+    results = []
+    for index_type in index_types:
+        result = benchmark_index_type(index_type, vectors, queries, truth, k)
+        print(json.dumps(result))
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare recall, latency, build time and memory of index types."
+    )
+    parser.add_argument("--index", default="faiss_index.bin", help="Exact index to take vectors from")
+    parser.add_argument("--types", nargs="+", choices=INDEX_TYPES, default=list(INDEX_TYPES))
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--output", default=None, help="Write results as JSON to this path")
+    args = parser.parse_args()
+
+    results = run_benchmark(load_vectors(args.index), args.types, args.k, args.queries)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,125 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import tempfile
+import time
+import urllib.request
+
+STAGES = ("metadata_request", "download", "parse", "embed", "index_insert")
+
+
+def _serve(port, options):
+    from aiohttp import web
+    from fake_gdc import make_app
+    web.run_app(make_app(**options), host="127.0.0.1", port=port, access_log=None, print=None)
+
+
+def start_fake_gdc(options, timeout=30):
+    """Run fake_gdc in a separate process so it does not share the pipeline's event loop."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = multiprocessing.get_context("spawn").Process(target=_serve, args=(port, options), daemon=True)
+    server.start()
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + timeout
+    while True:
+        try:
+            urllib.request.urlopen(f"{base_url}/stats", timeout=1).read()
+            return server, base_url
+        except OSError:
+            if time.time() > deadline or not server.is_alive():
+                server.terminate()
+                raise RuntimeError("Fake GDC server did not start")
+            time.sleep(0.1)
+
+
+def run_benchmark(server_options, case_concurrency=1, case_delay=0.0, patient_delay=0.0, workdir=None,
+                  bulk_group_size=0):
+    """
+    Run main_pipeline end to end against a local fake GDC server.
+
+    Returns:
+        dict: cases/minute, per-stage timings from metrics.py and server counters
+    """
+    server, base_url = start_fake_gdc(server_options)
+    try:
+        # The pipeline reads its endpoint and pacing when its modules are imported.
+        os.environ["GDC_API_URL"] = base_url
+        os.environ["INGEST_CASE_CONCURRENCY"] = str(case_concurrency)
+        os.environ["INGEST_CASE_DELAY"] = str(case_delay)
+        os.environ["INGEST_PATIENT_DELAY"] = str(patient_delay)
+        os.environ["INGEST_BULK_GROUP_SIZE"] = str(bulk_group_size)
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+            os.chdir(tmp)
+            try:
+                import metrics
+                from index import main_pipeline
+
+                start = time.perf_counter()
+                asyncio.run(main_pipeline("downloads", metrics_path=os.path.join(tmp, "metrics.jsonl")))
+                elapsed = time.perf_counter() - start
+                report = metrics.snapshot()
+            finally:
+                os.chdir(cwd)
+        server_stats = json.loads(urllib.request.urlopen(f"{base_url}/stats").read())
+    finally:
+        server.terminate()
+        server.join()
+
+    indexed = report["counters"].get("cases_indexed", 0)
+    return {
+        "server": server_options,
+        "pipeline": {
+            "case_concurrency": case_concurrency,
+            "case_delay": case_delay,
+            "patient_delay": patient_delay,
+            "bulk_group_size": bulk_group_size,
+        },
+        "elapsed_s": round(elapsed, 2),
+        "cases_indexed": indexed,
+        "cases_per_minute": round(indexed / elapsed * 60, 2),
+        "stages": {
+            name: {key: round(value, 2) for key, value in hist.items() if key != "buckets"}
+            for name, hist in report["histograms"].items() if name in STAGES
+        },
+        "counters": report["counters"],
+        "server_stats": server_stats,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the ingestion pipeline end to end against a local fake GDC server."
+    )
+    parser.add_argument("--projects", type=int, default=2)
+    parser.add_argument("--cases", type=int, default=25, help="Cases per project")
+    parser.add_argument("--genes", type=int, default=60660)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--bandwidth-mbps", type=float, default=200.0)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--reset-rate", type=float, default=0.0, help="Fraction of downloads cut off midway")
+    parser.add_argument("--case-concurrency", type=int, default=1)
+    parser.add_argument("--case-delay", type=float, default=0.0, help="Pipeline delay before each case")
+    parser.add_argument("--patient-delay", type=float, default=0.0, help="Pipeline delay after each metadata query")
+    parser.add_argument("--bulk-group-size", type=int, default=0, help="Files per archive download; 0 is one request per file")
+    parser.add_argument("--workdir", default=None, help="Where the pipeline's temporary outputs go")
+    parser.add_argument("--output", default="bench_ingest.json")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    result = run_benchmark(
+        {
+            "n_projects": args.projects, "cases_per_project": args.cases, "n_genes": args.genes,
+            "latency_ms": args.latency_ms, "bandwidth_mbps": args.bandwidth_mbps, "rate_429": args.rate_429,
+            "reset_rate": args.reset_rate,
+        },
+        args.case_concurrency, args.case_delay, args.patient_delay, args.workdir, args.bulk_group_size,
+    )
+    print(json.dumps({key: result[key] for key in ("elapsed_s", "cases_indexed", "cases_per_minute", "stages")}, indent=2))
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
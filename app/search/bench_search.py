@@ -0,0 +1,171 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+import faiss
+import numpy as np
+from index_factory import INDEX_TYPES, build_index, write_index
+from mapping import save_mapping
+from search import load_faiss, reverse_mapping, search_similar_batch, search_similar_cases
+
+N_CLUSTERS = 50
+BATCH_SIZE = 1000
+
+
+def synthetic_counts(n, d, batch_size=BATCH_SIZE, seed=0):
+    """
+    Yield batches of count-like vectors resembling STAR gene counts.
+
+    Gene means are log-normal, every case belongs to one of N_CLUSTERS
+    groups with their own gene effects, and counts are Poisson draws scaled
+    by a per-case library size, so neighbourhoods are meaningful. Batches are
+    generated one at a time, so n * d never has to fit in memory.
+    """
+    rng = np.random.default_rng(seed)
+    gene_means = rng.lognormal(mean=1.0, sigma=2.0, size=d).astype("float32")
+    cluster_effects = rng.lognormal(mean=0.0, sigma=0.5, size=(N_CLUSTERS, d)).astype("float32")
+    for start in range(0, n, batch_size):
+        count = min(batch_size, n - start)
+        batch_rng = np.random.default_rng((seed, start))
+        clusters = batch_rng.integers(N_CLUSTERS, size=count)
+        library = batch_rng.lognormal(mean=0.0, sigma=0.3, size=(count, 1)).astype("float32")
+        yield batch_rng.poisson(gene_means * cluster_effects[clusters] * library).astype("float32")
+
+
+def case_id(i):
+    return f"case-{i:07d}"
+
+
+def build_fixture(directory, n, d, index_type, seed=0):
+    """Build and save an index of n synthetic cases the way ingestion does."""
+    start = time.perf_counter()
+    index = build_index(synthetic_counts(n, d, seed=seed), n, index_type)
+    build_s = time.perf_counter() - start
+    index_path = os.path.join(directory, f"bench_{index_type}_{n}x{d}.bin")
+    mapping_path = os.path.join(directory, f"bench_{index_type}_{n}x{d}.json")
+    write_index(index, index_path)
+    save_mapping({case_id(i): i for i in range(n)}, mapping_path, index.ntotal)
+    return index_path, mapping_path, build_s
+
+
+def _percentiles(latencies_ms):
+    return {
+        "p50_ms": round(float(np.percentile(latencies_ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(latencies_ms, 95)), 3),
+        "p99_ms": round(float(np.percentile(latencies_ms, 99)), 3),
+    }
+
+
+def measure(index_path, mapping_path, mmap, ks, n_queries, batch_size, seed=1):
+    """
+    Time load_faiss and the query paths on a saved index.
+    Runs in its own process (see run_isolated) so peak RSS covers only this index.
+    """
+    start = time.perf_counter()
+    index, mapping = load_faiss(index_path, mapping_path, mmap=mmap)
+    idx_to_case = reverse_mapping(mapping, index.ntotal)
+    load_ms = (time.perf_counter() - start) * 1000
+
+    rng = np.random.default_rng(seed)
+    queries = [case_id(i) for i in rng.choice(index.ntotal, min(n_queries, index.ntotal), replace=False)]
+
+    by_k = {}
+    for k in ks:
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            search_similar_cases(index, mapping, query, k, idx_to_case=idx_to_case)
+            latencies.append((time.perf_counter() - start) * 1000)
+        by_k[str(k)] = _percentiles(latencies)
+
+    k = ks[0]
+    batches = [queries[i:i + batch_size] for i in range(0, len(queries), batch_size)]
+    start = time.perf_counter()
+    for batch in batches:
+        search_similar_batch(index, mapping, batch, k=k, idx_to_case=idx_to_case)
+    batch_ms = (time.perf_counter() - start) * 1000
+
+    return {
+        "mmap": mmap,
+        "load_ms": round(load_ms, 2),
+        "single_query": by_k,
+        f"batched_ms_per_query@{k}": round(batch_ms / len(queries), 4),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def run_isolated(func, *args):
+    """Run func(*args) in a fresh process and return its result."""
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(func, args)
+
+
+def version_info():
+    """What was measured, so results can be compared across versions."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "faiss": faiss.__version__,
+        "numpy": np.__version__,
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def run_benchmark(sizes, dims, index_types=("flat",), ks=(5, 10, 20, 100), n_queries=200,
+                  batch_size=100, mmap_modes=(True, False), directory=None):
+    """Benchmark every (n, d, index type, mmap) combination."""
+    results = {"versions": version_info(), "results": []}
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        for n in sizes:
+            for d in dims:
+                for index_type in index_types:
+                    index_path, mapping_path, build_s = build_fixture(tmp, n, d, index_type)
+                    for mmap in mmap_modes:
+                        result = {
+                            "n": n, "d": d, "index_type": index_type,
+                            "build_s": round(build_s, 2),
+                            "index_mb": round(os.path.getsize(index_path) / 1e6, 2),
+                            **run_isolated(measure, index_path, mapping_path, mmap,
+                                           list(ks), n_queries, batch_size),
+                        }
+                        print(json.dumps(result))
+                        results["results"].append(result)
+                    os.remove(index_path)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark index loading and similarity queries on synthetic expression vectors."
+    )
+    parser.add_argument("--n", nargs="+", type=int, default=[1000, 10000, 100000], help="Numbers of cases")
+    parser.add_argument("--d", nargs="+", type=int, default=[500, 5000], help="Vector dimensions (genes)")
+    parser.add_argument("--types", nargs="+", choices=INDEX_TYPES, default=["flat"])
+    parser.add_argument("-k", nargs="+", type=int, default=[5, 10, 20, 100])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--no-mmap", action="store_true", help="Only measure heap-loaded indexes")
+    parser.add_argument("--tmp-dir", default=None, help="Where to write the fixture indexes")
+    parser.add_argument("--output", default="bench_search.json", help="Write results as JSON to this path")
+    args = parser.parse_args()
+
+    results = run_benchmark(
+        args.n, args.d, args.types, args.k, args.queries, args.batch_size,
+        (False,) if args.no_mmap else (True, False), args.tmp_dir,
+    )
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
@@ -0,0 +1,157 @@
+import asyncio
+import hashlib
+import queue
+import tarfile
+from metrics import incr, timed
+from star_counts import process_file_in_chunks
+
+ARCHIVE_MANIFEST = "MANIFEST.txt"
+PIPE_CHUNKS = 64
+READ_SIZE = 64 * 1024
+
+
+class StreamPipe:
+    """
+    Blocking, read-only file object over chunks fed from the event loop.
+    At most PIPE_CHUNKS chunks are buffered, so a slow reader applies
+    backpressure to the download instead of the archive piling up in memory.
+    """
+
+    def __init__(self, max_chunks=PIPE_CHUNKS):
+        self.chunks = queue.Queue(max_chunks)
+        self.buffer = bytearray()
+        self.eof = False
+        self.closed = False
+
+    def _put(self, chunk):
+        while not self.closed:
+            try:
+                self.chunks.put(chunk, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    async def feed(self, chunk):
+        """Queue a chunk for the reader; returns False once the reader has stopped."""
+        if self.closed:
+            return False
+        try:
+            self.chunks.put_nowait(chunk)
+            return True
+        except queue.Full:
+            return await asyncio.to_thread(self._put, chunk)
+
+    async def finish(self):
+        """Signal the end of the stream."""
+        await self.feed(None)
+
+    def read(self, size=-1):
+        while not self.eof and (size is None or size < 0 or len(self.buffer) < size):
+            try:
+                chunk = self.chunks.get(timeout=0.1)
+            except queue.Empty:
+                if self.closed:
+                    raise EOFError("Stream closed before the end of the archive")
+                continue
+            if chunk is None:
+                self.eof = True
+            else:
+                self.buffer += chunk
+        if size is None or size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def close(self):
+        self.closed = True
+
+
+class MemberReader:
+    """
+    Forward-only reader for one member of a streamed archive that hashes
+    the bytes as they are read. pandas probes seekable(), which the
+    stream-mode member files do not implement.
+    """
+
+    def __init__(self, fileobj, name):
+        self.fileobj = fileobj
+        self.name = name
+        self.digest = hashlib.md5()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.digest.update(data)
+        return data
+
+    def hexdigest(self):
+        """md5 of the whole member; reads whatever the parser left unread."""
+        while self.read(READ_SIZE):
+            pass
+        return self.digest.hexdigest()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+
+def extract_archive(pipe, on_member):
+    """
+    Parse each STAR counts member of a streamed tar(.gz) archive as it arrives.
+    GDC archives hold <file_id>/<file_name> members plus a MANIFEST.txt;
+    on_member(file_id, processed_data, md5) is called for every counts file.
+    """
+    try:
+        with tarfile.open(fileobj=pipe, mode="r|*") as archive:
+            for member in archive:
+                if not member.isfile() or member.name.endswith(ARCHIVE_MANIFEST):
+                    continue
+                file_id = member.name.split("/")[0]
+                reader = MemberReader(archive.extractfile(member), member.name)
+                with timed("parse"):
+                    processed_data = process_file_in_chunks(reader)
+                on_member(file_id, processed_data, reader.hexdigest())
+    finally:
+        pipe.close()
+
+
+async def _feed_response(response, pipe):
+    try:
+        with timed("download"):
+            async for chunk in response.content.iter_chunked(READ_SIZE):
+                incr("download_bytes", len(chunk))
+                if not await pipe.feed(chunk):
+                    break
+    finally:
+        await pipe.finish()
+
+
+async def iter_archive(response):
+    """
+    Yield (file_id, processed_data, md5) for every counts file in an archive
+    response while it is still downloading; nothing is written to disk.
+    Members are parsed in a worker thread as their bytes arrive.
+    """
+    loop = asyncio.get_running_loop()
+    members = asyncio.Queue()
+    pipe = StreamPipe()
+
+    def on_member(file_id, processed_data, md5):
+        loop.call_soon_threadsafe(members.put_nowait, (file_id, processed_data, md5))
+
+    extraction = asyncio.ensure_future(asyncio.to_thread(extract_archive, pipe, on_member))
+    # Runs after every member queued by the thread, so it marks the end.
+    extraction.add_done_callback(lambda _: members.put_nowait(None))
+    feeding = asyncio.ensure_future(_feed_response(response, pipe))
+    try:
+        while (item := await members.get()) is not None:
+            yield item
+        await feeding
+        await extraction
+    finally:
+        pipe.close()
+        feeding.cancel()
+        await asyncio.gather(feeding, extraction, return_exceptions=True)
@@ -0,0 +1,9 @@
+"""
+Values shared by the modules that implement them and by the command line.
+This module imports nothing, so cli.py can build its parser without numpy or faiss.
+"""
+
+# Index types index_factory can build.
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw", "sq8")
+# Metadata fields recorded at ingestion that searches can be filtered on.
+METADATA_FIELDS = ("project_id", "primary_site", "submitter_id")
@@ -0,0 +1,131 @@
+"""
+Command line entry point for the similarity search stack.
+
+    python cli.py ingest [--base-dir downloads] [--metrics-port 9100] [--bulk-group-size 50]
+    python cli.py aggregate [--dir .] [--index-type ivf_flat]
+    python cli.py shard [--dir shards] [--projects TCGA-LUAD] [--workers 8]
+    python cli.py search CASE_ID [-k 10] [--primary-site Lung]
+    python cli.py search --counts counts.tsv [-k 10] [--shards shards]
+    python cli.py serve [--host 0.0.0.0] [--port 5001] [--shards shards]
+
+Only the standard library and choices.py are imported up front; each
+subcommand imports the modules it needs, so --help and argument errors
+return immediately.
+"""
+import argparse
+import os
+import sys
+from choices import INDEX_TYPES, METADATA_FIELDS as FILTER_FIELDS
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def ingest(args):
+    if args.bulk_group_size is not None:
+        os.environ["INGEST_BULK_GROUP_SIZE"] = str(args.bulk_group_size)
+    import asyncio
+    from index import main_pipeline
+    asyncio.run(main_pipeline(args.base_dir, metrics_port=args.metrics_port))
+
+
+def aggregate(args):
+    from process import aggregate_checkpoints
+    index, _ = aggregate_checkpoints(args.dir, index_type=args.index_type)
+    return 0 if index is not None else 1
+
+
+def shard(args):
+    from shards import build_shards
+    table = build_shards(args.store, args.dir, args.projects, args.workers, args.index_type)
+    return 0 if table else 1
+
+
+def search(args):
+    os.environ.setdefault("SIMILARITY_RELOAD_INTERVAL", "0")
+    if args.shards:
+        os.environ["SIMILARITY_SHARD_DIR"] = args.shards
+    if args.index:
+        os.environ["SIMILARITY_INDEX_PATH"] = args.index
+    if args.mapping:
+        os.environ["SIMILARITY_MAPPING_PATH"] = args.mapping
+    import service
+
+    filters = {field: getattr(args, field) for field in FILTER_FIELDS if getattr(args, field)}
+    try:
+        if args.counts:
+            results = service.similar_to_counts(args.counts, args.k, filters)
+        else:
+            results = service.similar_cases(args.case_id, args.k, filters)
+    except KeyError:
+        print(f"Case {args.case_id} is not in the similarity index")
+        return 1
+    except ValueError as e:
+        print(e)
+        return 1
+    if results is None:
+        print(f"No similarity index at {service.INDEX_PATH}")
+        return 1
+    for case_id, similarity in results:
+        print(f"Case: {case_id}, Similarity: {similarity:.3f}")
+    return 0
+
+
+def serve(args):
+    if args.shards:
+        os.environ["SIMILARITY_SHARD_DIR"] = args.shards
+    sys.path.insert(0, os.path.dirname(HERE))
+    from app import app
+    app.run(host=args.host, port=args.port)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Ingest, aggregate, search and serve the case similarity index.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    ingest_parser = commands.add_parser("ingest", help="Download, embed and index every eligible GDC project")
+    ingest_parser.add_argument("--base-dir", default="downloads")
+    ingest_parser.add_argument("--metrics-port", type=int, default=None)
+    ingest_parser.add_argument("--bulk-group-size", type=int, default=None,
+                               help="Download this many files per archive request")
+    ingest_parser.set_defaults(func=ingest)
+
+    aggregate_parser = commands.add_parser("aggregate", help="Merge checkpoints into one compacted index")
+    aggregate_parser.add_argument("--dir", default=".", help="Directory holding the checkpoints")
+    aggregate_parser.add_argument("--index-type", choices=INDEX_TYPES, default=None, help="Output index type")
+    aggregate_parser.set_defaults(func=aggregate)
+
+    shard_parser = commands.add_parser("shard", help="Build one index per project from the counts store")
+    shard_parser.add_argument("--store", default="counts_store", help="Counts store directory")
+    shard_parser.add_argument("--dir", default="shards", help="Directory the shards are written to")
+    shard_parser.add_argument("--projects", nargs="+", default=None, help="Only rebuild these projects' shards")
+    shard_parser.add_argument("--workers", type=int, default=None)
+    shard_parser.add_argument("--index-type", choices=INDEX_TYPES, default=None, help="Shard index type")
+    shard_parser.set_defaults(func=shard)
+
+    search_parser = commands.add_parser("search", help="Find the cases most similar to a case or a counts file")
+    query = search_parser.add_mutually_exclusive_group(required=True)
+    query.add_argument("case_id", nargs="?")
+    query.add_argument("--counts", help="STAR gene counts TSV to query with")
+    search_parser.add_argument("-k", type=int, default=5)
+    search_parser.add_argument("--index", default=None)
+    search_parser.add_argument("--mapping", default=None)
+    search_parser.add_argument("--shards", default=None, help="Search the per-project shards in this directory")
+    for field in FILTER_FIELDS:
+        search_parser.add_argument(f"--{field.replace('_', '-')}", nargs="+", help=f"Only return cases with this {field}")
+    search_parser.set_defaults(func=search)
+
+    serve_parser = commands.add_parser("serve", help="Run the API server")
+    serve_parser.add_argument("--host", default="0.0.0.0")
+    serve_parser.add_argument("--port", type=int, default=5001)
+    serve_parser.add_argument("--shards", default=None, help="Serve the per-project shards in this directory")
+    serve_parser.set_defaults(func=serve)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args) or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,61 @@
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+# Smaller bodies are sent as they are; compressing them saves nothing on the wire.
+MIN_COMPRESS_BYTES = 1024
+
+
+def supported_encodings():
+    """Content-Encodings this process can produce, most preferred first."""
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def accepted_encoding(accept_encoding):
+    """
+    Pick the response encoding from an Accept-Encoding header: br if the
+    client takes it and brotli is installed, then gzip, else None.
+    """
+    accepted = {}
+    for token in (accept_encoding or "").split(","):
+        name, _, params = token.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name.strip().lower()] = quality
+    for encoding in supported_encodings():
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+
+def compress(body, encoding):
+    """Encode body (bytes) with a Content-Encoding from supported_encodings()."""
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    if encoding == "gzip":
+        return gzip.compress(body, GZIP_LEVEL, mtime=0)
+    return body
+
+
+def encode_body(body, accept_encoding):
+    """
+    Compress a response body for a client.
+
+    Returns:
+        tuple: (body, encoding), encoding None when sent uncompressed
+    """
+    encoding = accepted_encoding(accept_encoding)
+    if encoding is None or len(body) < MIN_COMPRESS_BYTES:
+        return body, None
+    return compress(body, encoding), encoding
@@ -0,0 +1,126 @@
+import json
+import os
+import threading
+import numpy as np
+
+COUNTS_DIR = "counts_store"
+CHUNK_ROWS = 256
+GENES_FILE = "genes.json"
+CASES_FILE = "cases.jsonl"
+
+# Store state, populated by open_store.
+store_dir = None
+genes = None
+case_rows = {}  # Maps case_id to its latest row in the store
+next_row = 0
+store_lock = threading.Lock()
+
+
+def chunk_path(chunk_num, directory=None):
+    return os.path.join(directory or store_dir, f"chunk_{chunk_num:05d}.npy")
+
+
+def open_store(directory=COUNTS_DIR, gene_order=None):
+    """
+    Open (or create) the on-disk counts matrix.
+
+    The store is a cases x genes float32 matrix split into memory-mapped
+    chunks of CHUNK_ROWS rows, plus a case index where each line commits
+    one written row.
+
+    Args:
+        directory (str): Store directory
+        gene_order (list): Gene order for a new store; ignored if one exists
+
+    Returns:
+        bool: True if the store has a gene order and is ready for use
+    """
+    global store_dir, genes, case_rows, next_row
+    with store_lock:
+        store_dir = directory
+        genes = None
+        case_rows = {}
+        next_row = 0
+        os.makedirs(directory, exist_ok=True)
+
+        genes_path = os.path.join(directory, GENES_FILE)
+        if os.path.exists(genes_path):
+            with open(genes_path, 'r') as f:
+                genes = json.load(f)
+        elif gene_order is not None:
+            genes = list(gene_order)
+            with open(genes_path, 'w') as f:
+                json.dump(genes, f)
+                f.flush()
+                os.fsync(f.fileno())
+
+        cases_path = os.path.join(directory, CASES_FILE)
+        if os.path.exists(cases_path):
+            with open(cases_path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    case_rows[entry["case_id"]] = entry["row"]
+                    next_row = max(next_row, entry["row"] + 1)
+
+    if genes is not None:
+        print(f"Opened counts store {directory} with {len(case_rows)} cases x {len(genes)} genes")
+    return genes is not None
+
+
+def append_counts(case_id, counts, gene_order=None):
+    """
+    Append one case's aligned count vector to the store.
+    The store is opened on first use, taking gene_order for a new store.
+    Returns the row the vector was written to.
+    """
+    global next_row
+    if store_dir is None or genes is None:
+        open_store(store_dir or COUNTS_DIR, gene_order)
+
+    counts = np.asarray(counts, dtype="float32")
+    with store_lock:
+        if len(counts) != len(genes):
+            raise ValueError(f"Counts for {case_id} have {len(counts)} genes, store has {len(genes)}")
+
+        row = next_row
+        chunk_num, offset = divmod(row, CHUNK_ROWS)
+        path = chunk_path(chunk_num)
+        mode = 'r+' if os.path.exists(path) else 'w+'
+        chunk = np.lib.format.open_memmap(
+            path, mode=mode, dtype="float32", shape=(CHUNK_ROWS, len(genes))
+        )
+        chunk[offset] = counts
+        chunk.flush()
+        del chunk
+
+        # The case index line is the commit marker for the row.
+        with open(os.path.join(store_dir, CASES_FILE), 'a') as f:
+            f.write(json.dumps({"case_id": case_id, "row": row}) + "\n")
+        case_rows[case_id] = row
+        next_row = row + 1
+    return row
+
+
+def read_counts(case_id):
+    """Return the stored count vector for a case, or None if it is not stored."""
+    row = case_rows.get(case_id)
+    if row is None:
+        return None
+    chunk_num, offset = divmod(row, CHUNK_ROWS)
+    chunk = np.load(chunk_path(chunk_num), mmap_mode='r')
+    return np.array(chunk[offset])
+
+
+def chunk_assignments():
+    """
+    Group the latest row of every case by chunk.
+    Returns a list of (chunk_num, [(offset, case_id), ...]) in row order.
+    """
+    chunks = {}
+    for case_id, row in case_rows.items():
+        chunk_num, offset = divmod(row, CHUNK_ROWS)
+        chunks.setdefault(chunk_num, []).append((offset, case_id))
+    return [(chunk_num, sorted(chunks[chunk_num])) for chunk_num in sorted(chunks)]
@@ -0,0 +1,115 @@
+import asyncio
+import hashlib
+import os
+import random
+import aiofiles
+from metrics import incr
+
+MIN_READ = 64 * 1024
+MAX_READ = 1024 * 1024
+DOWNLOAD_RETRIES = 5
+RETRY_BASE_DELAY = 1.0
+MAX_RETRY_DELAY = 60.0
+# A stalled read is retried; a slow but progressing download is not cut off.
+# Keyword arguments of the aiohttp.ClientTimeout each request is made with.
+DOWNLOAD_TIMEOUT = {"total": None, "sock_connect": 30, "sock_read": 60}
+
+
+class DownloadError(Exception):
+    """A file could not be downloaded intact within the allowed retries."""
+
+
+class RetryableError(Exception):
+    """A failed attempt that is worth retrying, after delay seconds if given."""
+
+    def __init__(self, message, delay=None):
+        super().__init__(message)
+        self.delay = delay
+
+
+def _resume_state(filepath):
+    """md5 and size of a partial file left by an earlier attempt."""
+    digest = hashlib.md5()
+    if not os.path.exists(filepath):
+        return digest, 0
+    with open(filepath, "rb") as f:
+        while block := f.read(MAX_READ):
+            digest.update(block)
+    return digest, os.path.getsize(filepath)
+
+
+def _retry_after(resp):
+    try:
+        return float(resp.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+async def download_file(session, url, filepath, expected_md5=None, retries=DOWNLOAD_RETRIES):
+    """
+    Download url to filepath, resuming interrupted transfers with Range requests.
+
+    The md5 is computed while the bytes are written, so verifying it needs no
+    second pass. Reads start at MIN_READ bytes and grow up to MAX_READ while
+    the connection keeps filling them. Failed attempts are retried with
+    exponential backoff (honouring Retry-After on 429) from the last byte
+    written; a file whose md5 does not match is downloaded again from scratch.
+
+    Returns:
+        int: Size of the downloaded file
+
+    Raises:
+        DownloadError: if the file cannot be downloaded intact in retries + 1 attempts
+    """
+    import aiohttp
+    digest, offset = _resume_state(filepath)
+    attempt = 0
+    while True:
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        try:
+            async with session.get(url, headers=headers, timeout=aiohttp.ClientTimeout(**DOWNLOAD_TIMEOUT)) as resp:
+                if resp.status == 416:
+                    # The partial file does not fit the remote one; start over.
+                    digest, offset = hashlib.md5(), 0
+                    os.remove(filepath)
+                    raise RetryableError("range not satisfiable", delay=0)
+                if resp.status == 429:
+                    incr("http_429")
+                    raise RetryableError("rate limited", delay=_retry_after(resp))
+                if resp.status in (408, 500, 502, 503, 504):
+                    raise RetryableError(f"status {resp.status}", delay=_retry_after(resp))
+                if resp.status not in (200, 206):
+                    raise DownloadError(f"status {resp.status}")
+                if resp.status == 200 and offset:
+                    # The server ignored the range and sent the whole file.
+                    digest, offset = hashlib.md5(), 0
+                if offset:
+                    incr("download_resumes")
+
+                async with aiofiles.open(filepath, "ab" if offset else "wb") as f:
+                    read_size = MIN_READ
+                    while chunk := await resp.content.read(read_size):
+                        await f.write(chunk)
+                        digest.update(chunk)
+                        offset += len(chunk)
+                        incr("download_bytes", len(chunk))
+                        if len(chunk) == read_size:
+                            read_size = min(read_size * 2, MAX_READ)
+
+            if expected_md5 and digest.hexdigest() != expected_md5:
+                incr("md5_mismatches")
+                digest, offset = hashlib.md5(), 0
+                os.remove(filepath)
+                raise RetryableError(f"md5 mismatch, expected {expected_md5}")
+            return offset
+
+        except (aiohttp.ClientError, asyncio.TimeoutError, RetryableError) as e:
+            attempt += 1
+            if attempt > retries:
+                raise DownloadError(f"{e} after {attempt} attempts") from e
+            incr("download_retries")
+            delay = getattr(e, "delay", None)
+            if delay is None:
+                delay = min(RETRY_BASE_DELAY * 2 ** (attempt - 1), MAX_RETRY_DELAY) * random.uniform(0.5, 1.5)
+            print(f"Retrying {url} from byte {offset} in {delay:.1f}s: {e}")
+            await asyncio.sleep(delay)
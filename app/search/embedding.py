@@ -0,0 +1,112 @@
+import hashlib
+import os
+import numpy as np
+
+REDUCER_PATH = "embedding_model.npz"
+REDUCER_METHODS = ("pca", "random")
+N_VARIABLE_GENES = 5000
+N_COMPONENTS = 256
+FIT_SAMPLE_SIZE = 5000
+
+
+def normalize_counts(counts):
+    """
+    Library-size normalise raw counts to counts per million, then log1p.
+    Accepts a single vector or a (cases, genes) matrix.
+    """
+    counts = np.atleast_2d(np.asarray(counts, dtype="float32"))
+    totals = counts.sum(axis=1, keepdims=True)
+    totals[totals == 0] = 1.0
+    return np.log1p(counts / totals * 1e6)
+
+
+def select_variable_genes(normalized, n_genes=N_VARIABLE_GENES):
+    """Indices (in gene order) of the n_genes with the highest variance."""
+    variances = normalized.var(axis=0)
+    n_genes = min(n_genes, len(variances))
+    return np.sort(np.argpartition(variances, -n_genes)[-n_genes:])
+
+
+def fit_reducer(counts, n_genes=N_VARIABLE_GENES, n_components=N_COMPONENTS,
+                method="pca", seed=0):
+    """
+    Fit the embedding transform on a sample of raw count vectors.
+
+    Counts are normalised with normalize_counts, restricted to the most
+    variable genes, centred and projected to n_components dimensions by PCA
+    or by a Gaussian random projection.
+
+    Args:
+        counts (np.ndarray): (cases, genes) raw counts aligned to the reference genes
+        method (str): "pca" or "random"
+
+    Returns:
+        dict: reducer with gene_indices, mean, components and method
+    """
+    if method not in REDUCER_METHODS:
+        raise ValueError(f"Unknown reducer method {method!r}; expected one of {REDUCER_METHODS}")
+
+    normalized = normalize_counts(counts)
+    gene_indices = select_variable_genes(normalized, n_genes)
+    selected = normalized[:, gene_indices]
+    mean = selected.mean(axis=0)
+
+    if method == "pca":
+        n_components = min(n_components, *selected.shape)
+        _, _, vt = np.linalg.svd(selected - mean, full_matrices=False)
+        components = vt[:n_components]
+    else:
+        rng = np.random.default_rng(seed)
+        components = rng.standard_normal((n_components, len(gene_indices))) / np.sqrt(n_components)
+
+    print(f"Fitted {method} reducer: {counts.shape[1]} genes -> "
+          f"{len(gene_indices)} variable genes -> {len(components)} dimensions")
+    return {
+        "method": method,
+        "gene_indices": gene_indices.astype("int64"),
+        "mean": mean.astype("float32"),
+        "components": np.ascontiguousarray(components, dtype="float32"),
+    }
+
+
+def transform(reducer, counts):
+    """Project raw count vectors with a fitted reducer; returns (n, n_components) float32."""
+    selected = normalize_counts(counts)[:, reducer["gene_indices"]]
+    return np.ascontiguousarray((selected - reducer["mean"]) @ reducer["components"].T, dtype="float32")
+
+
+def embed_counts(counts, reducer=None):
+    """
+    Turn one aligned raw count vector into the vector stored in the index:
+    the counts themselves without a reducer, otherwise their projection.
+    """
+    if reducer is None:
+        return np.asarray(counts, dtype="float32")
+    return transform(reducer, counts)[0]
+
+
+def reducer_id(reducer):
+    """Short fingerprint of a reducer ("raw" for none), recorded with the vectors it produced."""
+    if reducer is None:
+        return "raw"
+    digest = hashlib.sha1(str(reducer["method"]).encode())
+    for name in ("gene_indices", "mean", "components"):
+        digest.update(np.ascontiguousarray(reducer[name]).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def save_reducer(reducer, path=REDUCER_PATH):
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, **reducer)
+    os.replace(tmp_path, path)
+    print(f"Saved embedding reducer to {path}")
+
+
+def load_reducer(path=REDUCER_PATH):
+    """Load a saved reducer, or None if there is none (raw counts are embedded)."""
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        reducer = {name: data[name] for name in data.files}
+    reducer["method"] = str(reducer["method"])
+    return reducer
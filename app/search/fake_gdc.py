@@ -0,0 +1,325 @@
+import argparse
+import asyncio
+import hashlib
+import io
+import random
+import tarfile
+import uuid
+import numpy as np
+from aiohttp import web
+
+# Stand-in for the parts of the GDC API the ingestion pipeline uses:
+#   POST /v0/graphql   the Projects, ProjectCases and FileSearch queries in query.py
+#   GET  /data/<id>    STAR counts TSV downloads, with Range support
+#   POST /data         {"ids": [...]} bulk downloads as a tar.gz archive
+# Run it and point the pipeline at it with GDC_API_URL=http://127.0.0.1:<port>.
+
+N_GENES = 60660
+SPECIAL_ROWS = ['N_unmapped', 'N_multimapping', 'N_noFeature', 'N_ambiguous']
+STAR_COLUMNS = "gene_id\tgene_name\tgene_type\tunstranded\tstranded_first\tstranded_second\ttpm_unstranded\tfpkm_unstranded\tfpkm_uq_unstranded"
+WRITE_CHUNK = 64 * 1024
+NAMESPACE = uuid.UUID("5a1f6c1e-0000-4000-8000-000000000000")
+
+
+def make_catalog(n_projects, cases_per_project, seed=0):
+    """Deterministic projects, cases and one STAR counts file per case."""
+    projects = {}
+    cases = {}
+    for p in range(n_projects):
+        project_id = f"FAKE-{p:03d}"
+        projects[project_id] = []
+        for c in range(cases_per_project):
+            case_id = str(uuid.uuid5(NAMESPACE, f"{seed}/{project_id}/{c}"))
+            file_id = str(uuid.uuid5(NAMESPACE, f"{seed}/{case_id}/file"))
+            cases[case_id] = {
+                "case_id": case_id,
+                "submitter_id": f"{project_id}-{c:05d}",
+                "project_id": project_id,
+                "primary_site": ("Lung", "Breast", "Kidney", "Brain")[c % 4],
+                "file_id": file_id,
+                "file_name": f"{file_id}.rna_seq.augmented_star_gene_counts.tsv",
+                "seed": (seed, p, c),
+            }
+            projects[project_id].append(case_id)
+    return projects, cases
+
+
+def render_counts(case, gene_lines):
+    """STAR counts TSV for a case: Poisson counts around shared log-normal gene means."""
+    rng = np.random.default_rng(case["seed"])
+    counts = rng.poisson(gene_lines["means"]).tolist()
+    lines = ["# gene-model: GENCODE v36", STAR_COLUMNS]
+    lines += [f"{name}\t\t\t{rng.integers(10**6)}\t0\t0\t\t\t" for name in SPECIAL_ROWS]
+    lines += [
+        f"{prefix}{count}\t{count}\t0\t{count / 10:.4f}\t{count / 20:.4f}\t{count / 30:.4f}"
+        for prefix, count in zip(gene_lines["prefixes"], counts)
+    ]
+    return ("\n".join(lines) + "\n").encode()
+
+
+def file_bytes(app, case):
+    """Rendered file and its md5, cached since FileSearch reports the md5 before download."""
+    cache = app["files"]
+    if case["file_id"] not in cache:
+        if len(cache) >= app["config"]["cache_files"]:
+            cache.pop(next(iter(cache)))
+        content = render_counts(case, app["genes"])
+        cache[case["file_id"]] = (content, hashlib.md5(content).hexdigest())
+    return cache[case["file_id"]]
+
+
+async def maybe_throttle(app):
+    """Apply the configured latency; returns a 429 response for injected rate limiting."""
+    config = app["config"]
+    if config["latency_ms"]:
+        await asyncio.sleep(config["latency_ms"] / 1000)
+    if config["rate_429"] and random.random() < config["rate_429"]:
+        app["stats"]["http_429"] += 1
+        return web.json_response({"message": "Too many requests"}, status=429)
+    return None
+
+
+def _filter_value(filters, field):
+    """Value of the first filter on field in a GDC filter tree."""
+    if not isinstance(filters, dict):
+        return None
+    content = filters.get("content")
+    if isinstance(content, dict):
+        return content.get("value") if content.get("field") == field else None
+    for child in content or []:
+        value = _filter_value(child, field)
+        if value is not None:
+            return value
+    return None
+
+
+def _case_node(case):
+    return {
+        "case_id": case["case_id"],
+        "submitter_id": case["submitter_id"],
+        "primary_site": case["primary_site"],
+        "project": {"project_id": case["project_id"]},
+    }
+
+
+async def graphql(request):
+    app = request.app
+    app["stats"]["graphql"] += 1
+    throttled = await maybe_throttle(app)
+    if throttled is not None:
+        return throttled
+    body = await request.json()
+    query = body.get("query", "")
+    variables = body.get("variables") or {}
+
+    if "files {" in query:
+        case_ids = _filter_value(variables.get("filters"), "cases.case_id") or []
+        edges = []
+        for case_id in case_ids:
+            case = app["cases"].get(case_id)
+            if case is None:
+                continue
+            _, md5 = file_bytes(app, case)
+            edges.append({"node": {
+                "file_id": case["file_id"],
+                "file_name": case["file_name"],
+                "md5sum": md5,
+                "data_category": "Transcriptome Profiling",
+                "data_format": "TSV",
+                "experimental_strategy": "RNA-Seq",
+                "access": "open",
+                "analysis": {"workflow_type": "STAR - Counts"},
+                "cases": {"hits": {"edges": [{"node": _case_node(case)}]}},
+            }})
+        return web.json_response({"data": {"repository": {"files": {"hits": {"edges": edges}}}}})
+
+    if "cases {" in query:
+        project_id = _filter_value(variables.get("filters"), "project.project_id")
+        case_ids = app["projects"].get(project_id, [])[:variables.get("size") or None]
+        edges = [{"node": _case_node(app["cases"][case_id])} for case_id in case_ids]
+        return web.json_response({"data": {"repository": {"cases": {"hits": {"edges": edges}}}}})
+
+    if "projects {" in query:
+        edges = [
+            {"node": {
+                "project_id": project_id,
+                "name": f"Synthetic project {project_id}",
+                "primary_site": ["Lung", "Breast", "Kidney", "Brain"],
+                "disease_type": ["Synthetic"],
+                "summary": {"case_count": len(case_ids)},
+            }}
+            for project_id, case_ids in app["projects"].items()
+        ]
+        return web.json_response({"data": {"projects": {"hits": {"edges": edges}}}})
+
+    return web.json_response({"errors": [{"message": "Unsupported query"}]}, status=400)
+
+
+async def data(request):
+    app = request.app
+    app["stats"]["downloads"] += 1
+    throttled = await maybe_throttle(app)
+    if throttled is not None:
+        return throttled
+    case = app["files_by_id"].get(request.match_info["file_id"])
+    if case is None:
+        return web.json_response({"message": "File not found"}, status=404)
+    content, _ = file_bytes(app, case)
+
+    return await send_bytes(request, content, "text/tab-separated-values", case["file_name"], ranged=True)
+
+
+async def bulk_data(request):
+    """Several files as one tar.gz of <file_id>/<file_name> members plus MANIFEST.txt, like GDC."""
+    app = request.app
+    app["stats"]["bulk_requests"] += 1
+    throttled = await maybe_throttle(app)
+    if throttled is not None:
+        return throttled
+    body = await request.json()
+    cases = [app["files_by_id"][file_id] for file_id in body.get("ids", []) if file_id in app["files_by_id"]]
+    if not cases:
+        return web.json_response({"message": "No files found"}, status=404)
+    if len(cases) == 1:
+        content, _ = file_bytes(app, cases[0])
+        return await send_bytes(request, content, "text/tab-separated-values", cases[0]["file_name"])
+
+    buffer = io.BytesIO()
+    manifest = ["id\tfilename\tmd5\tsize\tstate"]
+    with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+        for case in cases:
+            content, md5 = file_bytes(app, case)
+            name = f"{case['file_id']}/{case['file_name']}"
+            manifest.append(f"{case['file_id']}\t{name}\t{md5}\t{len(content)}\treleased")
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            archive.addfile(info, io.BytesIO(content))
+        listing = ("\n".join(manifest) + "\n").encode()
+        info = tarfile.TarInfo("MANIFEST.txt")
+        info.size = len(listing)
+        archive.addfile(info, io.BytesIO(listing))
+    return await send_bytes(request, buffer.getvalue(), "application/x-tar", "gdc_download.tar.gz")
+
+
+def _range_start(request, size):
+    """Start offset of a "bytes=<start>-" Range header, 0 without one, None if unsatisfiable."""
+    header = request.headers.get("Range", "")
+    if not header.startswith("bytes=") or not header.endswith("-"):
+        return 0
+    start = int(header[len("bytes="):-1])
+    return start if start < size else None
+
+
+async def send_bytes(request, content, content_type, filename, ranged=False):
+    """
+    Stream content at the configured bandwidth, honouring a Range header if
+    ranged. With reset_rate set, transfers are cut off midway at random.
+    """
+    app = request.app
+    headers = {
+        "Content-Type": content_type,
+        "Content-Disposition": f'attachment; filename="{filename}"',
+        "Accept-Ranges": "bytes" if ranged else "none",
+    }
+    start = _range_start(request, len(content)) if ranged else 0
+    if start is None:
+        return web.Response(status=416, headers={"Content-Range": f"bytes */{len(content)}"})
+    status = 200
+    if start:
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{len(content) - 1}/{len(content)}"
+        app["stats"]["range_requests"] += 1
+    body = content[start:]
+
+    response = web.StreamResponse(status=status, headers=headers)
+    response.content_length = len(body)
+    await response.prepare(request)
+    bytes_per_s = app["config"]["bandwidth_mbps"] * 1e6 / 8
+    cut_at = len(body)
+    if app["config"]["reset_rate"] and random.random() < app["config"]["reset_rate"]:
+        cut_at = random.randrange(len(body))
+    for offset in range(0, len(body), WRITE_CHUNK):
+        if offset >= cut_at:
+            app["stats"]["resets"] += 1
+            request.transport.close()
+            return response
+        chunk = body[offset:offset + WRITE_CHUNK]
+        await response.write(chunk)
+        app["stats"]["download_bytes"] += len(chunk)
+        if bytes_per_s:
+            await asyncio.sleep(len(chunk) / bytes_per_s)
+    await response.write_eof()
+    return response
+
+
+async def stats(request):
+    return web.json_response(request.app["stats"])
+
+
+def make_app(n_projects=3, cases_per_project=25, n_genes=N_GENES, latency_ms=0.0,
+             bandwidth_mbps=0.0, rate_429=0.0, reset_rate=0.0, cache_files=64, seed=0):
+    """
+    Build the stand-in server.
+
+    Args:
+        latency_ms (float): Delay added before every response
+        bandwidth_mbps (float): Download bandwidth per request in megabits/s; 0 is unlimited
+        rate_429 (float): Probability of answering any request with 429
+        reset_rate (float): Probability of dropping the connection partway through a download
+        cache_files (int): Rendered files kept in memory
+    """
+    app = web.Application()
+    projects, cases = make_catalog(n_projects, cases_per_project, seed)
+    rng = np.random.default_rng(seed)
+    app["config"] = {
+        "latency_ms": latency_ms, "bandwidth_mbps": bandwidth_mbps,
+        "rate_429": rate_429, "reset_rate": reset_rate, "cache_files": cache_files,
+    }
+    app["projects"] = projects
+    app["cases"] = cases
+    app["files_by_id"] = {case["file_id"]: case for case in cases.values()}
+    app["genes"] = {
+        "prefixes": [f"ENSG{i:011d}.1\tGENE{i}\tprotein_coding\t" for i in range(n_genes)],
+        "means": rng.lognormal(mean=1.0, sigma=2.0, size=n_genes),
+    }
+    app["files"] = {}
+    app["stats"] = {
+        "graphql": 0, "downloads": 0, "bulk_requests": 0, "range_requests": 0,
+        "download_bytes": 0, "http_429": 0, "resets": 0,
+    }
+    app.router.add_post("/v0/graphql", graphql)
+    app.router.add_get("/data/{file_id}", data)
+    app.router.add_post("/data", bulk_data)
+    app.router.add_get("/stats", stats)
+    return app
+
+
+async def start_server(app, host="127.0.0.1", port=0):
+    """Start serving app; returns (runner, base_url). Stop with runner.cleanup()."""
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{port}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a synthetic stand-in for the GDC API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--projects", type=int, default=3)
+    parser.add_argument("--cases", type=int, default=25, help="Cases per project")
+    parser.add_argument("--genes", type=int, default=N_GENES)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--bandwidth-mbps", type=float, default=0.0)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--reset-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    web.run_app(
+        make_app(args.projects, args.cases, args.genes, args.latency_ms,
+                 args.bandwidth_mbps, args.rate_429, args.reset_rate, seed=args.seed),
+        host=args.host, port=args.port, access_log=None,
+    )
@@ -0,0 +1,207 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from compression import MIN_COMPRESS_BYTES, compress, supported_encodings
+
+GDC_API_URL = os.environ.get("GDC_API_URL", "https://api.gdc.cancer.gov").rstrip("/")
+# GDC endpoints the UI reads metadata from.
+ENDPOINTS = ("projects", "cases", "files")
+PASSTHROUGH_PARAMS = ("filters", "fields", "expand", "size", "from", "sort", "facets")
+# Seconds a response is served as fresh, then served stale while it is refreshed.
+CACHE_TTL = float(os.environ.get("GDC_PROXY_TTL", "300"))
+CACHE_STALE = float(os.environ.get("GDC_PROXY_STALE", "3600"))
+CACHE_MAX_BYTES = int(os.environ.get("GDC_PROXY_MAX_BYTES", str(256 * 1024 * 1024)))
+MAX_ENTRY_BYTES = 32 * 1024 * 1024
+FETCH_THREADS = 8
+FETCH_TIMEOUT = 60
+
+
+class UpstreamError(Exception):
+    """GDC answered with an error status; body is passed through to the client."""
+
+    def __init__(self, status, body):
+        super().__init__(f"GDC returned status {status}")
+        self.status = status
+        self.body = body
+
+
+class CachedResponse:
+    """A trimmed GDC response body with its compressed forms and ETag."""
+
+    def __init__(self, body):
+        self.body = body
+        self.fetched = time.time()
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.encoded = {}
+        if len(body) >= MIN_COMPRESS_BYTES:
+            self.encoded = {encoding: compress(body, encoding) for encoding in supported_encodings()}
+        self.size = len(body) + sum(map(len, self.encoded.values()))
+
+
+class ProxyCache:
+    """
+    Byte-bounded LRU cache of upstream responses shared by every request.
+
+    Entries are fresh for ttl seconds; for stale seconds after that they are
+    still served while a single background fetch replaces them, and they are
+    served past that if the upstream is failing. Concurrent misses for the
+    same key wait on one upstream fetch.
+    """
+
+    def __init__(self, fetch, ttl=CACHE_TTL, stale=CACHE_STALE, max_bytes=CACHE_MAX_BYTES,
+                 threads=FETCH_THREADS):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.stale = stale
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="gdc-proxy")
+
+    def get(self, key):
+        """
+        Returns:
+            tuple: (CachedResponse, "HIT" | "STALE" | "MISS")
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                age = time.time() - entry.fetched
+                if age < self.ttl:
+                    return entry, "HIT"
+                if age < self.ttl + self.stale:
+                    self._schedule(key)
+                    return entry, "STALE"
+            future = self._schedule(key)
+        try:
+            return future.result(), "MISS"
+        except UpstreamError:
+            raise
+        except Exception as e:
+            if entry is None:
+                raise
+            print(f"Serving stale GDC response after refresh failed: {e}")
+            return entry, "STALE"
+
+    def _schedule(self, key):
+        # Called with the lock held.
+        future = self.inflight.get(key)
+        if future is None:
+            future = self.pool.submit(self._load, key)
+            self.inflight[key] = future
+        return future
+
+    def _load(self, key):
+        try:
+            entry = self.fetch(key)
+            with self.lock:
+                self._store(key, entry)
+            return entry
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+
+    def _store(self, key, entry):
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.size -= previous.size
+        if entry.size > MAX_ENTRY_BYTES:
+            return
+        self.entries[key] = entry
+        self.size += entry.size
+        while self.size > self.max_bytes and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.size
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.size, "inflight": len(self.inflight)}
+
+
+def field_tree(fields):
+    """'a.b,a.c,d' -> {"a": {"b": {}, "c": {}}, "d": {}}"""
+    tree = {}
+    for field in fields.split(","):
+        node = tree
+        for part in field.strip().split("."):
+            if part:
+                node = node.setdefault(part, {})
+    return tree
+
+
+def trim(value, tree):
+    """Keep only the requested fields of a hit, descending into nested objects and lists."""
+    if isinstance(value, list):
+        return [trim(item, tree) for item in value]
+    if not isinstance(value, dict) or not tree:
+        return value
+    return {key: trim(value[key], subtree) for key, subtree in tree.items() if key in value}
+
+
+def cache_key(endpoint, args):
+    """
+    Normalise the query so equivalent requests share an entry: only known
+    parameters are kept, filters are re-serialised with sorted keys and
+    fields are de-duplicated and sorted.
+    """
+    params = {}
+    for name in PASSTHROUGH_PARAMS:
+        value = args.get(name)
+        if value in (None, ""):
+            continue
+        if name == "filters":
+            value = json.dumps(json.loads(value), sort_keys=True, separators=(",", ":"))
+        elif name == "fields":
+            value = ",".join(sorted({field.strip() for field in value.split(",") if field.strip()}))
+        params[name] = value
+    return endpoint, tuple(sorted(params.items()))
+
+
+def fetch_gdc(key):
+    """Fetch one GDC query as JSON and trim its hits to the requested fields."""
+    endpoint, params = key
+    params = dict(params)
+    url = f"{GDC_API_URL}/{endpoint}?{urllib.parse.urlencode({**params, 'format': 'json'})}"
+    try:
+        with urllib.request.urlopen(url, timeout=FETCH_TIMEOUT) as resp:
+            payload = json.load(resp)
+    except urllib.error.HTTPError as e:
+        if 400 <= e.code < 500:
+            raise UpstreamError(e.code, e.read())
+        raise
+
+    data = payload.get("data", {})
+    if params.get("fields") and isinstance(data.get("hits"), list):
+        tree = field_tree(params["fields"])
+        data["hits"] = [trim(hit, tree) for hit in data["hits"]]
+    trimmed = {"data": data}
+    if payload.get("warnings"):
+        trimmed["warnings"] = payload["warnings"]
+    return CachedResponse(json.dumps(trimmed, separators=(",", ":")).encode())
+
+
+cache = ProxyCache(fetch_gdc)
+
+
+def cached_get(endpoint, args):
+    """
+    Serve a GDC metadata query from the shared cache.
+    Raises ValueError for an unknown endpoint or malformed filters.
+    """
+    if endpoint not in ENDPOINTS:
+        raise ValueError(f"Unknown GDC endpoint {endpoint}")
+    try:
+        key = cache_key(endpoint, args)
+    except json.JSONDecodeError:
+        raise ValueError("filters must be JSON")
+    return cache.get(key)
@@ -0,0 +1,64 @@
+import threading
+from collections import OrderedDict
+import duckdb
+from idc_index import index as idc
+
+MAX_CACHED_STATEMENTS = 256
+
+# One in-memory database holding the idc-index table, shared by every request.
+# Each thread queries it through its own cursor.
+_connection = None
+_connection_lock = threading.Lock()
+_local = threading.local()
+_statements = OrderedDict()
+_statements_lock = threading.Lock()
+
+
+def connection():
+    """Create the shared database from the idc-index table on first use."""
+    global _connection
+    with _connection_lock:
+        if _connection is None:
+            client = idc.IDCClient()
+            con = duckdb.connect()
+            con.register("index_df", client.index)
+            con.execute('CREATE TABLE "index" AS SELECT * FROM index_df')
+            con.unregister("index_df")
+            print(f"Loaded idc-index table with {len(client.index)} series")
+            _connection = con
+        return _connection
+
+
+def _cursor():
+    cursor = getattr(_local, "cursor", None)
+    if cursor is None:
+        cursor = _local.cursor = connection().cursor()
+    return cursor
+
+
+def _statement(sql):
+    """Parse sql once; later calls with the same text reuse the parsed statement."""
+    with _statements_lock:
+        statement = _statements.get(sql)
+        if statement is not None:
+            _statements.move_to_end(sql)
+            return statement
+    statements = duckdb.extract_statements(sql)
+    if len(statements) != 1:
+        raise ValueError("Expected exactly one SQL statement")
+    with _statements_lock:
+        _statements[sql] = statements[0]
+        if len(_statements) > MAX_CACHED_STATEMENTS:
+            _statements.popitem(last=False)
+    return statements[0]
+
+
+def sql_query(sql, params=()):
+    """
+    Run a query against the idc-index table and return a DataFrame.
+
+    Values are never formatted into sql: pass them as $1, $2, ... params.
+    Lists bind as a single LIST parameter (e.g. PatientID = ANY($1)), so the
+    statement text, and its cache entry, do not change with the list length.
+    """
+    return _cursor().execute(_statement(sql), list(params)).df()
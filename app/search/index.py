@@ -1,21 +1,48 @@
-import faiss
-import numpy as np
-import pandas as pd
 import os
-from process import process_file_in_chunks, process_project, save_faiss_index, query_all_projects, MIN_PATIENTS, load_most_recent_save
-import aiohttp, asyncio
-from aiohttp import ClientTimeout, TCPConnector
-from aiohttp.client_exceptions import ClientError
-import backoff 
-@backoff.on_exception(
-    backoff.expo,
-    (ClientError, asyncio.TimeoutError),
-    max_tries=5
-)
-async def main_pipeline(base_dir="downloads"):
-
-    timeout = ClientTimeout(total=300)  # 5 minute timeout
-    connector = TCPConnector(
+import asyncio
+import process
+from process import process_project, save_faiss_index, query_all_projects, MIN_PATIENTS, load_most_recent_save
+from manifest import load_manifest, reconcile_manifest
+from metrics import incr, report_periodically, serve_metrics, start_run, METRICS_PATH, REPORT_INTERVAL
+
+
+def _with_retries(pipeline):
+    """Retry pipeline on connection errors and timeouts with exponential backoff."""
+    import backoff
+    from aiohttp.client_exceptions import ClientError
+    return backoff.on_exception(
+        backoff.expo,
+        (ClientError, asyncio.TimeoutError),
+        max_tries=5,
+        on_backoff=lambda details: incr("retries"),
+    )(pipeline)
+
+
+async def main_pipeline(base_dir="downloads", metrics_path=METRICS_PATH, metrics_port=None):
+    """
+    Index every eligible GDC project.
+    Per-stage metrics are appended to metrics_path every REPORT_INTERVAL
+    seconds and, if metrics_port is set, served as JSON on that local port.
+    """
+    start_run()
+    metrics_port = metrics_port or os.environ.get("INGEST_METRICS_PORT")
+    metrics_server = serve_metrics(int(metrics_port)) if metrics_port else None
+    reporter = asyncio.create_task(report_periodically(metrics_path, REPORT_INTERVAL))
+    try:
+        return await _with_retries(_run_pipeline)(base_dir)
+    finally:
+        reporter.cancel()
+        await asyncio.gather(reporter, return_exceptions=True)
+        if metrics_server is not None:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+
+async def _run_pipeline(base_dir):
+    import aiohttp
+    import pandas as pd
+
+    timeout = aiohttp.ClientTimeout(total=300)  # 5 minute timeout
+    connector = aiohttp.TCPConnector(
         limit=10,  # Limit concurrent connections
         force_close=True,
         enable_cleanup_closed=True
@@ -30,6 +57,9 @@ async def main_pipeline(base_dir="downloads"):
             print("Successfully loaded previous progress")
         else:
             print("Starting fresh processing")
+        # process.caseid_to_index is rebound by load_most_recent_save.
+        load_manifest()
+        reconcile_manifest(process.caseid_to_index)
         projects_df = await query_all_projects()
         if projects_df is None:
             print("No projects found.")
@@ -51,5 +81,5 @@ async def main_pipeline(base_dir="downloads"):
         return successful_results
 
 
-
-asyncio.run(main_pipeline())
\ No newline at end of file
+if __name__ == "__main__":
+    asyncio.run(main_pipeline())
\ No newline at end of file
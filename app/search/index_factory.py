@@ -0,0 +1,188 @@
+import os
+import numpy as np
+from choices import INDEX_TYPES
+
+# Index type used for new indexes; one of INDEX_TYPES.
+INDEX_TYPE = os.environ.get("FAISS_INDEX_TYPE", "flat")
+
+TRAIN_SAMPLE_SIZE = 20000
+NLIST = 1024  # IVF coarse centroids, capped by the training sample size
+MIN_POINTS_PER_CENTROID = 39
+PQ_M = 64  # PQ sub-quantizers, lowered to a divisor of d
+HNSW_M = 32
+NPROBE = 16
+HNSW_EF_SEARCH = 128
+
+
+def normalize_rows(vectors):
+    """
+    L2-normalise vectors row-wise so inner product equals cosine similarity.
+    Accepts a single vector or an (n, d) array; zero rows are left as zeros.
+    """
+    vectors = np.atleast_2d(np.asarray(vectors, dtype="float32"))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return np.ascontiguousarray(vectors / norms, dtype="float32")
+
+
+def factory_string(index_type, d, n_train=None):
+    """Translate an index type into a faiss index_factory description."""
+    n_train = n_train or TRAIN_SAMPLE_SIZE
+    nlist = max(1, min(NLIST, n_train // MIN_POINTS_PER_CENTROID))
+    if index_type == "flat":
+        return "Flat"
+    if index_type == "ivf_flat":
+        return f"IVF{nlist},Flat"
+    if index_type == "ivf_pq":
+        m = max(m for m in range(1, min(PQ_M, d) + 1) if d % m == 0)
+        # 8-bit codes need 256 centroids per sub-quantizer; use fewer bits
+        # when the training sample cannot support that many.
+        nbits = int(np.clip(np.log2(max(n_train / MIN_POINTS_PER_CENTROID, 2)), 1, 8))
+        return f"IVF{nlist},PQ{m}x{nbits}"
+    if index_type == "hnsw":
+        return f"HNSW{HNSW_M},Flat"
+    if index_type == "sq8":
+        return "SQ8"
+    raise ValueError(f"Unknown index type {index_type!r}; expected one of {INDEX_TYPES}")
+
+
+def new_index(d, index_type=None, n_train=None):
+    """
+    Create an empty index for d-dimensional embeddings.
+    Vectors are stored L2-normalised, so the inner-product metric gives
+    cosine similarity directly from a native top-k search.
+
+    Args:
+        d (int): Vector dimension
+        index_type (str): One of INDEX_TYPES; defaults to INDEX_TYPE
+        n_train (int): Expected training sample size, used to size IVF lists
+    """
+    import faiss
+    index_type = index_type or INDEX_TYPE
+    if index_type == "flat":
+        return faiss.IndexFlatIP(d)
+    return faiss.index_factory(d, factory_string(index_type, d, n_train), faiss.METRIC_INNER_PRODUCT)
+
+
+def train_index(index, vectors):
+    """Train index on (at most TRAIN_SAMPLE_SIZE rows of) vectors if it needs it."""
+    if index.is_trained:
+        return
+    vectors = normalize_rows(vectors)
+    if len(vectors) > TRAIN_SAMPLE_SIZE:
+        sample = np.random.default_rng(0).choice(len(vectors), TRAIN_SAMPLE_SIZE, replace=False)
+        vectors = vectors[np.sort(sample)]
+    index.train(vectors)
+
+
+def sample_rows(n_total, size=TRAIN_SAMPLE_SIZE, seed=0):
+    """Sorted random row numbers for a training sample out of n_total rows."""
+    if n_total <= size:
+        return np.arange(n_total)
+    return np.sort(np.random.default_rng(seed).choice(n_total, size, replace=False))
+
+
+def build_index(batches, n_total, index_type=None, train_vectors=None):
+    """
+    Build an index from an iterable of vector batches.
+
+    The dimension is taken from the first batch. If train_vectors is given
+    the index is trained on it up front; otherwise the first TRAIN_SAMPLE_SIZE
+    vectors are buffered and used for training. Vector positions follow the
+    order of the batches either way. Returns None if there were no batches.
+    """
+    index = None
+    buffered = []
+    buffered_rows = 0
+    for batch in batches:
+        batch = normalize_rows(batch)
+        if index is None:
+            index = new_index(batch.shape[1], index_type, min(n_total, TRAIN_SAMPLE_SIZE))
+            if train_vectors is not None:
+                train_index(index, train_vectors)
+        if index.is_trained:
+            index.add(batch)
+            continue
+        buffered.append(batch)
+        buffered_rows += len(batch)
+        if buffered_rows >= min(TRAIN_SAMPLE_SIZE, n_total):
+            pending = np.vstack(buffered)
+            train_index(index, pending)
+            index.add(pending)
+            buffered = []
+    if buffered:
+        pending = np.vstack(buffered)
+        train_index(index, pending)
+        index.add(pending)
+    return index
+
+
+def _ivf(index):
+    import faiss
+    try:
+        return faiss.extract_index_ivf(index)
+    except RuntimeError:
+        return None
+
+
+def write_index(index, path):
+    """
+    Save an index atomically. IVF indexes are saved with their direct map,
+    which reconstruct() needs to fetch an indexed case's vector, so loading
+    does not have to walk every inverted list to rebuild it.
+    """
+    import faiss
+    ivf = _ivf(index)
+    if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+        ivf.make_direct_map()
+    tmp_path = path + ".tmp"
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def prepare_for_search(index):
+    """
+    Set search-time parameters. IVF indexes saved without a direct map
+    (before write_index) get one built here, in time linear in their size.
+    """
+    import faiss
+    ivf = _ivf(index)
+    if ivf is not None:
+        ivf.nprobe = NPROBE
+        if ivf.direct_map.type == faiss.DirectMap.NoMap:
+            print("Building the direct map of an IVF index saved without one; re-save it to skip this")
+            ivf.make_direct_map()
+    hnsw = getattr(faiss.downcast_index(index), "hnsw", None)
+    if hnsw is not None:
+        hnsw.efSearch = HNSW_EF_SEARCH
+    return index
+
+
+def search_parameters(index, selector=None):
+    """
+    Per-query search parameters restricting a search to the ids in selector,
+    carrying the index type's search-time settings. None without a selector.
+    """
+    import faiss
+    if selector is None:
+        return None
+    if _ivf(index) is not None:
+        return faiss.SearchParametersIVF(sel=selector, nprobe=NPROBE)
+    if hasattr(faiss.downcast_index(index), "hnsw"):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=HNSW_EF_SEARCH)
+    return faiss.SearchParameters(sel=selector)
+
+
+def to_cosine_index(index):
+    """
+    Return an inner-product index over L2-normalised copies of index's vectors.
+    Indexes that already use the inner-product metric are returned unchanged,
+    so the conversion cost is only paid once for legacy L2 indexes.
+    """
+    import faiss
+    if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        return index
+    cosine_index = faiss.IndexFlatIP(index.d)
+    if index.ntotal:
+        cosine_index.add(normalize_rows(index.reconstruct_n(0, index.ntotal)))
+    return cosine_index
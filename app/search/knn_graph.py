@@ -0,0 +1,172 @@
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from mapping import binary_mapping_prefix
+from search import load_faiss
+from segments import atomic_write
+
+GRAPH_K = 20
+# Blocks are sized in bytes from the vector dimension: one database block is
+# resident at a time, and each worker holds a query block and its scores.
+DB_BLOCK_BYTES = 512 * 1024 * 1024
+QUERY_BLOCK_BYTES = 32 * 1024 * 1024
+
+
+def graph_paths(mapping_path):
+    """case_mapping.json -> (case_mapping.knn_ids.npy, case_mapping.knn_scores.npy)"""
+    prefix = binary_mapping_prefix(mapping_path)
+    return f"{prefix}.knn_ids.npy", f"{prefix}.knn_scores.npy"
+
+
+def block_rows(d, db_block_bytes=DB_BLOCK_BYTES, query_block_bytes=QUERY_BLOCK_BYTES):
+    """Rows per (database block, query block) for float32 vectors of dimension d."""
+    db_rows = max(1, db_block_bytes // (4 * d))
+    # A query block holds its own vectors and its scores against a database block.
+    query_rows = max(1, query_block_bytes // (4 * (d + db_rows)))
+    return db_rows, query_rows
+
+
+def _merge_top_k(best_scores, best_ids, scores, ids, k):
+    """Merge a block of candidate scores into the running per-row top-k."""
+    scores = np.hstack([best_scores, scores])
+    ids = np.hstack([best_ids, ids])
+    if scores.shape[1] > k:
+        keep = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, keep, axis=1)
+        ids = np.take_along_axis(ids, keep, axis=1)
+    return scores, ids
+
+
+def _query_block(load_block, valid, db, db_start, best_scores, best_ids, start, count, k):
+    """Merge the neighbours of rows [start, start + count) in one database block into their top-k."""
+    queries = load_block(start, count)
+    db_count = len(db)
+    rows = np.arange(count)
+    scores = queries @ db.T
+    scores[:, ~valid[db_start:db_start + db_count]] = -np.inf
+    # A case is not its own neighbour.
+    own = rows + start - db_start
+    inside = (own >= 0) & (own < db_count)
+    scores[rows[inside], own[inside]] = -np.inf
+
+    block_k = min(k, db_count)
+    top = np.argpartition(-scores, block_k - 1, axis=1)[:, :block_k]
+    # Each query block owns its rows of the running top-k, so workers never overlap.
+    best_scores[start:start + count], best_ids[start:start + count] = _merge_top_k(
+        best_scores[start:start + count], best_ids[start:start + count],
+        np.take_along_axis(scores, top, axis=1), top + db_start, k,
+    )
+
+
+def compute_knn_graph(load_block, ntotal, d, valid=None, k=GRAPH_K, db_block_bytes=DB_BLOCK_BYTES,
+                      query_block_bytes=QUERY_BLOCK_BYTES, workers=None):
+    """
+    Compute the exact top-k inner-product neighbours of every vector.
+
+    The outer loop walks database blocks, so each is loaded once; every query
+    block is then scored against it as a matrix product in a thread pool (the
+    BLAS products release the GIL) and merged into a running top-k. Memory is
+    bounded by db_block_bytes + workers * query_block_bytes, plus the
+    (ntotal, k) result, regardless of ntotal.
+
+    Args:
+        load_block (callable): load_block(start, count) -> (count, d) float32 vectors
+        ntotal (int): Number of vectors
+        d (int): Vector dimension, used to size the blocks
+        valid (np.ndarray): Optional bool mask of positions that may be returned
+        k (int): Neighbours per vector
+
+    Returns:
+        tuple: (ids int32 (ntotal, k), scores float16 (ntotal, k)); rows
+            with fewer than k neighbours are padded with id -1
+    """
+    if valid is None:
+        valid = np.ones(ntotal, dtype=bool)
+    db_rows, query_rows = block_rows(d, db_block_bytes, query_block_bytes)
+    best_scores = np.full((ntotal, k), -np.inf, dtype="float32")
+    best_ids = np.full((ntotal, k), -1, dtype="int64")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for db_start in range(0, ntotal, db_rows):
+            db = load_block(db_start, min(db_rows, ntotal - db_start))
+            futures = [
+                executor.submit(_query_block, load_block, valid, db, db_start, best_scores, best_ids,
+                                start, min(query_rows, ntotal - start), k)
+                for start in range(0, ntotal, query_rows)
+            ]
+            for future in futures:
+                future.result()
+
+    order = np.argsort(-best_scores, axis=1)
+    scores = np.take_along_axis(best_scores, order, axis=1)
+    ids = np.take_along_axis(best_ids, order, axis=1).astype("int32")
+    ids[~np.isfinite(scores)] = -1
+    return ids, scores.astype("float16")
+
+
+def build_knn_graph(index_path="faiss_index.bin", mapping_path="case_mapping.json", k=GRAPH_K,
+                    db_block_bytes=DB_BLOCK_BYTES, query_block_bytes=QUERY_BLOCK_BYTES, workers=None):
+    """Compute the neighbour table for an index and save it next to its mapping."""
+    index, mapping = load_faiss(index_path, mapping_path, mmap=True)
+    if index is None:
+        return False
+
+    valid = np.zeros(index.ntotal, dtype=bool)
+    positions = np.fromiter(mapping.values(), dtype="int64", count=len(mapping))
+    valid[positions[(positions >= 0) & (positions < index.ntotal)]] = True
+
+    def load_block(start, count):
+        return index.reconstruct_n(start, count)
+
+    started = time.perf_counter()
+    ids, scores = compute_knn_graph(load_block, index.ntotal, index.d, valid, k, db_block_bytes,
+                                    query_block_bytes, workers)
+    ids_path, scores_path = graph_paths(mapping_path)
+    atomic_write(scores_path, lambda f: np.save(f, scores))
+    # The ids file is written last, so a complete graph always has both.
+    atomic_write(ids_path, lambda f: np.save(f, ids))
+    print(f"Computed top-{k} neighbours for {index.ntotal} vectors "
+          f"in {time.perf_counter() - started:.1f}s -> {ids_path}")
+    return True
+
+
+def load_knn_graph(mapping_path, index_path, ntotal):
+    """
+    Memory-map the neighbour table for an index.
+
+    Returns:
+        tuple: (ids, scores) arrays, or None if there is no graph or it is
+            older than the index or was built for a different number of vectors
+    """
+    ids_path, scores_path = graph_paths(mapping_path)
+    if not (os.path.exists(ids_path) and os.path.exists(scores_path)):
+        return None
+    if os.path.getmtime(ids_path) < os.path.getmtime(index_path):
+        print(f"Ignoring neighbour graph {ids_path}: older than {index_path}")
+        return None
+    ids = np.load(ids_path, mmap_mode='r')
+    scores = np.load(scores_path, mmap_mode='r')
+    if len(ids) != ntotal or ids.shape != scores.shape:
+        print(f"Ignoring neighbour graph {ids_path}: built for {len(ids)} vectors, index has {ntotal}")
+        return None
+    print(f"Memory-mapped top-{ids.shape[1]} neighbour graph")
+    return ids, scores
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Precompute the top-k neighbours of every indexed case."
+    )
+    parser.add_argument("--index", default="faiss_index.bin")
+    parser.add_argument("--mapping", default="case_mapping.json")
+    parser.add_argument("-k", type=int, default=GRAPH_K)
+    parser.add_argument("--db-block-mb", type=int, default=DB_BLOCK_BYTES // 2**20,
+                        help="Memory for the database block loaded at a time")
+    parser.add_argument("--query-block-mb", type=int, default=QUERY_BLOCK_BYTES // 2**20,
+                        help="Memory per worker for a query block and its scores")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    build_knn_graph(args.index, args.mapping, args.k, args.db_block_mb * 2**20, args.query_block_mb * 2**20,
+                    args.workers)
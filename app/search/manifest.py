@@ -0,0 +1,107 @@
+import json
+import os
+from datetime import datetime
+
+MANIFEST_PATH = "ingest_manifest.jsonl"
+MAX_RETRIES = 3
+
+# Per-case ingestion states, in pipeline order.
+PENDING = "pending"
+DOWNLOADED = "downloaded"
+EMBEDDED = "embedded"
+INDEXED = "indexed"
+FAILED = "failed"
+
+# Latest record for every case seen so far, keyed by case_id.
+case_states = {}
+manifest_path = MANIFEST_PATH
+
+
+def load_manifest(path=MANIFEST_PATH):
+    """
+    Replay the manifest log so every case maps to its most recent record.
+    The log is compacted afterwards so it holds one line per case.
+    """
+    global case_states, manifest_path
+    manifest_path = path
+    case_states = {}
+
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn last line from an interrupted write; the case
+                    # simply falls back to its previous state.
+                    continue
+                case_states[record["case_id"]] = record
+        compact_manifest()
+
+    print(f"Loaded manifest with {len(case_states)} cases from {path}")
+    return case_states
+
+
+def compact_manifest():
+    """Rewrite the manifest log with only the latest record per case."""
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        for record in case_states.values():
+            f.write(json.dumps(record) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, manifest_path)
+
+
+def update_case(case_id, state, **fields):
+    """
+    Record a state transition for a case and append it to the manifest log.
+    Failed transitions increment the case's attempt counter.
+    """
+    previous = case_states.get(case_id, {})
+    record = {**previous, **fields}
+    record["case_id"] = case_id
+    record["state"] = state
+    record["updated"] = datetime.now().isoformat(timespec="seconds")
+    if state == FAILED:
+        record["attempts"] = previous.get("attempts", 0) + 1
+
+    case_states[case_id] = record
+    with open(manifest_path, 'a') as f:
+        f.write(json.dumps(record) + "\n")
+    return record
+
+
+def reconcile_manifest(indexed_cases):
+    """
+    Align the manifest with the index restored from the latest checkpoint.
+
+    Cases marked indexed after the last checkpoint were lost with the process
+    and go back to pending; cases present in the checkpoint but missing from
+    the manifest (older runs) are marked indexed.
+    """
+    lost = 0
+    for case_id, record in list(case_states.items()):
+        if record["state"] == INDEXED and case_id not in indexed_cases:
+            update_case(case_id, PENDING)
+            lost += 1
+
+    adopted = 0
+    for case_id in indexed_cases:
+        record = case_states.get(case_id)
+        if record is None or record["state"] != INDEXED:
+            update_case(case_id, INDEXED)
+            adopted += 1
+
+    print(f"Manifest reconciled: {adopted} cases adopted from checkpoint, "
+          f"{lost} cases to redo")
+
+
+def should_process(case_id, indexed_cases, max_retries=MAX_RETRIES):
+    """Return True if the case still has outstanding work and retries left."""
+    if case_id in indexed_cases:
+        return False
+    record = case_states.get(case_id)
+    if record is not None and record["state"] == FAILED:
+        return record.get("attempts", 0) < max_retries
+    return True
@@ -0,0 +1,100 @@
+import json
+import os
+from collections.abc import Mapping
+import numpy as np
+from segments import atomic_write
+
+
+def binary_mapping_prefix(mapping_path):
+    """case_mapping.json -> case_mapping; the binary files sit next to the JSON."""
+    return os.path.splitext(mapping_path)[0]
+
+
+def write_binary_mapping(case_mapping, ntotal, prefix):
+    """
+    Write a compact, mmap-able form of a case_id -> position mapping.
+
+    Files:
+        <prefix>.ids.npy  sorted case_ids as fixed-width bytes
+        <prefix>.pos.npy  index position of each sorted case_id
+        <prefix>.rev.npy  rank in the sorted ids for every index position (-1 if none)
+    """
+    case_ids = sorted(case_mapping)
+    ids = np.array([case_id.encode() for case_id in case_ids], dtype=f"S{max(map(len, case_ids), default=1)}")
+    positions = np.array([case_mapping[case_id] for case_id in case_ids], dtype="int64")
+    reverse = np.full(ntotal, -1, dtype="int64")
+    in_range = (positions >= 0) & (positions < ntotal)
+    reverse[positions[in_range]] = np.nonzero(in_range)[0]
+
+    for suffix, array in (("ids", ids), ("pos", positions), ("rev", reverse)):
+        atomic_write(f"{prefix}.{suffix}.npy", lambda f, array=array: np.save(f, array))
+
+
+def save_mapping(case_mapping, mapping_path, ntotal):
+    """Save a mapping as JSON plus its binary form for memory-mapped loading."""
+    atomic_write(mapping_path, lambda f: f.write(json.dumps(case_mapping).encode()))
+    write_binary_mapping(case_mapping, ntotal, binary_mapping_prefix(mapping_path))
+
+
+def has_binary_mapping(mapping_path):
+    prefix = binary_mapping_prefix(mapping_path)
+    return all(os.path.exists(f"{prefix}.{suffix}.npy") for suffix in ("ids", "pos", "rev"))
+
+
+class CaseMapping(Mapping):
+    """
+    Read-only case_id -> index position mapping over memory-mapped arrays.
+    Lookups are binary searches, so nothing is parsed at load time and the
+    pages are shared between processes through the page cache.
+    """
+
+    def __init__(self, prefix):
+        self.ids = np.load(f"{prefix}.ids.npy", mmap_mode='r')
+        self.positions = np.load(f"{prefix}.pos.npy", mmap_mode='r')
+        self.ranks = np.load(f"{prefix}.rev.npy", mmap_mode='r')
+
+    def _rank(self, case_id):
+        if not isinstance(case_id, str):
+            return -1
+        key = case_id.encode()
+        if len(key) > self.ids.dtype.itemsize:
+            return -1
+        rank = int(np.searchsorted(self.ids, key))
+        if rank < len(self.ids) and self.ids[rank] == key:
+            return rank
+        return -1
+
+    def __getitem__(self, case_id):
+        rank = self._rank(case_id)
+        if rank < 0:
+            raise KeyError(case_id)
+        return int(self.positions[rank])
+
+    def __contains__(self, case_id):
+        return self._rank(case_id) >= 0
+
+    def __iter__(self):
+        return (case_id.decode() for case_id in self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def reverse(self):
+        """Sequence view mapping index positions back to case_ids."""
+        return ReverseCaseMapping(self)
+
+
+class ReverseCaseMapping:
+    """Index position -> case_id view of a CaseMapping (None for unmapped positions)."""
+
+    def __init__(self, case_mapping):
+        self.case_mapping = case_mapping
+
+    def __len__(self):
+        return len(self.case_mapping.ranks)
+
+    def __getitem__(self, idx):
+        rank = self.case_mapping.ranks[idx]
+        if rank < 0:
+            return None
+        return self.case_mapping.ids[rank].decode()
@@ -0,0 +1,115 @@
+import json
+import os
+import threading
+import numpy as np
+from choices import METADATA_FIELDS
+from mapping import binary_mapping_prefix
+from segments import atomic_write
+
+MAX_CACHED_SELECTORS = 256
+
+
+def sidecar_path(mapping_path):
+    """case_mapping.json -> case_mapping.meta.json"""
+    return binary_mapping_prefix(mapping_path) + ".meta.json"
+
+
+def save_sidecar(case_metadata, mapping_path, case_ids=None):
+    """
+    Save per-case metadata next to a mapping, keyed by case_id so it stays
+    valid when the same cases are re-embedded at different positions.
+    Only cases in case_ids (e.g. the mapping) are kept when it is given.
+    """
+    if case_ids is not None:
+        case_metadata = {case_id: case_metadata[case_id] for case_id in case_ids if case_id in case_metadata}
+    atomic_write(sidecar_path(mapping_path), lambda f: f.write(json.dumps(case_metadata).encode()))
+
+
+def load_sidecar(mapping_path, case_mapping):
+    """
+    Load the metadata sidecar for a mapping.
+
+    Returns:
+        dict: {"cases", "mapping", "postings", "selectors", "lock"} or None if
+            there is no sidecar. Postings are built on first filtered search.
+    """
+    path = sidecar_path(mapping_path)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        cases = json.load(f)
+    print(f"Loaded metadata for {len(cases)} cases")
+    return {
+        "cases": cases,
+        "mapping": case_mapping,
+        "postings": None,
+        "selectors": {},
+        "lock": threading.Lock(),
+    }
+
+
+def _build_postings(sidecar):
+    """field -> value -> sorted index positions of the cases with that value."""
+    postings = {field: {} for field in METADATA_FIELDS}
+    case_mapping = sidecar["mapping"]
+    for case_id, fields in sidecar["cases"].items():
+        if case_id not in case_mapping:
+            continue
+        position = case_mapping[case_id]
+        for field in METADATA_FIELDS:
+            value = fields.get(field)
+            if value is not None:
+                postings[field].setdefault(value, []).append(position)
+    return {
+        field: {value: np.array(sorted(positions), dtype="int64") for value, positions in values.items()}
+        for field, values in postings.items()
+    }
+
+
+def case_fields(sidecar, case_id):
+    """Metadata recorded for one case, or an empty dict."""
+    if sidecar is None:
+        return {}
+    return sidecar["cases"].get(case_id, {})
+
+
+def filter_selector(sidecar, filters, ntotal):
+    """
+    Build (and cache) a faiss ID selector for metadata filters.
+
+    Args:
+        filters (dict): field -> list of accepted values. Values of one
+            field are OR-ed, different fields are AND-ed.
+        ntotal (int): Number of vectors in the index
+
+    Returns:
+        faiss.IDSelectorBitmap restricting the search to matching positions
+    """
+    import faiss
+    key = tuple(sorted((field, tuple(sorted(values))) for field, values in filters.items()))
+    with sidecar["lock"]:
+        cached = sidecar["selectors"].get(key)
+        if cached is not None:
+            return cached
+        if sidecar["postings"] is None:
+            sidecar["postings"] = _build_postings(sidecar)
+
+        mask = np.ones(ntotal, dtype=bool)
+        for field, values in filters.items():
+            field_mask = np.zeros(ntotal, dtype=bool)
+            for value in values:
+                positions = sidecar["postings"][field].get(value)
+                if positions is not None:
+                    field_mask[positions[positions < ntotal]] = True
+            mask &= field_mask
+
+        # The selector only holds a raw pointer into the bitmap; attaching the
+        # array keeps it alive for as long as anyone still searches with the
+        # selector, including after it is evicted from the cache.
+        bitmap = np.packbits(mask, bitorder='little')
+        selector = faiss.IDSelectorBitmap(ntotal, faiss.swig_ptr(bitmap))
+        selector.bitmap_ref = bitmap
+        if len(sidecar["selectors"]) >= MAX_CACHED_SELECTORS:
+            sidecar["selectors"].pop(next(iter(sidecar["selectors"])))
+        sidecar["selectors"][key] = selector
+        return selector
@@ -0,0 +1,172 @@
+import asyncio
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PATH = "ingest_metrics.jsonl"
+REPORT_INTERVAL = 30  # seconds
+# Histogram bucket upper bounds in milliseconds; the last bucket is unbounded.
+BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+counters = {}
+gauges = {}
+histograms = {}
+metrics_lock = threading.Lock()
+# Start of the run that rates are measured over; reset by start_run().
+started_at = time.time()
+# Counter values at the previous report, for per-interval rates.
+_last_report = {"time": started_at, "counters": {}}
+
+
+def start_run():
+    """
+    Start measuring a run: rates are taken from now rather than from import,
+    and counters and histograms start from zero. Gauges keep their values.
+    """
+    global started_at
+    with metrics_lock:
+        counters.clear()
+        histograms.clear()
+        started_at = time.time()
+        _last_report["time"] = started_at
+        _last_report["counters"] = {}
+
+
+def incr(name, value=1):
+    """Increase a monotonically growing counter."""
+    with metrics_lock:
+        counters[name] = counters.get(name, 0) + value
+
+
+def set_gauge(name, value):
+    with metrics_lock:
+        gauges[name] = value
+
+
+def add_gauge(name, delta):
+    """Adjust a gauge by delta, e.g. +1/-1 around a queue."""
+    with metrics_lock:
+        gauges[name] = gauges.get(name, 0) + delta
+
+
+def observe_ms(name, ms):
+    """Record one duration in milliseconds into a histogram."""
+    with metrics_lock:
+        hist = histograms.get(name)
+        if hist is None:
+            hist = histograms[name] = {
+                "count": 0, "sum_ms": 0.0, "max_ms": 0.0,
+                "buckets": [0] * (len(BUCKETS_MS) + 1),
+            }
+        hist["count"] += 1
+        hist["sum_ms"] += ms
+        hist["max_ms"] = max(hist["max_ms"], ms)
+        for i, bound in enumerate(BUCKETS_MS):
+            if ms <= bound:
+                hist["buckets"][i] += 1
+                break
+        else:
+            hist["buckets"][-1] += 1
+
+
+@contextmanager
+def timed(name):
+    """Time the enclosed block into the `name` histogram."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_ms(name, (time.perf_counter() - start) * 1000)
+
+
+def _quantile(hist, q):
+    """Approximate a quantile as the upper bound of the bucket containing it."""
+    target = q * hist["count"]
+    seen = 0
+    for i, count in enumerate(hist["buckets"]):
+        seen += count
+        if seen >= target and count:
+            return min(BUCKETS_MS[i], hist["max_ms"]) if i < len(BUCKETS_MS) else hist["max_ms"]
+    return 0.0
+
+
+def snapshot(interval_rates=False):
+    """
+    Return the current metrics as a JSON-serialisable dict.
+    Rates are per second over the whole run, and over the interval since the
+    previous snapshot when interval_rates is True.
+    """
+    now = time.time()
+    with metrics_lock:
+        elapsed = max(now - started_at, 1e-9)
+        current = dict(counters)
+        result = {
+            "time": now,
+            "elapsed_s": round(elapsed, 3),
+            "counters": current,
+            "gauges": dict(gauges),
+            "rates": {name: value / elapsed for name, value in current.items()},
+            "histograms": {
+                name: {
+                    "count": hist["count"],
+                    "mean_ms": hist["sum_ms"] / hist["count"] if hist["count"] else 0.0,
+                    "p50_ms": _quantile(hist, 0.5),
+                    "p95_ms": _quantile(hist, 0.95),
+                    "max_ms": hist["max_ms"],
+                    "buckets": dict(zip([str(b) for b in BUCKETS_MS] + ["inf"], hist["buckets"])),
+                }
+                for name, hist in histograms.items()
+            },
+        }
+        if interval_rates:
+            window = max(now - _last_report["time"], 1e-9)
+            previous = _last_report["counters"]
+            result["interval_rates"] = {
+                name: (value - previous.get(name, 0)) / window
+                for name, value in current.items()
+            }
+            _last_report["time"] = now
+            _last_report["counters"] = current
+
+    result["rates"]["download_mb"] = result["rates"].get("download_bytes", 0) / 1e6
+    return result
+
+
+def write_report(path=METRICS_PATH):
+    """Append one snapshot as a JSON line."""
+    with open(path, 'a') as f:
+        f.write(json.dumps(snapshot(interval_rates=True)) + "\n")
+
+
+async def report_periodically(path=METRICS_PATH, interval=REPORT_INTERVAL):
+    """Write a snapshot every `interval` seconds until cancelled."""
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            write_report(path)
+    finally:
+        write_report(path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps(snapshot()).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port, host="127.0.0.1"):
+    """Serve the current snapshot as JSON on a local port from a daemon thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    print(f"Serving ingestion metrics on http://{host}:{port}/")
+    return server
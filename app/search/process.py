@@ -1,152 +1,179 @@
 import numpy as np
-import pandas as pd
 import os
-import faiss
-import aiohttp
-import aiofiles
 import asyncio
 import shutil
 import gc
+import time
 from datetime import datetime   
 import glob
 import json
-from query import query_all_projects, query_patients_by_project, query_gdc
+import re
+from query import GDC_API_URL, query_all_projects, query_patients_by_project, query_gdc
+from manifest import update_case, should_process, DOWNLOADED, EMBEDDED, INDEXED, FAILED, PENDING
+from counts_store import COUNTS_DIR, append_counts
+from mapping import save_mapping
+from metadata import METADATA_FIELDS, save_sidecar, sidecar_path
+from embedding import REDUCER_PATH, embed_counts, load_reducer, reducer_id
+from star_counts import process_file_in_chunks, compute_embedding
+from bulk_download import iter_archive
+from download import DownloadError, download_file
+from metrics import incr, add_gauge, timed
+from index_factory import new_index, normalize_rows, to_cosine_index, build_index, train_index, sample_rows, write_index, TRAIN_SAMPLE_SIZE
+from segments import CHECKPOINT_DIR, write_segment, iter_segments, list_segments, save_reference_genes, load_reference_genes
+from reembed import reseed_segments
 
 MIN_PATIENTS = 20
 SAVE_FREQUENCY = 2500
+# Pacing of GDC requests: cases processed at once per project, the delay
+# before each case and the delay after its metadata query.
+CASE_CONCURRENCY = int(os.environ.get("INGEST_CASE_CONCURRENCY", "1"))
+CASE_DELAY = float(os.environ.get("INGEST_CASE_DELAY", "3"))
+PATIENT_DELAY = float(os.environ.get("INGEST_PATIENT_DELAY", "0.8"))
+# Files fetched per POST /data archive request; 0 or 1 downloads one file per request.
+BULK_GROUP_SIZE = int(os.environ.get("INGEST_BULK_GROUP_SIZE", "0"))
 # Global FAISS index variables and a lock for safe updates.
 faiss_index = None
 caseid_to_index = {}  # Maps case_id to index position in FAISS
+case_metadata = {}  # Maps case_id to its project_id, primary_site and submitter_id
 index_lock = asyncio.Lock()
+# Serialises segment writes so they land on disk in index order.
+segment_lock = asyncio.Lock()
 reference_genes = None
-def process_file_in_chunks(filepath, chunk_size=10000):
-    """
-    Process a large gene counts TSV file in chunks.
-    Returns a DataFrame of processed gene counts.
-    """
-    try:
-        chunks = []
-        processed_rows = 0
-
-        # Count total rows (subtract 2 for headers)
-        with open(filepath) as f:
-            total_rows = sum(1 for _ in f) - 2
-
-        print(f"Processing {filepath}")
-        print(f"Total rows to process: {total_rows:,}")
+# Optional fitted normalisation + projection (see embedding.py), loaded with the index.
+embedding_reducer = None
+# Vectors and case_ids added since the last segment was written.
+pending_vectors = []
+pending_case_ids = []
+# Vectors held back until an index type that needs training has enough of them.
+untrained_vectors = []
 
-        special_rows = ['N_unmapped', 'N_multimapping', 'N_noFeature', 'N_ambiguous']
 
-        for chunk_num, chunk in enumerate(
-            pd.read_csv(filepath, sep='\t', header=1, chunksize=chunk_size)
-        ):
-            try:
-                chunk = chunk.set_index(chunk.columns[0])
-                if 'unstranded' not in chunk.columns:
-                    raise ValueError(f"No 'unstranded' column found in chunk {chunk_num}")
-
-                processed_chunk = (
-                    chunk[['unstranded']]
-                    .loc[~chunk.index.isin(special_rows)]
-                    .apply(pd.to_numeric, errors='coerce')
-                    .dropna()
-                    .loc[lambda x: x['unstranded'] != 0]
-                )
-                if not processed_chunk.empty:
-                    chunks.append(processed_chunk)
-
-                processed_rows += len(chunk)
-                progress = (processed_rows / total_rows) * 100
-                print(f"\rProgress: {progress:.1f}% ({processed_rows:,}/{total_rows:,} rows)", end="")
-            except Exception as e:
-                print(f"\nError processing chunk {chunk_num}: {e}")
-                continue
-
-        print("\nCombining chunks...")
-        final_df = pd.concat(chunks) if chunks else pd.DataFrame()
-        gc.collect()
-        chunks.clear()
-        gc.collect()
-        print(f"Final dataset shape: {final_df.shape}")
-        return final_df
+last_save_count = 0
+# Seconds to wait before retrying a failed segment write; the vectors stay pending.
+SEGMENT_RETRY_DELAY = 30
+segment_retry_at = 0.0
 
-    except Exception as e:
-        print(f"Failed to process file {filepath}: {e}")
+def take_pending_segment():
+    """
+    Snapshot the vectors added since the last segment, leaving them pending
+    until commit_pending_segment confirms the segment is on disk.
+    Must be called while holding index_lock (or outside the event loop).
+    Returns (vectors, case_ids, start, metadata) or None if nothing is pending.
+    """
+    if not pending_case_ids:
         return None
+    case_ids = list(pending_case_ids)
+    metadata = [case_metadata.get(case_id, {}) for case_id in case_ids]
+    return (np.stack(pending_vectors[:len(case_ids)]), case_ids, last_save_count, metadata,
+            reducer_id(embedding_reducer))
 
+def commit_pending_segment(count):
+    """
+    Drop the first count pending vectors once their segment has been written.
+    Must be called while holding index_lock (or outside the event loop).
+    """
+    global last_save_count
+    del pending_vectors[:count]
+    del pending_case_ids[:count]
+    last_save_count += count
 
-def compute_embedding(processed_data, reference_genes=None):
+def write_pending_segment(segment):
     """
-    Compute an embedding vector from the processed data.
-    Here we simply convert the 'unstranded' column values to a float32 numpy array.
+    Write a snapshot from take_pending_segment. A failed write is reported
+    and the vectors stay pending, to be retried after SEGMENT_RETRY_DELAY.
+    Returns True if the segment was written.
     """
+    global segment_retry_at
     try:
-        if reference_genes is not None:
-            # Align to reference, filling missing genes with 0.
-            processed_data = processed_data.reindex(reference_genes, fill_value=0)
-        return processed_data['unstranded'].values.astype("float32")
+        write_segment(*segment)
+        return True
     except Exception as e:
-        print(f"Error computing embedding: {e}")
-        return None
+        incr("segment_write_errors")
+        segment_retry_at = time.monotonic() + SEGMENT_RETRY_DELAY
+        print(f"Error writing segment at {segment[2]}, retrying in {SEGMENT_RETRY_DELAY}s: {e}")
+        return False
 
-
-last_save_count = 0
+async def flush_pending_segment():
+    """Write the pending vectors as a segment unless another write is under way."""
+    async with segment_lock:
+        async with index_lock:
+            segment = take_pending_segment()
+        if segment is None:
+            return
+        with timed("segment_write"):
+            written = await asyncio.to_thread(write_pending_segment, segment)
+        if written:
+            async with index_lock:
+                commit_pending_segment(len(segment[1]))
 
 async def add_embedding(case_id, embedding):
     """
     Add the computed embedding to the global FAISS index in a thread-safe manner.
-    Save progress every SAVE_FREQUENCY entries.
+    The embedding is L2-normalised once here so the index serves cosine search.
+    Index types that need training buffer the first TRAIN_SAMPLE_SIZE vectors
+    and train on them before adding.
+    Every SAVE_FREQUENCY entries the new vectors are appended as a segment.
     """
-    global faiss_index, caseid_to_index, last_save_count
+    global faiss_index, caseid_to_index
+    flush = False
+    vector = normalize_rows(embedding)
     async with index_lock:
         if faiss_index is None:
             d = len(embedding)
-            faiss_index = faiss.IndexFlatL2(d)
+            faiss_index = new_index(d)
             print(f"Initialized FAISS index with dimension {d}")
         
-        faiss_index.add(np.expand_dims(embedding, axis=0))
-        current_idx = faiss_index.ntotal - 1
+        current_idx = faiss_index.ntotal + len(untrained_vectors)
+        with timed("index_insert"):
+            if faiss_index.is_trained:
+                faiss_index.add(vector)
+            else:
+                untrained_vectors.append(vector[0])
+                if len(untrained_vectors) >= TRAIN_SAMPLE_SIZE:
+                    train_pending_index()
         caseid_to_index[case_id] = current_idx
-        print(f"Added embedding for case {case_id} at index {current_idx}")
+        pending_vectors.append(vector[0])
+        pending_case_ids.append(case_id)
+        incr("cases_indexed")
 
-        # Check if we need to save progress
-        if current_idx - last_save_count >= SAVE_FREQUENCY:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            index_path = f"faiss_index_{timestamp}.bin"
-            mapping_path = f"case_mapping_{timestamp}.json"
-            
-            # Save the current state
-            save_faiss_index(index_path, mapping_path)
-            last_save_count = current_idx
-            
-            # Cleanup old saves (keep last 3)
-            cleanup_old_saves()
+        flush = (len(pending_case_ids) >= SAVE_FREQUENCY and not segment_lock.locked()
+                 and time.monotonic() >= segment_retry_at)
 
-def cleanup_old_saves(keep_last=3):
-    """Clean up old save files, keeping only the most recent ones."""
-    import glob
-    
-    # List all save files
-    index_files = sorted(glob.glob("faiss_index_*.bin"))
-    mapping_files = sorted(glob.glob("case_mapping_*.json"))
-    
-    # Remove old files, keeping the specified number of recent files
-    for files in [index_files, mapping_files]:
-        if len(files) > keep_last:
-            for old_file in files[:-keep_last]:
-                try:
-                    os.remove(old_file)
-                    print(f"Cleaned up old save file: {old_file}")
-                except Exception as e:
-                    print(f"Error cleaning up {old_file}: {e}")
+    # Write outside index_lock so ingestion keeps adding vectors meanwhile.
+    if flush:
+        await flush_pending_segment()
+
+def train_pending_index():
+    """
+    Train the index on the buffered vectors and add them.
+    With fewer vectors than TRAIN_SAMPLE_SIZE the index is re-created and
+    sized for the smaller sample first.
+    """
+    global faiss_index, untrained_vectors
+    if faiss_index is None or faiss_index.is_trained or not untrained_vectors:
+        return
+    vectors = np.stack(untrained_vectors)
+    if len(vectors) < TRAIN_SAMPLE_SIZE:
+        faiss_index = new_index(vectors.shape[1], n_train=len(vectors))
+    train_index(faiss_index, vectors)
+    faiss_index.add(vectors)
+    untrained_vectors = []
+    print(f"Trained FAISS index on {len(vectors)} vectors")
 
 def save_faiss_index(index_path="faiss_index.bin", mapping_path="case_mapping.json"):
-    """Save the FAISS index and case ID mapping to disk"""
+    """
+    Save the full FAISS index and case ID mapping to disk.
+    Any vectors not yet in a segment are flushed as a final segment first.
+    """
     if faiss_index is not None:
         try:
-            faiss.write_index(faiss_index, index_path)
-            with open(mapping_path, 'w') as f:
-                json.dump(caseid_to_index, f)
+            train_pending_index()
+            segment = take_pending_segment()
+            if segment is not None and write_pending_segment(segment):
+                commit_pending_segment(len(segment[1]))
+            write_index(faiss_index, index_path)
+            save_mapping(caseid_to_index, mapping_path, faiss_index.ntotal)
+            save_sidecar(case_metadata, mapping_path, caseid_to_index)
             print(f"Saved index with {faiss_index.ntotal} vectors to {index_path}")
             # Force garbage collection after saving
             gc.collect()
@@ -156,95 +183,297 @@ def save_faiss_index(index_path="faiss_index.bin", mapping_path="case_mapping.js
 async def download_and_process_file(session, file_meta, base_dir="downloads"):
     """
     Download the file, process it, compute its embedding, and add it to the FAISS index.
+    Interrupted downloads resume and are checked against the file's md5 (see download.py).
     """
     patient_dir = os.path.join(base_dir, file_meta["case_id"])
     os.makedirs(patient_dir, exist_ok=True)
     filepath = os.path.join(patient_dir, file_meta["file_name"])
 
-    url = f'https://api.gdc.cancer.gov/data/{file_meta["file_id"]}'
-    async with session.get(url, timeout=aiohttp.ClientTimeout(total=300)) as resp:
-        if resp.status == 200:
-            async with aiofiles.open(filepath, "wb") as f:
-                while chunk := await resp.content.read(8192):
-                    await f.write(chunk)
-            print(f"Downloaded: {filepath}")
-        else:
-            print(f"Failed to download {file_meta['file_id']}: {resp.status}")
-            return None
+    case_id = file_meta["case_id"]
+    url = f'{GDC_API_URL}/data/{file_meta["file_id"]}'
+    try:
+        with timed("download"):
+            await download_file(session, url, filepath, file_meta.get("md5sum"))
+    except DownloadError as e:
+        incr("download_errors")
+        print(f"Failed to download {file_meta['file_id']}: {e}")
+        update_case(case_id, FAILED, error=f"download failed: {e}")
+        return None
+    incr("downloads")
+    update_case(case_id, DOWNLOADED)
 
     # Offload the synchronous file processing to a thread.
-    processed_data = await asyncio.to_thread(process_file_in_chunks, filepath)
+    with timed("parse"):
+        processed_data = await asyncio.to_thread(process_file_in_chunks, filepath)
+    try:
+        return await embed_and_index(case_id, processed_data, filepath)
+    finally:
+        if os.path.exists(patient_dir):
+            shutil.rmtree(patient_dir)
+
+
+async def embed_and_index(case_id, processed_data, source):
+    """
+    Embed a parsed counts file, store its counts and add it to the index.
+    source names the file in log messages.
+    """
     if processed_data is None or processed_data.empty:
-        print(f"Processing failed for {filepath}")
+        print(f"Processing failed for {source}")
+        update_case(case_id, FAILED, error="processing failed")
         return None
 
-        global reference_genes
+    global reference_genes
     if reference_genes is None:
         # Initialize reference_genes from the first file processed.
         reference_genes = processed_data.index
-    embedding = compute_embedding(processed_data, reference_genes)
+        save_reference_genes(reference_genes)
+    with timed("embed"):
+        counts = compute_embedding(processed_data, reference_genes)
+        embedding = embed_counts(counts, embedding_reducer) if counts is not None else None
     if embedding is None:
-        print(f"Embedding computation failed for {filepath}")
+        print(f"Embedding computation failed for {source}")
+        update_case(case_id, FAILED, error="embedding failed")
         return processed_data
-    await add_embedding(file_meta["case_id"], embedding)
-    if os.path.exists(patient_dir):
-            shutil.rmtree(patient_dir)
-            print(f"Cleaned up directory for case {file_meta['case_id']}")
-            gc.collect()  
+    # Keep the aligned raw counts so the index can be rebuilt without re-downloading.
+    await asyncio.to_thread(append_counts, case_id, counts, reference_genes)
+    update_case(case_id, EMBEDDED)
+    await add_embedding(case_id, embedding)
+    update_case(case_id, INDEXED)
     return processed_data
 
 
-async def process_patient(patient_id, session, base_dir="downloads"):
+async def download_archive(session, file_metas):
     """
-    For a given patient, download and process their STAR count TSV.
+    Download several files with one POST /data request and index them as
+    the archive streams in. file_metas maps file_id to its file metadata.
+    Files missing from the archive are marked failed.
+    """
+    import aiohttp
+    url = f'{GDC_API_URL}/data'
+    pending = dict(file_metas)
+    results = []
+    try:
+        async with session.post(url, json={"ids": list(file_metas)},
+                                timeout=aiohttp.ClientTimeout(total=300)) as resp:
+            if resp.status != 200:
+                if resp.status == 429:
+                    incr("http_429")
+                incr("download_errors")
+                print(f"Failed to download {len(file_metas)} files: {resp.status}")
+                for file_meta in file_metas.values():
+                    update_case(file_meta["case_id"], FAILED, error=f"download status {resp.status}")
+                return results
+            incr("bulk_requests")
+
+            async for file_id, processed_data, md5 in iter_archive(resp):
+                file_meta = pending.pop(file_id, None)
+                if file_meta is None:
+                    continue
+                if file_meta.get("md5sum") and md5 != file_meta["md5sum"]:
+                    incr("md5_mismatches")
+                    print(f"File {file_id} in archive does not match its md5")
+                    update_case(file_meta["case_id"], FAILED, error="md5 mismatch")
+                    continue
+                incr("downloads")
+                update_case(file_meta["case_id"], DOWNLOADED)
+                results.append(await embed_and_index(file_meta["case_id"], processed_data, file_meta["file_name"]))
+    except Exception as e:
+        for file_meta in pending.values():
+            update_case(file_meta["case_id"], FAILED, error=str(e))
+        raise
+    for file_meta in pending.values():
+        print(f"File {file_meta['file_id']} missing from archive")
+        update_case(file_meta["case_id"], FAILED, error="missing from archive")
+    return results
+
+
+async def fetch_file_meta(patient_id):
+    """
+    Look up a patient's STAR count TSV and record it as pending.
+    Returns the file metadata, or None if the patient has no such file.
     """
     file_df = await query_gdc(patient_id)
-    await asyncio.sleep(0.8)  # Simulate processing time
+    await asyncio.sleep(PATIENT_DELAY)
     if file_df is None or file_df.empty:
         print(f"No file metadata for patient {patient_id}")
+        update_case(patient_id, FAILED, error="no file metadata")
         return None
     file_meta = file_df.to_dict("records")[0]
-    return await download_and_process_file(session, file_meta, base_dir)
+    fields = case_metadata.setdefault(patient_id, {})
+    for field in METADATA_FIELDS:
+        if fields.get(field) is None and file_meta.get(field) is not None:
+            fields[field] = file_meta[field]
+    update_case(
+        patient_id, PENDING,
+        file_id=file_meta["file_id"],
+        md5=file_meta.get("md5sum"),
+        project_id=file_meta.get("project_id"),
+    )
+    return file_meta
+
+
+async def process_patient(patient_id, session, base_dir="downloads"):
+    """
+    For a given patient, download and process their STAR count TSV.
+    """
+    file_meta = await fetch_file_meta(patient_id)
+    if file_meta is None:
+        return None
+    try:
+        return await download_and_process_file(session, file_meta, base_dir)
+    except Exception as e:
+        update_case(patient_id, FAILED, error=str(e))
+        raise
+
+
+async def process_patients_bulk(patient_ids, session, base_dir="downloads"):
+    """
+    For a group of patients, look up their STAR count TSVs and download
+    them in a single archive request (see download_archive).
+    """
+    file_metas = {}
+    for patient_id in patient_ids:
+        file_meta = await fetch_file_meta(patient_id)
+        if file_meta is not None:
+            file_metas[file_meta["file_id"]] = file_meta
+    if len(file_metas) == 1:
+        # A single id is answered with the bare file rather than an archive.
+        file_meta = next(iter(file_metas.values()))
+        try:
+            return [await download_and_process_file(session, file_meta, base_dir)]
+        except Exception as e:
+            update_case(file_meta["case_id"], FAILED, error=str(e))
+            raise
+    if not file_metas:
+        return []
+    return await download_archive(session, file_metas)
+
+class EmbeddingMismatchError(Exception):
+    """Saved vectors were produced by a different reducer than the one loaded."""
+
+
+def expected_dimension(directory=CHECKPOINT_DIR):
+    """Dimension new embeddings will have, or None while the gene order is unknown."""
+    if embedding_reducer is not None:
+        return len(embedding_reducer["components"])
+    genes = load_reference_genes(directory)
+    return len(genes) if genes is not None else None
+
+
+def embedding_matches(reducer, dim, directory=CHECKPOINT_DIR):
+    """
+    Whether saved vectors (from reducer at dim) fit the loaded reducer.
+    Vectors saved before reducers were recorded are judged by dimension alone.
+    """
+    if reducer is not None:
+        return reducer == reducer_id(embedding_reducer)
+    expected = expected_dimension(directory)
+    return expected is None or dim == expected
+
+
+def reseed_or_refuse(reason, directory=CHECKPOINT_DIR):
+    """
+    Rebuild the segment log from the counts store with the loaded reducer.
+    Raises EmbeddingMismatchError when the store cannot replace the saved vectors.
+    """
+    print(f"{reason}; re-seeding segments from the counts store")
+    if not reseed_segments(COUNTS_DIR, REDUCER_PATH, directory):
+        raise EmbeddingMismatchError(
+            f"{reason} and there is no counts store to re-embed from. Restore the "
+            f"previous reducer or move the saved index aside to start over."
+        )
+
+
+def load_segments(directory=CHECKPOINT_DIR):
+    """
+    Rebuild the FAISS index and mapping by replaying segments in order.
+    Segments from another reducer than the loaded one are first re-seeded
+    from the counts store (see reseed_or_refuse).
+    """
+    import pandas as pd
+    global faiss_index, caseid_to_index, last_save_count, reference_genes
+
+    faiss_index = None
+    caseid_to_index = {}
+    segments = list(iter_segments(directory))
+    if not segments:
+        return False
+    stale = [
+        descriptor["seq"] for descriptor, _ in segments
+        if not embedding_matches(descriptor.get("reducer"), descriptor["dim"], directory)
+    ]
+    if stale:
+        reseed_or_refuse(
+            f"{len(stale)} segments were embedded by another reducer than {reducer_id(embedding_reducer)}",
+            directory,
+        )
+        segments = list(iter_segments(directory))
+        if not segments:
+            return False
+
+    for descriptor, _ in segments:
+        metadata = descriptor.get("metadata") or [None] * descriptor["count"]
+        for offset, (case_id, fields) in enumerate(zip(descriptor["case_ids"], metadata)):
+            if case_id is not None:
+                caseid_to_index[case_id] = descriptor["start"] + offset
+                if fields:
+                    case_metadata[case_id] = fields
+
+    # Train on a random sample across all segments, then replay them in order.
+    n_total = sum(descriptor["count"] for descriptor, _ in segments)
+    dim = segments[-1][0]["dim"]
+    train_vectors = None
+    if not new_index(dim, n_train=min(n_total, TRAIN_SAMPLE_SIZE)).is_trained:
+        sample = sample_rows(n_total)
+        train_vectors = []
+        for descriptor, vectors in segments:
+            start = descriptor["start"]
+            rows = sample[(sample >= start) & (sample < start + descriptor["count"])]
+            if len(rows):
+                train_vectors.append(vectors[rows - start])
+        train_vectors = np.vstack(train_vectors)
+    faiss_index = build_index(
+        (vectors for _, vectors in segments), n_total, train_vectors=train_vectors,
+    )
+    print(f"Replayed {len(segments)} segments")
+
+    genes = load_reference_genes(directory)
+    if genes is not None:
+        reference_genes = pd.Index(genes)
+    last_save_count = faiss_index.ntotal
+    print(f"Successfully loaded index with {faiss_index.ntotal} vectors from segments")
+    return True
 
 def load_most_recent_save():
-    """Load the most recent FAISS index and mapping files."""
-    import glob
-    from datetime import datetime
+    """
+    Load the most recent saved state: replay segments if any exist,
+    otherwise fall back to the latest full index and mapping files.
+    The embedding reducer, if one was fitted, is loaded as well.
+    """
+    import faiss
     
+    global faiss_index, caseid_to_index, last_save_count, embedding_reducer
+    embedding_reducer = load_reducer()
     try:
-        # Find all save files
-        index_files = sorted(glob.glob("faiss_index_*.bin"))
-        mapping_files = sorted(glob.glob("case_mapping_*.json"))
-        
-        if not index_files or not mapping_files:
-            print("No save files found.")
-            return False
-            
-        # Extract timestamps and pair files
-        file_pairs = []
-        for idx_file in index_files:
-            # Extract timestamp from index filename (format: faiss_index_YYYYMMDD_HHMMSS.bin)
-            idx_timestamp = idx_file.split('_')[2:4][0]
-            # Find matching mapping file
-            matching_map = next(
-                (f for f in mapping_files if idx_timestamp in f), 
-                None
-            )
-            if matching_map:
-                file_pairs.append((idx_file, matching_map, idx_timestamp))
-        
+        if list_segments():
+            return load_segments()
+
+        file_pairs = pair_checkpoints()
         if not file_pairs:
             print("No matching index-mapping file pairs found.")
             return False
             
-        # Sort by timestamp and get most recent pair
-        latest_pair = sorted(file_pairs, key=lambda x: x[2])[-1]
-        latest_index, latest_mapping = latest_pair[0:2]
+        # Pairs are sorted by timestamp; take the most recent one
+        latest_index, latest_mapping = file_pairs[-1][0:2]
         
         # Load the files
-        global faiss_index, caseid_to_index, last_save_count
         print(f"Loading index from {latest_index}...")
-        faiss_index = faiss.read_index(latest_index)
+        faiss_index = to_cosine_index(faiss.read_index(latest_index))
+        if not embedding_matches(None, faiss_index.d):
+            dim, faiss_index = faiss_index.d, None
+            reseed_or_refuse(f"Index {latest_index} has dimension {dim}, "
+                             f"the loaded reducer embeds to {expected_dimension()}")
+            return load_segments()
         
         print(f"Loading mapping from {latest_mapping}...")
         with open(latest_mapping, 'r') as f:
@@ -252,8 +481,21 @@ def load_most_recent_save():
             
         last_save_count = faiss_index.ntotal
         print(f"Successfully loaded index with {faiss_index.ntotal} vectors")
+
+        # Seed the segment log with the legacy index so later segments
+        # replay on top of it.
+        positions = {idx: case_id for case_id, idx in caseid_to_index.items()}
+        write_segment(
+            faiss_index.reconstruct_n(0, faiss_index.ntotal),
+            [positions.get(i) for i in range(faiss_index.ntotal)],
+            0,
+            reducer=reducer_id(embedding_reducer),
+        )
+        retire_legacy_saves()
         return True
         
+    except EmbeddingMismatchError:
+        raise
     except Exception as e:
         print(f"Error loading save files: {str(e)}")
         # Reset globals in case of partial load
@@ -262,73 +504,178 @@ def load_most_recent_save():
         last_save_count = 0
         return False
     
-def aggregate_checkpoints(checkpoint_dir="."):
-    """Aggregate all checkpoint FAISS indexes into a single index."""
-    import glob
-    from datetime import datetime
-    
+def checkpoint_timestamp(path):
+    """Extract the YYYYMMDD_HHMMSS timestamp from a checkpoint filename."""
+    match = re.search(r"(\d{8}_\d{6})", os.path.basename(path))
+    return match.group(1) if match else None
+
+def pair_checkpoints(checkpoint_dir="."):
+    """
+    Pair full index and mapping checkpoints by their timestamp.
+    Returns a list of (index_path, mapping_path, timestamp) sorted by timestamp.
+    """
+    mappings = {
+        checkpoint_timestamp(f): f
+        for f in glob.glob(os.path.join(checkpoint_dir, "case_mapping_*.json"))
+    }
+    file_pairs = []
+    for idx_file in glob.glob(os.path.join(checkpoint_dir, "faiss_index_*.bin")):
+        timestamp = checkpoint_timestamp(idx_file)
+        if timestamp is not None and timestamp in mappings:
+            file_pairs.append((idx_file, mappings[timestamp], timestamp))
+        else:
+            print(f"No mapping file found for checkpoint {idx_file}")
+    return sorted(file_pairs, key=lambda x: x[2])
+
+def retire_legacy_saves(checkpoint_dir="."):
+    """
+    Move the full index/mapping checkpoints (and their sidecars) into a
+    retired_<timestamp> subdirectory once the segment log holds their vectors,
+    so they are neither replayed nor aggregated again.
+    Returns the new location, or None if there was nothing to retire.
+    """
+    file_pairs = pair_checkpoints(checkpoint_dir)
+    if not file_pairs:
+        return None
+    retired = os.path.join(checkpoint_dir, f"retired_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+    os.makedirs(retired, exist_ok=True)
+    for idx_file, map_file, _ in file_pairs:
+        # The index goes first, so an interrupted move never leaves an index without its mapping.
+        for path in (idx_file, map_file, sidecar_path(map_file)):
+            if os.path.exists(path):
+                os.replace(path, os.path.join(retired, os.path.basename(path)))
+    print(f"Retired {len(file_pairs)} full checkpoints to {retired}")
+    return retired
+
+def _checkpoint_sources(checkpoint_dir):
+    """
+    List every checkpoint source, oldest first, as (name, case_rows, dim, loader).
+    case_rows is a list of (case_id, row) and loader(rows) returns those vectors.
+    Full checkpoints come first since segments are always written after them.
+    """
+    import faiss
+    sources = []
+    for idx_file, map_file, _ in pair_checkpoints(checkpoint_dir):
+        with open(map_file, 'r') as f:
+            mapping = json.load(f)
+        index = faiss.read_index(idx_file, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+
+        def load_rows(rows, index=index):
+            return index.reconstruct_batch(np.asarray(rows, dtype="int64"))
+
+        sources.append((idx_file, list(mapping.items()), index.d, load_rows))
+
+    segment_dir = os.path.join(checkpoint_dir, CHECKPOINT_DIR)
+    for descriptor, vectors in iter_segments(segment_dir):
+        case_rows = [
+            (case_id, row)
+            for row, case_id in enumerate(descriptor["case_ids"])
+            if case_id is not None
+        ]
+
+        def load_rows(rows, vectors=vectors):
+            return np.asarray(vectors[rows], dtype="float32")
+
+        sources.append((descriptor["vectors"], case_rows, descriptor["dim"], load_rows))
+    return sources
+
+def _checkpoint_metadata(checkpoint_dir):
+    """
+    Collect case metadata from checkpoint sidecars and segment descriptors,
+    oldest first so that the latest record for a case wins.
+    """
+    merged = {}
+    for _, map_file, _ in pair_checkpoints(checkpoint_dir):
+        path = sidecar_path(map_file)
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                merged.update(json.load(f))
+    segment_dir = os.path.join(checkpoint_dir, CHECKPOINT_DIR)
+    for descriptor, _ in iter_segments(segment_dir):
+        for case_id, fields in zip(descriptor["case_ids"], descriptor.get("metadata") or []):
+            if case_id is not None and fields:
+                merged[case_id] = fields
+    return merged
+
+def aggregate_checkpoints(checkpoint_dir=".", batch_size=1024, index_type=None):
+    """
+    Merge all checkpoints into a single compacted index with one vector per case.
+
+    Both full checkpoints (paired by timestamp) and segments are merged.
+    Mappings are read first to pick the latest vector for every case_id;
+    vectors are then streamed source by source in batches of batch_size,
+    so only one batch is held in memory besides the output index.
+    index_type selects the output index (see index_factory.INDEX_TYPES);
+    types that need training are trained on a random sample of the cases.
+    """
     try:
-        # Find all checkpoint files
-        index_files = sorted(glob.glob(os.path.join(checkpoint_dir, "faiss_index_*.bin")))
-        mapping_files = sorted(glob.glob(os.path.join(checkpoint_dir, "case_mapping_*.json")))
-        
-        if not index_files:
+        sources = _checkpoint_sources(checkpoint_dir)
+        if not sources:
             print("No checkpoint files found.")
             return None, None
-            
-        # Load the first index to get dimensions
-        base_index = faiss.read_index(index_files[0])
-        dimension = base_index.d
-        
-        # Create a new index with same parameters
-        combined_index = faiss.IndexFlatL2(dimension)
+
+        dimension = sources[-1][2]
+        print(f"Found {len(sources)} checkpoints to aggregate")
+
+        # Pass 1: the latest source wins for every case_id.
+        latest = {}
+        total_vectors = 0
+        for source_num, (name, case_rows, dim, _) in enumerate(sources):
+            if dim != dimension:
+                print(f"Skipping {name}: dimension {dim} != {dimension}")
+                continue
+            total_vectors += len(case_rows)
+            for case_id, row in case_rows:
+                latest[case_id] = (source_num, row)
+
+        selected = {}
+        for case_id, (source_num, row) in latest.items():
+            selected.setdefault(source_num, []).append((row, case_id))
+
+        combined_index = new_index(dimension, index_type, min(len(latest), TRAIN_SAMPLE_SIZE))
+        if not combined_index.is_trained:
+            winners = list(latest.values())
+            sample = {}
+            for i in sample_rows(len(winners)):
+                source_num, row = winners[i]
+                sample.setdefault(source_num, []).append(row)
+            train_vectors = np.vstack([
+                sources[source_num][3](sorted(rows)) for source_num, rows in sample.items()
+            ])
+            print(f"Training {index_type or 'default'} index on {len(train_vectors)} vectors")
+            train_index(combined_index, train_vectors)
+
+        # Pass 2: stream the winning vectors into the compacted index.
         combined_mapping = {}
-        
-        print(f"Found {len(index_files)} checkpoints to aggregate")
-        
-        # Process each checkpoint
-        for idx_file, map_file in zip(index_files, mapping_files):
-            try:
-                print(f"Processing {idx_file}...")
-                
-                # Load checkpoint index
-                checkpoint_index = faiss.read_index(idx_file)
-                
-                # Load checkpoint mapping
-                with open(map_file, 'r') as f:
-                    checkpoint_mapping = json.load(f)
-                
-                # Get current total before adding vectors
-                current_total = combined_index.ntotal
-                
-                # Add vectors from checkpoint
-                vectors = faiss.vector_float_to_array(checkpoint_index.get_xb())
-                vectors = vectors.reshape(checkpoint_index.ntotal, checkpoint_index.d)
-                combined_index.add(vectors)
-                
-                # Update mapping with offset
-                for case_id, idx in checkpoint_mapping.items():
-                    if case_id not in combined_mapping:
-                        combined_mapping[case_id] = idx + current_total
-                
-                print(f"Added {checkpoint_index.ntotal} vectors from checkpoint")
-                
-            except Exception as e:
-                print(f"Error processing checkpoint {idx_file}: {e}")
+        for source_num, (name, _, _, load_rows) in enumerate(sources):
+            picks = sorted(selected.get(source_num, []))
+            if not picks:
                 continue
-        
+            print(f"Processing {name}: keeping {len(picks)} vectors")
+            for start in range(0, len(picks), batch_size):
+                batch = picks[start:start + batch_size]
+                vectors = load_rows([row for row, _ in batch])
+                for offset, (_, case_id) in enumerate(batch):
+                    combined_mapping[case_id] = combined_index.ntotal + offset
+                # Legacy full checkpoints hold raw vectors; normalising is a
+                # no-op for segment vectors, which are stored normalised.
+                combined_index.add(normalize_rows(vectors))
+
+        compaction_ratio = total_vectors / combined_index.ntotal if combined_index.ntotal else 0.0
         print(f"\nAggregation complete:")
+        print(f"Input vectors: {total_vectors}")
         print(f"Total vectors: {combined_index.ntotal}")
         print(f"Total cases: {len(combined_mapping)}")
+        print(f"Compaction ratio: {compaction_ratio:.2f}x")
         
         # Save aggregated index
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         agg_index_path = os.path.join(checkpoint_dir, f"aggregated_index_{timestamp}.bin")
         agg_mapping_path = os.path.join(checkpoint_dir, f"aggregated_mapping_{timestamp}.json")
         
-        faiss.write_index(combined_index, agg_index_path)
-        with open(agg_mapping_path, 'w') as f:
-            json.dump(combined_mapping, f)
+        write_index(combined_index, agg_index_path)
+        save_mapping(combined_mapping, agg_mapping_path, combined_index.ntotal)
+        save_sidecar(_checkpoint_metadata(checkpoint_dir), agg_mapping_path, combined_mapping)
             
         print(f"\nSaved aggregated files:")
         print(f"Index: {agg_index_path}")
@@ -343,6 +690,7 @@ def aggregate_checkpoints(checkpoint_dir="."):
 async def process_project(project_id, session, base_dir="downloads"):
     """
     For a given project, query its patients and process each patient's file.
+    Cases already in the index, or failed too many times, are skipped.
     Uses a semaphore to limit concurrent requests while maintaining efficiency.
     """
     patients_df = await query_patients_by_project(project_id)
@@ -350,18 +698,53 @@ async def process_project(project_id, session, base_dir="downloads"):
         print(f"No patients found for project {project_id}")
         return []
 
+    for row in patients_df.to_dict("records"):
+        case_metadata[row["case_id"]] = {
+            field: row.get(field) for field in METADATA_FIELDS
+        }
+
+    case_ids = [
+        case_id for case_id in patients_df["case_id"]
+        if should_process(case_id, caseid_to_index)
+    ]
+    skipped = len(patients_df) - len(case_ids)
+    if skipped:
+        print(f"Skipping {skipped} of {len(patients_df)} cases already done for project {project_id}")
+
     # Create a semaphore to limit concurrent requests
-    semaphore = asyncio.Semaphore(1)  
+    semaphore = asyncio.Semaphore(CASE_CONCURRENCY)
 
     async def process_with_rate_limit(case_id):
+        add_gauge("cases_queued", 1)
+        async with semaphore:
+            add_gauge("cases_queued", -1)
+            add_gauge("cases_in_flight", 1)
+            try:
+                await asyncio.sleep(CASE_DELAY)  # Rate limiting delay
+                return await process_patient(case_id, session, base_dir)
+            finally:
+                add_gauge("cases_in_flight", -1)
+
+    async def process_group_with_rate_limit(group):
+        add_gauge("cases_queued", len(group))
         async with semaphore:
-            await asyncio.sleep(3)  # Rate limiting delay
-            return await process_patient(case_id, session, base_dir)
+            add_gauge("cases_queued", -len(group))
+            add_gauge("cases_in_flight", len(group))
+            try:
+                await asyncio.sleep(CASE_DELAY)  # Rate limiting delay
+                return await process_patients_bulk(group, session, base_dir)
+            finally:
+                add_gauge("cases_in_flight", -len(group))
+
+    if BULK_GROUP_SIZE > 1:
+        groups = [case_ids[i:i + BULK_GROUP_SIZE] for i in range(0, len(case_ids), BULK_GROUP_SIZE)]
+        group_results = await asyncio.gather(*(process_group_with_rate_limit(group) for group in groups))
+        return [result for results in group_results for result in results]
 
     # Create tasks for all patients and process them concurrently
     tasks = [
-        process_with_rate_limit(row["case_id"]) 
-        for _, row in patients_df.iterrows()
+        process_with_rate_limit(case_id)
+        for case_id in case_ids
     ]
     results = await asyncio.gather(*tasks)
     return results
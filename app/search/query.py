@@ -8,17 +8,14 @@
 # - test = query_patients_by_project("TCGA-LUAD")
 # - a = query_gdc(test['case_id'][0])
 # - print(a)
-import requests
-import pandas as pd
-import json
-import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
-import matplotlib.pyplot as plt
-import aiohttp
+import os
 import asyncio
+import time
+from metrics import incr, observe_ms
 
-from concurrent.futures import ProcessPoolExecutor
+# Point at a stand-in server (see fake_gdc.py) to run the pipeline offline.
+GDC_API_URL = os.environ.get("GDC_API_URL", "https://api.gdc.cancer.gov").rstrip("/")
+GRAPHQL_URL = f"{GDC_API_URL}/v0/graphql"
 
 
 query = """
@@ -30,6 +27,7 @@ query FileSearch($filters: FiltersArgument) {
           node {
             file_id
             file_name
+            md5sum
             data_category
             data_format
             experimental_strategy
@@ -101,6 +99,8 @@ def create_filters(case_id):
     
 async def query_patients_by_project(project_id, size=10000):
     """Query cases for a specific project."""
+    import aiohttp
+    import pandas as pd
     cases_query = """
     query ProjectCases($filters: FiltersArgument, $size: Int) {
       repository {
@@ -110,6 +110,7 @@ async def query_patients_by_project(project_id, size=10000):
               node {
                 case_id
                 submitter_id
+                primary_site
                 project {
                   project_id
                 }
@@ -169,9 +170,11 @@ async def query_patients_by_project(project_id, size=10000):
         "size": size
     }
 
-    url = 'https://api.gdc.cancer.gov/v0/graphql'
+    url = GRAPHQL_URL
     async with aiohttp.ClientSession() as session:
+        request_start = time.perf_counter()
         async with session.post(url, json={'query': cases_query, 'variables': variables}) as response:
+            record_metadata_response(response, request_start)
 
             if response.status == 200:
                 data = await response.json()
@@ -183,6 +186,7 @@ async def query_patients_by_project(project_id, size=10000):
                     case_info = {
                         'case_id': node['case_id'],
                         'submitter_id': node['submitter_id'],
+                        'primary_site': node['primary_site'],
                         'project_id': node['project']['project_id']
                     }
                     case_data.append(case_info)
@@ -196,14 +200,25 @@ async def query_patients_by_project(project_id, size=10000):
 
 retry_delay = 5  # Define a retry delay in seconds
 
+def record_metadata_response(response, request_start):
+    """Count a GDC metadata request and record its latency and rate limiting."""
+    incr("metadata_requests")
+    observe_ms("metadata_request", (time.perf_counter() - request_start) * 1000)
+    if response.status == 429:
+        incr("http_429")
+
 async def query_gdc(case_id):
+  import aiohttp
+  import pandas as pd
   variables = {
     "filters": create_filters(case_id),
   }
 
-  url = 'https://api.gdc.cancer.gov/v0/graphql'
+  url = GRAPHQL_URL
   async with aiohttp.ClientSession() as session:
+    request_start = time.perf_counter()
     async with session.post(url, json={'query': query, 'variables': variables}) as response:
+        record_metadata_response(response, request_start)
         await asyncio.sleep(0.1)
         if response.status == 200:
             data = await response.json()
@@ -215,6 +230,7 @@ async def query_gdc(case_id):
                 file_info = {
                     'file_id': node['file_id'],
                     'file_name': node['file_name'],
+                    'md5sum': node['md5sum'],
                     'data_category': node['data_category'],
                     'data_format': node['data_format'],
                     'experimental_strategy': node['experimental_strategy'],
@@ -244,14 +260,18 @@ async def query_gdc(case_id):
             return None
   
 async def query_all_patient_files(case_id):
+    import aiohttp
+    import pandas as pd
     variables = {
       "filters": create_filters(case_id),
       
     }
 
-    url = 'https://api.gdc.cancer.gov/v0/graphql'
+    url = GRAPHQL_URL
     async with aiohttp.ClientSession() as session:
+        request_start = time.perf_counter()
         async with session.post(url, json={'query': query, 'variables': variables}) as response:
+            record_metadata_response(response, request_start)
 
             if response.status == 200:
                 data = await response.json()
@@ -264,6 +284,7 @@ async def query_all_patient_files(case_id):
                     file_info = {
                         'file_id': node['file_id'],
                         'file_name': node['file_name'],
+                        'md5sum': node['md5sum'],
                         'data_category': node['data_category'],
                         'data_format': node['data_format'],
                         'experimental_strategy': node['experimental_strategy'],
@@ -284,6 +305,8 @@ async def query_all_patient_files(case_id):
       
 async def query_all_projects():
     """Query all available projects from GDC."""
+    import aiohttp
+    import pandas as pd
     projects_query = """
     query Projects($size: Int) {
       projects {
@@ -305,9 +328,11 @@ async def query_all_projects():
     """
 
     variables = {"size": 2000}  # Adjust size as needed
-    url = 'https://api.gdc.cancer.gov/v0/graphql'
+    url = GRAPHQL_URL
     async with aiohttp.ClientSession() as session:
+        request_start = time.perf_counter()
         async with await session.post(url, json={'query': projects_query, 'variables': variables}) as response:
+            record_metadata_response(response, request_start)
 
             if response.status == 200:
                 data = await response.json()
@@ -364,6 +389,7 @@ async def query_all_projects():
 #     metadata_list = []
 # print(metadata_list)
 async def main():
+    import pandas as pd
     # Retrieve all projects as a DataFrame.
     min_patients = 20
     projects_df = await query_all_projects()
@@ -395,5 +421,5 @@ async def main():
     else:
         print("No patient data found for any projects.")
 
-# Run the async main function
-asyncio.run(main())
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,166 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import counts_store
+from embedding import (
+    FIT_SAMPLE_SIZE, N_COMPONENTS, N_VARIABLE_GENES, REDUCER_METHODS, REDUCER_PATH,
+    fit_reducer, load_reducer, reducer_id, save_reducer, transform,
+)
+from index_factory import build_index, normalize_rows, sample_rows, write_index, INDEX_TYPES
+from mapping import save_mapping
+from segments import CHECKPOINT_DIR, iter_segments, list_segments, retire_segments, write_segment
+
+
+def embed_chunk(store_dir, chunk_num, picks, reducer_path=None):
+    """
+    Worker: read the selected rows of one store chunk and embed them.
+
+    Args:
+        store_dir (str): Counts store directory
+        chunk_num (int): Chunk to read
+        picks (list): (offset, case_id) pairs to embed from this chunk
+        reducer_path (str): Optional fitted reducer to project the counts with
+
+    Returns:
+        tuple: (case_ids, vectors)
+    """
+    chunk = np.load(counts_store.chunk_path(chunk_num, store_dir), mmap_mode='r')
+    offsets = [offset for offset, _ in picks]
+    counts = np.asarray(chunk[offsets], dtype="float32")
+    reducer = load_reducer(reducer_path) if reducer_path else None
+    vectors = normalize_rows(transform(reducer, counts) if reducer is not None else counts)
+    return [case_id for _, case_id in picks], vectors
+
+
+def fit_reducer_from_store(n_genes=N_VARIABLE_GENES, n_components=N_COMPONENTS,
+                           method="pca", sample_size=FIT_SAMPLE_SIZE, path=REDUCER_PATH):
+    """Fit the embedding reducer on a random sample of stored cases and save it."""
+    rows = sorted(counts_store.case_rows.values())
+    sample = [rows[i] for i in sample_rows(len(rows), sample_size)]
+    counts = np.vstack([
+        np.load(counts_store.chunk_path(row // counts_store.CHUNK_ROWS), mmap_mode='r')[row % counts_store.CHUNK_ROWS]
+        for row in sample
+    ])
+    reducer = fit_reducer(counts, n_genes, n_components, method)
+    save_reducer(reducer, path)
+    return reducer
+
+
+def reembed(store_dir=counts_store.COUNTS_DIR, index_path="faiss_index.bin",
+            mapping_path="case_mapping.json", workers=None, index_type=None,
+            reducer_path=REDUCER_PATH):
+    """
+    Rebuild the FAISS index from the counts store without re-downloading.
+    Chunks are embedded in parallel worker processes and added in row order.
+    index_type selects the index (see index_factory.INDEX_TYPES); counts are
+    projected with the reducer at reducer_path if one has been fitted.
+    """
+    if not counts_store.open_store(store_dir):
+        print(f"No counts store found at {store_dir}")
+        return None, None
+
+    assignments = counts_store.chunk_assignments()
+    print(f"Re-embedding {len(counts_store.case_rows)} cases from {len(assignments)} chunks")
+
+    start = time.perf_counter()
+    mapping = {}
+
+    def embedded_batches(results):
+        for case_ids, vectors in results:
+            for case_id in case_ids:
+                mapping[case_id] = len(mapping)
+            yield vectors
+
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        results = executor.map(
+            embed_chunk,
+            [store_dir] * len(assignments),
+            [chunk_num for chunk_num, _ in assignments],
+            [picks for _, picks in assignments],
+            [reducer_path if os.path.exists(reducer_path) else None] * len(assignments),
+        )
+        index = build_index(embedded_batches(results), len(counts_store.case_rows), index_type)
+
+    if index is None:
+        print("Counts store is empty")
+        return None, None
+
+    write_index(index, index_path)
+    save_mapping(mapping, mapping_path, index.ntotal)
+
+    elapsed = time.perf_counter() - start
+    print(f"Re-embedded {index.ntotal} cases in {elapsed:.1f}s "
+          f"({index.ntotal / elapsed:.0f} cases/s) -> {index_path}")
+    return index, mapping
+
+
+def reseed_segments(store_dir=counts_store.COUNTS_DIR, reducer_path=REDUCER_PATH,
+                    directory=CHECKPOINT_DIR, workers=None):
+    """
+    Replace the ingestion segment log with the counts store embedded by the
+    reducer at reducer_path, so ingestion resumes at the new dimension.
+    The old segments are retired (see segments.retire_segments) and their
+    per-case metadata carried over. Cases missing from the store are
+    dropped; the manifest sends them back to pending on the next run.
+
+    Returns:
+        int: Number of cases written, or None if there is no counts store
+    """
+    if not counts_store.open_store(store_dir):
+        print(f"No counts store found at {store_dir}")
+        return None
+
+    metadata = {}
+    for descriptor, _ in iter_segments(directory):
+        for case_id, fields in zip(descriptor["case_ids"], descriptor.get("metadata") or []):
+            if case_id is not None and fields:
+                metadata[case_id] = fields
+    retire_segments(directory)
+
+    reducer_path = reducer_path if os.path.exists(reducer_path) else None
+    reducer = reducer_id(load_reducer(reducer_path) if reducer_path else None)
+    assignments = counts_store.chunk_assignments()
+    start = 0
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        results = executor.map(
+            embed_chunk,
+            [store_dir] * len(assignments),
+            [chunk_num for chunk_num, _ in assignments],
+            [picks for _, picks in assignments],
+            [reducer_path] * len(assignments),
+        )
+        for case_ids, vectors in results:
+            write_segment(
+                vectors, case_ids, start,
+                [metadata.get(case_id, {}) for case_id in case_ids], reducer, directory,
+            )
+            start += len(case_ids)
+    print(f"Re-seeded segments with {start} cases embedded by reducer {reducer}")
+    return start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the FAISS index from the counts store.")
+    parser.add_argument("--store", default=counts_store.COUNTS_DIR)
+    parser.add_argument("--index", default="faiss_index.bin")
+    parser.add_argument("--mapping", default="case_mapping.json")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--index-type", choices=INDEX_TYPES, default=None)
+    parser.add_argument("--reducer", default=REDUCER_PATH, help="Reducer file to use or fit")
+    parser.add_argument("--fit-reducer", choices=REDUCER_METHODS, default=None,
+                        help="Fit a new reducer on the store before re-embedding")
+    parser.add_argument("--genes", type=int, default=N_VARIABLE_GENES)
+    parser.add_argument("--components", type=int, default=N_COMPONENTS)
+    parser.add_argument("--segments", default=CHECKPOINT_DIR,
+                        help="Ingestion segment log to re-seed after fitting a new reducer")
+    args = parser.parse_args()
+    if args.fit_reducer:
+        counts_store.open_store(args.store)
+        fit_reducer_from_store(args.genes, args.components, args.fit_reducer, path=args.reducer)
+    reembed(args.store, args.index, args.mapping, args.workers, args.index_type, args.reducer)
+    if args.fit_reducer and list_segments(args.segments):
+        # The segments hold vectors from the previous reducer; ingestion would
+        # otherwise replay them and reject every newly embedded case.
+        reseed_segments(args.store, args.reducer, args.segments, args.workers)
@@ -1,29 +1,52 @@
-import faiss
 import os
 import json
 import numpy as np
-from process import aggregate_checkpoints
-def load_faiss(index_path="faiss_index.bin", mapping_path="case_mapping.json"):
+from index_factory import normalize_rows, prepare_for_search, search_parameters, to_cosine_index, write_index
+from mapping import CaseMapping, binary_mapping_prefix, has_binary_mapping
+
+def load_faiss(index_path="faiss_index.bin", mapping_path="case_mapping.json", mmap=False):
     """
-    Load the FAISS index and case ID mapping from disk
+    Load the FAISS index and case ID mapping from disk.
+    Legacy L2 indexes of raw vectors are converted once to a normalised
+    inner-product index, saved over the original, so searches return
+    cosine similarity.
     
     Args:
         index_path (str): Path to the saved FAISS index file
         mapping_path (str): Path to the saved case mapping JSON file
+        mmap (bool): Memory-map the index read-only and use the binary
+            mapping next to mapping_path (when present) instead of parsing
+            the JSON, so worker processes share pages and start in constant time
     
     Returns:
         tuple: (faiss_index, case_mapping) or (None, None) if loading fails
     """
+    import faiss
+    # Read the index in place from the page cache instead of copying it to the heap.
+    # IO_FLAG_MMAP_IFC (faiss >= 1.11) maps flat codes and IVF lists alike; adding
+    # IO_FLAG_MMAP to it makes IVF indexes fail to load.
+    flags = faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY if mmap else 0
     try:
         # Load the FAISS index
         if not os.path.exists(index_path):
             print(f"FAISS index file not found at {index_path}")
             return None, None
             
-        faiss_index = faiss.read_index(index_path)
+        faiss_index = faiss.read_index(index_path, flags)
+        if faiss_index.metric_type != faiss.METRIC_INNER_PRODUCT:
+            # Convert once on disk; later loads map the converted index directly.
+            print(f"Converting legacy L2 index {index_path} to cosine similarity")
+            write_index(to_cosine_index(faiss_index), index_path)
+            faiss_index = faiss.read_index(index_path, flags)
+        faiss_index = prepare_for_search(faiss_index)
         print(f"Loaded FAISS index with {faiss_index.ntotal} vectors")
         
         # Load the case mapping
+        if mmap and has_binary_mapping(mapping_path):
+            case_mapping = CaseMapping(binary_mapping_prefix(mapping_path))
+            print(f"Memory-mapped mapping for {len(case_mapping)} cases")
+            return faiss_index, case_mapping
+
         if not os.path.exists(mapping_path):
             print(f"Case mapping file not found at {mapping_path}")
             return None, None
@@ -39,9 +62,46 @@ def load_faiss(index_path="faiss_index.bin", mapping_path="case_mapping.json"):
         return None, None
     
 
-def search_similar_cases(faiss_index, case_mapping, query_case_id, k=5):
+def reverse_mapping(case_mapping, ntotal):
+    """Build a list mapping each index position back to its case_id."""
+    if isinstance(case_mapping, CaseMapping):
+        return case_mapping.reverse()
+    idx_to_case = [None] * ntotal
+    for case_id, idx in case_mapping.items():
+        if 0 <= idx < ntotal:
+            idx_to_case[idx] = case_id
+    return idx_to_case
+
+
+def graph_neighbours(knn_graph, idx, k, idx_to_case):
+    """
+    Look up the precomputed neighbours of index position idx (see knn_graph.py).
+    Returns a list of (case_id, similarity), or None if the graph holds fewer than k.
+    """
+    ids, scores = knn_graph
+    if k > ids.shape[1]:
+        return None
+    return [
+        (idx_to_case[int(neighbour)], float(score))
+        for neighbour, score in zip(ids[idx, :k], scores[idx, :k])
+        if neighbour >= 0
+    ]
+
+
+def search_similar_cases(faiss_index, case_mapping, query_case_id, k=5, idx_to_case=None,
+                         selector=None, knn_graph=None):
     """
-    Search for similar cases using cosine similarity
+    Search for similar cases using cosine similarity.
+    The index holds L2-normalised vectors with the inner-product metric,
+    so a single top-k search returns cosine scores directly.
+
+    Args:
+        idx_to_case (list): Optional precomputed reverse mapping from
+            reverse_mapping(); built per call when omitted
+        selector (faiss.IDSelector): Optional restriction of the candidate
+            positions, e.g. from metadata.filter_selector()
+        knn_graph (tuple): Optional precomputed (ids, scores) neighbour table;
+            unfiltered queries with k within the table are answered from it
     """
     try:
         if query_case_id not in case_mapping:
@@ -49,31 +109,29 @@ def search_similar_cases(faiss_index, case_mapping, query_case_id, k=5):
             return []
             
         query_idx = case_mapping[query_case_id]
+
+        if idx_to_case is None:
+            idx_to_case = reverse_mapping(case_mapping, faiss_index.ntotal)
+
+        if knn_graph is not None and selector is None:
+            results = graph_neighbours(knn_graph, query_idx, k, idx_to_case)
+            if results is not None:
+                return results
         
-        # Get and normalize the query vector
-        query_vector = faiss_index.reconstruct(query_idx)
-        query_vector = query_vector / np.linalg.norm(query_vector)
-        query_vector = query_vector.reshape(1, -1).astype('float32')
-        
-        # Get all vectors for proper normalization
-        all_vectors = np.vstack([faiss_index.reconstruct(i) for i in range(faiss_index.ntotal)])
-        all_vectors = all_vectors / np.linalg.norm(all_vectors, axis=1, keepdims=True)
-        
-        # Compute dot product (cosine similarity since vectors are normalized)
-        similarities = np.dot(query_vector, all_vectors.T)[0]
-        
-        # Get top k+1 indices (including query)
-        top_indices = np.argsort(similarities)[::-1][:k+1]
+        # Stored vectors are already normalized
+        query_vector = faiss_index.reconstruct(query_idx).reshape(1, -1)
         
-        # Create reverse mapping
-        idx_to_case = {v: k for k, v in case_mapping.items()}
+        # Get top k+1 neighbours (including query)
+        similarities, top_indices = faiss_index.search(
+            query_vector, k + 1, params=search_parameters(faiss_index, selector)
+        )
         
         # Format results, excluding query case
         results = []
-        for idx in top_indices:
-            case_id = idx_to_case[idx]
-            if case_id != query_case_id:
-                results.append((case_id, float(similarities[idx])))
+        for idx, similarity in zip(top_indices[0], similarities[0]):
+            case_id = idx_to_case[idx] if 0 <= idx < len(idx_to_case) else None
+            if case_id is not None and case_id != query_case_id:
+                results.append((case_id, float(similarity)))
                 
         return results[:k]
         
@@ -81,14 +139,78 @@ def search_similar_cases(faiss_index, case_mapping, query_case_id, k=5):
         print(f"Error during similarity search: {e}")
         return []
 
+def search_similar_batch(faiss_index, case_mapping, query_case_ids=(), query_vectors=None,
+                         k=5, idx_to_case=None, selector=None, knn_graph=None):
+    """
+    Search neighbours for many queries with a single faiss search call.
+
+    Args:
+        faiss_index: Normalised inner-product index
+        case_mapping (dict): case_id -> index position
+        query_case_ids (list): Indexed cases to query; each query's own case
+            is excluded from its results
+        query_vectors (array): Optional (n, d) raw vectors to query as well;
+            they are L2-normalised here
+        k (int): Neighbours per query
+        idx_to_case (list): Optional precomputed reverse mapping
+        selector (faiss.IDSelector): Optional restriction of the candidates
+        knn_graph (tuple): Optional precomputed neighbour table; unfiltered
+            case_id queries are looked up in it and only vectors are searched
+
+    Returns:
+        list: One entry per case_id (in order), then one per vector. Each entry
+            is a list of (case_id, similarity), or None for unknown case_ids.
+    """
+    if idx_to_case is None:
+        idx_to_case = reverse_mapping(case_mapping, faiss_index.ntotal)
+
+    query_case_ids = list(query_case_ids)
+    known = [case_id for case_id in query_case_ids if case_id in case_mapping]
+    by_case = {}
+    if knn_graph is not None and selector is None and k <= knn_graph[0].shape[1]:
+        by_case = {
+            case_id: graph_neighbours(knn_graph, case_mapping[case_id], k, idx_to_case)
+            for case_id in known
+        }
+        known = []
+    blocks = []
+    if known:
+        positions = np.array([case_mapping[case_id] for case_id in known], dtype="int64")
+        blocks.append(faiss_index.reconstruct_batch(positions))
+    if query_vectors is not None and len(query_vectors):
+        blocks.append(normalize_rows(query_vectors))
+    if not blocks:
+        return [by_case.get(case_id) for case_id in query_case_ids]
+
+    queries = np.ascontiguousarray(np.vstack(blocks), dtype="float32")
+    similarities, top_indices = faiss_index.search(
+        queries, k + 1, params=search_parameters(faiss_index, selector)
+    )
+
+    exclude = known + [None] * (len(queries) - len(known))
+    rows = []
+    for query_case, row_ids, row_scores in zip(exclude, top_indices, similarities):
+        results = []
+        for idx, similarity in zip(row_ids, row_scores):
+            case_id = idx_to_case[idx] if 0 <= idx < len(idx_to_case) else None
+            if case_id is not None and case_id != query_case:
+                results.append((case_id, float(similarity)))
+        rows.append(results[:k])
+
+    by_case.update(zip(known, rows))
+    return [by_case.get(case_id) for case_id in query_case_ids] + rows[len(known):]
+
+
 def search(id):
-    index, mapping = load_faiss()
-    if index is not None:
-        similar_cases = search_similar_cases(index, mapping, id, k=5)
-        return similar_cases
-    return []
+    # The index is loaded once per process by the similarity service.
+    from service import similar_cases
+    try:
+        return similar_cases(id, k=5) or []
+    except KeyError:
+        return []
 # Example usage
 if __name__ == "__main__":
+    from process import aggregate_checkpoints
     aggregate_checkpoints()
     index, mapping = load_faiss()
     if index is not None:
@@ -0,0 +1,143 @@
+import glob
+import json
+import os
+import time
+import numpy as np
+
+CHECKPOINT_DIR = "checkpoints"
+REFERENCE_GENES_FILE = "reference_genes.json"
+
+
+def _fsync_dir(directory):
+    """Flush directory metadata so a completed rename survives a crash."""
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def atomic_write(path, write):
+    """
+    Write a file through a temporary sibling, fsync it and rename it into place.
+    `write` receives the open binary file object.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def list_segments(directory=CHECKPOINT_DIR):
+    """Return the committed segment descriptor paths in sequence order."""
+    return sorted(glob.glob(os.path.join(directory, "segment_*.json")))
+
+
+def write_segment(vectors, case_ids, start, metadata=None, reducer=None, directory=CHECKPOINT_DIR):
+    """
+    Persist the vectors added since the previous segment.
+
+    The vectors are written first and the JSON descriptor last, so a segment
+    only exists for the loader once both files are durable on disk.
+
+    Args:
+        vectors (np.ndarray): (n, d) float32 array of new vectors
+        case_ids (list): case_ids in the same order as the vectors
+        start (int): index position of the first vector in this segment
+        metadata (list): Optional per-case metadata dicts, in the same order
+        reducer (str): embedding.reducer_id of the reducer that produced the vectors
+
+    Returns:
+        str: path of the segment descriptor
+    """
+    os.makedirs(directory, exist_ok=True)
+    existing = list_segments(directory)
+    seq = int(os.path.basename(existing[-1])[8:14]) + 1 if existing else 0
+
+    vectors_name = f"segment_{seq:06d}.npy"
+    descriptor_path = os.path.join(directory, f"segment_{seq:06d}.json")
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+
+    atomic_write(
+        os.path.join(directory, vectors_name),
+        lambda f: np.save(f, vectors),
+    )
+    descriptor = {
+        "seq": seq,
+        "start": start,
+        "count": len(case_ids),
+        "dim": int(vectors.shape[1]),
+        "vectors": vectors_name,
+        "case_ids": list(case_ids),
+        "metadata": list(metadata) if metadata is not None else None,
+        "reducer": reducer,
+    }
+    atomic_write(
+        descriptor_path,
+        lambda f: f.write(json.dumps(descriptor).encode()),
+    )
+    _fsync_dir(directory)
+    print(f"Wrote segment {seq} with {len(case_ids)} vectors starting at {start}")
+    return descriptor_path
+
+
+def iter_segments(directory=CHECKPOINT_DIR):
+    """
+    Yield (descriptor, vectors) for every committed segment in order.
+    Vectors are memory-mapped, so only one segment is paged in at a time.
+    Replay stops at the first gap in index positions.
+    """
+    expected_start = 0
+    for descriptor_path in list_segments(directory):
+        with open(descriptor_path, 'r') as f:
+            descriptor = json.load(f)
+        if descriptor["start"] != expected_start:
+            print(f"Segment {descriptor_path} starts at {descriptor['start']}, "
+                  f"expected {expected_start}; stopping replay")
+            return
+        vectors = np.load(
+            os.path.join(directory, descriptor["vectors"]), mmap_mode='r'
+        )
+        yield descriptor, vectors
+        expected_start += descriptor["count"]
+
+
+def retire_segments(directory=CHECKPOINT_DIR):
+    """
+    Move every segment into a retired_<timestamp> subdirectory, e.g. once a
+    new reducer makes their vectors unusable. Returns the new location, or
+    None if there were no segments.
+    """
+    existing = list_segments(directory)
+    if not existing:
+        return None
+    retired = os.path.join(directory, f"retired_{time.strftime('%Y%m%d_%H%M%S')}")
+    os.makedirs(retired, exist_ok=True)
+    for descriptor_path in existing:
+        # Descriptors first, so an interrupted move never leaves one without its vectors.
+        os.replace(descriptor_path, os.path.join(retired, os.path.basename(descriptor_path)))
+    for vectors_path in glob.glob(os.path.join(directory, "segment_*.npy")):
+        os.replace(vectors_path, os.path.join(retired, os.path.basename(vectors_path)))
+    _fsync_dir(directory)
+    print(f"Retired {len(existing)} segments to {retired}")
+    return retired
+
+
+def save_reference_genes(genes, directory=CHECKPOINT_DIR):
+    """Persist the gene order that every vector in the segments is aligned to."""
+    os.makedirs(directory, exist_ok=True)
+    atomic_write(
+        os.path.join(directory, REFERENCE_GENES_FILE),
+        lambda f: f.write(json.dumps(list(genes)).encode()),
+    )
+
+
+def load_reference_genes(directory=CHECKPOINT_DIR):
+    """Load the persisted gene order, or None if none was saved yet."""
+    path = os.path.join(directory, REFERENCE_GENES_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
@@ -0,0 +1,338 @@
+import argparse
+import glob
+import math
+import os
+import threading
+import time
+from embedding import REDUCER_PATH, load_reducer
+from knn_graph import graph_paths, load_knn_graph
+from mapping import binary_mapping_prefix
+from metadata import METADATA_FIELDS, case_fields, filter_selector, load_sidecar, sidecar_path
+from search import load_faiss, reverse_mapping, search_similar_batch, search_similar_cases
+from segments import CHECKPOINT_DIR, load_reference_genes
+from shards import load_shards, search_shards, shards_version
+from star_counts import embed_counts_file
+
+INDEX_PATH = os.environ.get("SIMILARITY_INDEX_PATH", "faiss_index.bin")
+MAPPING_PATH = os.environ.get("SIMILARITY_MAPPING_PATH", "case_mapping.json")
+# Gene order and reducer the index was built with, used to embed uploaded files.
+GENES_DIR = os.environ.get("SIMILARITY_GENES_DIR", CHECKPOINT_DIR)
+REDUCER = os.environ.get("SIMILARITY_REDUCER_PATH", REDUCER_PATH)
+# Memory-map the index and mapping so API workers share one copy in the page cache.
+MMAP = os.environ.get("SIMILARITY_MMAP", "1") == "1"
+MAX_K = 100
+MAX_BATCH = 1000
+MAX_UPLOAD_BYTES = 64 * 1024 * 1024
+
+# When set, serve the newest aggregated_index_<ts>.bin in this directory instead.
+INDEX_DIR = os.environ.get("SIMILARITY_INDEX_DIR")
+# Seconds between checks for a newly published index; 0 disables hot reload.
+RELOAD_INTERVAL = float(os.environ.get("SIMILARITY_RELOAD_INTERVAL", "30"))
+# When set, queries fan out over the per-project shards in this directory
+# (see shards.py) instead of searching one index.
+SHARD_DIR = os.environ.get("SIMILARITY_SHARD_DIR")
+
+# Currently served index state. Queries take one reference to it and use
+# that throughout, so a reload swaps it without affecting in-flight queries.
+_state = None
+_state_lock = threading.Lock()
+_reloader = None
+
+
+def published_paths():
+    """(index_path, mapping_path) of the index version that should be served."""
+    if INDEX_DIR:
+        aggregated = sorted(glob.glob(os.path.join(INDEX_DIR, "aggregated_index_*.bin")))
+        for index_path in reversed(aggregated):
+            mapping_path = index_path.replace("aggregated_index_", "aggregated_mapping_")[:-len(".bin")] + ".json"
+            if os.path.exists(mapping_path):
+                return index_path, mapping_path
+    return INDEX_PATH, MAPPING_PATH
+
+
+def served_files(mapping_path):
+    """Files loaded alongside an index and its JSON mapping, which may or may not exist."""
+    prefix = binary_mapping_prefix(mapping_path)
+    return (
+        *(f"{prefix}.{suffix}.npy" for suffix in ("ids", "pos", "rev")),
+        sidecar_path(mapping_path),
+        *graph_paths(mapping_path),
+    )
+
+
+def index_version(index_path, mapping_path):
+    """
+    Identity of every file served with an index. Writers replace each file
+    atomically but one after another, so a version loaded mid-save changes
+    again once the last file lands and the next check reloads it.
+    Returns None while the index or its mapping is missing.
+    """
+    version = []
+    for path in (index_path, mapping_path, *served_files(mapping_path)):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            if path in (index_path, mapping_path):
+                return None
+            version.append((path, None))
+            continue
+        version.append((path, st.st_ino, st.st_mtime_ns, st.st_size))
+    return tuple(version)
+
+
+def load_state(index_path, mapping_path):
+    """
+    Load an index version and everything served with it.
+
+    Returns:
+        dict: {"index", "case_to_idx", "idx_to_case", "metadata", "genes",
+            "reducer", "knn_graph", "version"} or None if the index cannot
+            be loaded; "metadata" is None without a sidecar, "genes" is None
+            if the gene order was not saved and "knn_graph" is None unless a
+            current graph was computed
+    """
+    index, mapping = load_faiss(index_path, mapping_path, mmap=MMAP)
+    if index is None:
+        return None
+    idx_to_case = reverse_mapping(mapping, index.ntotal)
+    if len(idx_to_case) != index.ntotal:
+        print(f"Skipping index {index_path}: mapping does not match its {index.ntotal} vectors")
+        return None
+    return {
+        "index": index,
+        "case_to_idx": mapping,
+        "idx_to_case": idx_to_case,
+        "metadata": load_sidecar(mapping_path, mapping),
+        "genes": load_reference_genes(GENES_DIR),
+        "reducer": load_reducer(REDUCER),
+        "knn_graph": load_knn_graph(mapping_path, index_path, index.ntotal),
+        "version": index_version(index_path, mapping_path),
+    }
+
+
+def load_sharded_state(directory):
+    """
+    Load every shard in directory and what is served with them.
+
+    Returns:
+        dict: {"shards", "dimension", "genes", "reducer", "version"} or None
+            if no shard can be loaded; see shards.load_shards for "shards"
+    """
+    version = shards_version(directory)
+    shards = load_shards(directory, mmap=MMAP)
+    if not shards:
+        return None
+    dimensions = {shard["index"].d for shard in shards.values()}
+    if len(dimensions) > 1:
+        print(f"Skipping shards in {directory}: they mix dimensions {sorted(dimensions)}")
+        return None
+    return {
+        "shards": shards,
+        "dimension": dimensions.pop(),
+        "genes": load_reference_genes(GENES_DIR),
+        "reducer": load_reducer(REDUCER),
+        "version": version,
+    }
+
+
+def reload_state():
+    """
+    Load the published index (or shards) if it differs from the served one and
+    swap it in. The swap is a single reference assignment; the old version is
+    freed once the last query holding it finishes. Returns True if a new
+    version was swapped in.
+    """
+    global _state
+    if SHARD_DIR:
+        source = SHARD_DIR
+        current_version = lambda: shards_version(SHARD_DIR)
+        load = lambda: load_sharded_state(SHARD_DIR)
+    else:
+        paths = published_paths()
+        source = paths[0]
+        current_version = lambda: index_version(*paths)
+        load = lambda: load_state(*paths)
+
+    version = current_version()
+    if version is None or (_state is not None and _state["version"] == version):
+        return False
+    state = load()
+    if state is None or current_version() != version:
+        # Missing, or replaced again while loading: try on the next check.
+        return False
+    _state = state
+    if "shards" in state:
+        print(f"Serving {len(state['shards'])} shards from {source}")
+    else:
+        print(f"Serving index {source} with {state['index'].ntotal} vectors")
+    return True
+
+
+def _watch(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            with _state_lock:
+                reload_state()
+        except Exception as e:
+            print(f"Index reload failed: {e}")
+
+
+def start_reloader(interval=RELOAD_INTERVAL):
+    """Start the background thread that swaps in newly published indexes."""
+    global _reloader
+    if _reloader is None and interval > 0:
+        _reloader = threading.Thread(target=_watch, args=(interval,), daemon=True, name="index-reloader")
+        _reloader.start()
+
+
+def get_state():
+    """
+    Return the served index state (see load_state), loading it on first use
+    and starting the reloader. Returns None if no index exists yet.
+    """
+    if _state is None:
+        with _state_lock:
+            if _state is None:
+                reload_state()
+            start_reloader()
+    return _state
+
+
+def _dimension(state):
+    return state["dimension"] if "shards" in state else state["index"].d
+
+
+def _check_queries(state, case_ids, vectors):
+    """
+    Raise ValueError unless every case_id is a string and every vector is a
+    list of exactly the index dimension's finite numbers.
+    """
+    if not all(isinstance(case_id, str) for case_id in case_ids):
+        raise ValueError("case_ids must be strings")
+    d = _dimension(state)
+    for vector in vectors or ():
+        if (not isinstance(vector, (list, tuple)) or len(vector) != d
+                or not all(isinstance(x, (int, float)) and not isinstance(x, bool) and math.isfinite(x)
+                           for x in vector)):
+            raise ValueError(f"Vectors must be lists of {d} numbers")
+
+
+def _selector(state, filters):
+    """
+    Turn {field: [values]} metadata filters into an ID selector for the search.
+    Raises ValueError for unknown fields or when the index has no metadata.
+    """
+    if not filters:
+        return None
+    unknown = set(filters) - set(METADATA_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown filter fields: {', '.join(sorted(unknown))}")
+    if state["metadata"] is None:
+        raise ValueError("Metadata filters are not available for this index")
+    return filter_selector(state["metadata"], filters, state["index"].ntotal)
+
+
+def similar_cases(case_id, k=5, filters=None):
+    """
+    Return the k most similar indexed cases as (case_id, score) pairs,
+    optionally restricted to cases matching metadata filters.
+    Returns None if no index is available and raises KeyError for unknown cases.
+    """
+    state = get_state()
+    if state is None:
+        return None
+    if "shards" in state:
+        results = search_shards(state["shards"], [case_id], k=k, filters=filters)[0]
+        if results is None:
+            raise KeyError(case_id)
+        return results
+    if case_id not in state["case_to_idx"]:
+        raise KeyError(case_id)
+    return search_similar_cases(
+        state["index"], state["case_to_idx"], case_id, k,
+        idx_to_case=state["idx_to_case"], selector=_selector(state, filters),
+        knn_graph=state["knn_graph"],
+    )
+
+
+def similar_cases_batch(case_ids=(), vectors=None, k=5, filters=None):
+    """
+    Return neighbours for many case_ids and/or raw vectors in one search.
+    Returns None if no index is available; see search_similar_batch for the
+    result layout. Raises ValueError for case_ids that are not strings and
+    vectors that are not lists of the index dimension's numbers.
+    """
+    state = get_state()
+    if state is None:
+        return None
+    _check_queries(state, case_ids, vectors)
+    if "shards" in state:
+        return search_shards(state["shards"], case_ids, vectors, k, filters)
+    return search_similar_batch(
+        state["index"], state["case_to_idx"], case_ids, vectors, k,
+        idx_to_case=state["idx_to_case"], selector=_selector(state, filters),
+        knn_graph=state["knn_graph"],
+    )
+
+
+def case_metadata(case_ids):
+    """
+    Metadata recorded at ingestion (project_id, primary_site, submitter_id)
+    for each case_id, as {case_id: fields}; cases without any map to {}.
+    """
+    state = get_state()
+    if state is None:
+        return {case_id: {} for case_id in case_ids}
+    if "shards" in state:
+        sidecars = [shard["metadata"] for shard in state["shards"].values() if shard["metadata"] is not None]
+    else:
+        sidecars = [state["metadata"]]
+    return {
+        case_id: next((fields for fields in (case_fields(sidecar, case_id) for sidecar in sidecars) if fields), {})
+        for case_id in case_ids
+    }
+
+
+def similar_to_counts(source, k=5, filters=None):
+    """
+    Embed a STAR counts file (path or binary stream) the way ingestion does
+    and return its k nearest indexed cases as (case_id, score) pairs.
+    Returns None if no index is available. Raises ValueError if the file
+    cannot be parsed or does not embed to the index dimension.
+    """
+    state = get_state()
+    if state is None:
+        return None
+    if state["genes"] is None:
+        raise ValueError("The gene order of this index is not available")
+    embedding = embed_counts_file(source, state["genes"], state["reducer"])
+    if embedding is None:
+        raise ValueError("Could not parse a STAR counts file with an 'unstranded' column")
+    if len(embedding) != _dimension(state):
+        raise ValueError(f"File embeds to {len(embedding)} dimensions, index has {_dimension(state)}")
+    if "shards" in state:
+        return search_shards(state["shards"], query_vectors=embedding.reshape(1, -1), k=k, filters=filters)[0]
+    return search_similar_batch(
+        state["index"], state["case_to_idx"], query_vectors=embedding.reshape(1, -1), k=k,
+        idx_to_case=state["idx_to_case"], selector=_selector(state, filters),
+    )[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Find the indexed cases most similar to a STAR counts file."
+    )
+    parser.add_argument("counts", help="STAR gene counts TSV")
+    parser.add_argument("-k", type=int, default=5)
+    for field in METADATA_FIELDS:
+        parser.add_argument(f"--{field.replace('_', '-')}", nargs="+", help=f"Only return cases with this {field}")
+    args = parser.parse_args()
+
+    filters = {field: getattr(args, field) for field in METADATA_FIELDS if getattr(args, field)}
+    results = similar_to_counts(args.counts, args.k, filters)
+    if results is None:
+        print(f"No similarity index at {INDEX_PATH}")
+    else:
+        for case_id, similarity in results:
+            print(f"Case: {case_id}, Similarity: {similarity:.3f}")
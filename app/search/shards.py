@@ -0,0 +1,326 @@
+import argparse
+import heapq
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime
+from itertools import groupby
+import numpy as np
+import counts_store
+from embedding import REDUCER_PATH
+from index_factory import INDEX_TYPES, build_index, normalize_rows, write_index
+from knn_graph import graph_paths
+from manifest import load_manifest
+from mapping import binary_mapping_prefix, save_mapping
+from metadata import METADATA_FIELDS, filter_selector, load_sidecar, save_sidecar, sidecar_path
+from reembed import embed_chunk
+from search import load_faiss, reverse_mapping, search_similar_batch
+from segments import atomic_write
+
+SHARD_DIR = "shards"
+SHARDS_FILE = "shards.json"
+# Metadata recorded by ingestion; its project_id decides each case's shard.
+METADATA_PATH = sidecar_path("case_mapping.json")
+# Threads a query fans out on; faiss releases the GIL while it searches.
+SEARCH_THREADS = int(os.environ.get("SIMILARITY_SHARD_THREADS", "8"))
+
+_search_pool = None
+_search_pool_lock = threading.Lock()
+
+
+def shard_paths(project_id, directory=SHARD_DIR, build=None):
+    """TCGA-LUAD, 20240101T000000000000-42 -> (shards/TCGA-LUAD.20240101T000000000000-42.bin, ....json)"""
+    name = re.sub(r"[^A-Za-z0-9_.-]", "_", project_id)
+    if build:
+        name = f"{name}.{build}"
+    return os.path.join(directory, f"{name}.bin"), os.path.join(directory, f"{name}.json")
+
+
+def shard_files(entry, directory=SHARD_DIR):
+    """Every file of a shard table entry: its index, mapping and the files derived from the mapping."""
+    mapping_path = os.path.join(directory, entry["mapping"])
+    prefix = binary_mapping_prefix(mapping_path)
+    return (
+        os.path.join(directory, entry["index"]),
+        mapping_path,
+        *(f"{prefix}.{suffix}.npy" for suffix in ("ids", "pos", "rev")),
+        sidecar_path(mapping_path),
+        *graph_paths(mapping_path),
+    )
+
+
+def remove_shard_files(entry, directory=SHARD_DIR):
+    for path in shard_files(entry, directory):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def load_shard_table(directory=SHARD_DIR):
+    """project_id -> {"index", "mapping", "build", "ntotal", "built"} for every built shard."""
+    path = os.path.join(directory, SHARDS_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def shards_version(directory=SHARD_DIR):
+    """Identity of the shard table; it is replaced atomically after every shard build."""
+    try:
+        st = os.stat(os.path.join(directory, SHARDS_FILE))
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def case_projects(metadata_path=METADATA_PATH):
+    """
+    Per-case metadata for sharding: the ingestion sidecar where it exists,
+    with project_id filled in from the ingest manifest for cases it lacks.
+    """
+    metadata = {}
+    if os.path.exists(metadata_path):
+        with open(metadata_path, 'r') as f:
+            metadata = json.load(f)
+    for case_id, record in load_manifest().items():
+        if record.get("project_id") is not None:
+            fields = metadata.setdefault(case_id, {})
+            fields.setdefault("project_id", record["project_id"])
+    return metadata
+
+
+def build_shard(store_dir, project_id, rows, directory, index_type=None, reducer_path=None, metadata=None):
+    """
+    Worker: embed one project's cases from the counts store into its own index.
+
+    Every build writes its files under new names, recorded in the returned
+    entry, so nothing a serving process has loaded is overwritten; the new
+    files are published together when the shard table is rewritten.
+
+    Args:
+        rows (list): (store row, case_id) pairs of the project's cases, in row order
+        metadata (dict): case_id -> metadata fields, saved as the shard's sidecar
+
+    Returns:
+        tuple: (project_id, shard table entry)
+    """
+    build = f"{datetime.now():%Y%m%dT%H%M%S%f}-{os.getpid()}"
+    index_path, mapping_path = shard_paths(project_id, directory, build)
+    mapping = {}
+
+    def embedded_batches():
+        for chunk_num, picks in groupby(rows, key=lambda pick: pick[0] // counts_store.CHUNK_ROWS):
+            offsets = [(row % counts_store.CHUNK_ROWS, case_id) for row, case_id in picks]
+            case_ids, vectors = embed_chunk(store_dir, chunk_num, offsets, reducer_path)
+            for case_id in case_ids:
+                mapping[case_id] = len(mapping)
+            yield vectors
+
+    index = build_index(embedded_batches(), len(rows), index_type)
+    write_index(index, index_path)
+    save_mapping(mapping, mapping_path, index.ntotal)
+    save_sidecar(metadata or {}, mapping_path, mapping)
+    return project_id, {
+        "index": os.path.basename(index_path),
+        "mapping": os.path.basename(mapping_path),
+        "build": build,
+        "ntotal": index.ntotal,
+        "built": datetime.now().isoformat(timespec="seconds"),
+    }
+
+
+def build_shards(store_dir=counts_store.COUNTS_DIR, directory=SHARD_DIR, projects=None, workers=None,
+                 index_type=None, reducer_path=REDUCER_PATH, metadata_path=METADATA_PATH):
+    """
+    Build one index per GDC project from the counts store, in parallel processes.
+
+    Only the given projects are rebuilt when projects is set; other shards are
+    left as they are. The shard table is rewritten as each shard finishes, so
+    a serving process picks up finished shards while the rest are still building.
+    A replaced shard's files are removed one build later, so a process that
+    read the previous table can still open them.
+
+    Returns:
+        dict: The updated shard table, or None if there is no counts store
+    """
+    if not counts_store.open_store(store_dir):
+        print(f"No counts store found at {store_dir}")
+        return None
+    os.makedirs(directory, exist_ok=True)
+
+    metadata = case_projects(metadata_path)
+    groups = {}
+    unassigned = 0
+    for case_id, row in counts_store.case_rows.items():
+        project_id = metadata.get(case_id, {}).get("project_id")
+        if project_id is None:
+            unassigned += 1
+            continue
+        groups.setdefault(project_id, []).append((row, case_id))
+    if unassigned:
+        print(f"Skipping {unassigned} cases with no known project")
+    if projects:
+        missing = set(projects) - set(groups)
+        if missing:
+            print(f"No stored cases for projects: {', '.join(sorted(missing))}")
+        groups = {project_id: rows for project_id, rows in groups.items() if project_id in projects}
+
+    reducer_path = reducer_path if reducer_path and os.path.exists(reducer_path) else None
+    table = load_shard_table(directory)
+    start = time.perf_counter()
+    print(f"Building {len(groups)} shards in {directory}")
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = [
+            executor.submit(
+                build_shard, store_dir, project_id, sorted(rows), directory, index_type, reducer_path,
+                {case_id: metadata[case_id] for _, case_id in rows},
+            )
+            for project_id, rows in groups.items()
+        ]
+        for future in as_completed(futures):
+            try:
+                project_id, entry = future.result()
+            except Exception as e:
+                print(f"Error building shard: {e}")
+                continue
+            previous = table.get(project_id)
+            if previous is not None and previous["index"] != entry["index"]:
+                entry["previous"] = {"index": previous["index"], "mapping": previous["mapping"]}
+            table[project_id] = entry
+            atomic_write(os.path.join(directory, SHARDS_FILE), lambda f: f.write(json.dumps(table, indent=2).encode()))
+            if previous is not None and previous.get("previous"):
+                remove_shard_files(previous["previous"], directory)
+            print(f"Built shard {project_id} with {entry['ntotal']} vectors")
+
+    elapsed = time.perf_counter() - start
+    print(f"Built {len(groups)} shards in {elapsed:.1f}s")
+    return table
+
+
+def load_shards(directory=SHARD_DIR, mmap=False):
+    """
+    Load every shard in the shard table.
+
+    Returns:
+        dict: project_id -> {"index", "case_to_idx", "idx_to_case", "metadata"};
+            shards that cannot be loaded or do not match their mapping are skipped
+    """
+    shards = {}
+    for project_id, entry in load_shard_table(directory).items():
+        mapping_path = os.path.join(directory, entry["mapping"])
+        index, mapping = load_faiss(os.path.join(directory, entry["index"]), mapping_path, mmap=mmap)
+        if index is None:
+            continue
+        idx_to_case = reverse_mapping(mapping, index.ntotal)
+        if len(idx_to_case) != index.ntotal:
+            print(f"Skipping shard {project_id}: mapping does not match its {index.ntotal} vectors")
+            continue
+        shards[project_id] = {
+            "index": index,
+            "case_to_idx": mapping,
+            "idx_to_case": idx_to_case,
+            "metadata": load_sidecar(mapping_path, mapping),
+        }
+    print(f"Loaded {len(shards)} shards with {sum(s['index'].ntotal for s in shards.values())} vectors")
+    return shards
+
+
+def shard_selectors(shards, filters):
+    """
+    Route metadata filters: project_id picks the shards to search, the other
+    fields become a per-shard ID selector.
+
+    Returns:
+        tuple: (project_ids to search, {project_id: selector or None})
+
+    Raises:
+        ValueError: for unknown fields, or field filters on shards without metadata
+    """
+    filters = dict(filters or {})
+    unknown = set(filters) - set(METADATA_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown filter fields: {', '.join(sorted(unknown))}")
+    projects = filters.pop("project_id", None)
+    targets = [project_id for project_id in shards if projects is None or project_id in projects]
+    selectors = {}
+    for project_id in targets:
+        shard = shards[project_id]
+        if not filters:
+            selectors[project_id] = None
+        elif shard["metadata"] is None:
+            raise ValueError(f"Metadata filters are not available for shard {project_id}")
+        else:
+            selectors[project_id] = filter_selector(shard["metadata"], filters, shard["index"].ntotal)
+    return targets, selectors
+
+
+def _pool():
+    global _search_pool
+    with _search_pool_lock:
+        if _search_pool is None:
+            _search_pool = ThreadPoolExecutor(max_workers=SEARCH_THREADS, thread_name_prefix="shard-search")
+        return _search_pool
+
+
+def search_shards(shards, query_case_ids=(), query_vectors=None, k=5, filters=None):
+    """
+    Fan a batch of queries out to the relevant shards concurrently and merge
+    each query's top-k across them. Same arguments and result layout as
+    search_similar_batch, with metadata filters in place of a selector.
+    """
+    query_case_ids = list(query_case_ids)
+    known = []
+    blocks = []
+    for case_id in query_case_ids:
+        for shard in shards.values():
+            if case_id in shard["case_to_idx"]:
+                known.append(case_id)
+                blocks.append(shard["index"].reconstruct(shard["case_to_idx"][case_id]).reshape(1, -1))
+                break
+    if query_vectors is not None and len(query_vectors):
+        blocks.append(normalize_rows(query_vectors))
+    if not blocks:
+        return [None] * len(query_case_ids)
+
+    queries = np.ascontiguousarray(np.vstack(blocks), dtype="float32")
+    targets, selectors = shard_selectors(shards, filters)
+
+    def search_shard(project_id):
+        shard = shards[project_id]
+        # One extra neighbour so a query's own case can be dropped.
+        return search_similar_batch(
+            shard["index"], shard["case_to_idx"], query_vectors=queries, k=k + 1,
+            idx_to_case=shard["idx_to_case"], selector=selectors[project_id],
+        )
+
+    per_shard = list(_pool().map(search_shard, targets))
+    exclude = known + [None] * (len(queries) - len(known))
+    rows = []
+    for i, query_case in enumerate(exclude):
+        candidates = (
+            (case_id, similarity)
+            for results in per_shard for case_id, similarity in results[i]
+            if case_id != query_case
+        )
+        rows.append(heapq.nlargest(k, candidates, key=lambda result: result[1]))
+
+    by_case = dict(zip(known, rows))
+    return [by_case.get(case_id) for case_id in query_case_ids] + rows[len(known):]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build per-project shard indexes from the counts store.")
+    parser.add_argument("--store", default=counts_store.COUNTS_DIR)
+    parser.add_argument("--dir", default=SHARD_DIR, help="Directory the shards are written to")
+    parser.add_argument("--projects", nargs="+", default=None, help="Only rebuild these projects' shards")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--index-type", choices=INDEX_TYPES, default=None)
+    parser.add_argument("--reducer", default=REDUCER_PATH)
+    parser.add_argument("--metadata", default=METADATA_PATH, help="Metadata sidecar with each case's project_id")
+    args = parser.parse_args()
+    build_shards(args.store, args.dir, args.projects, args.workers, args.index_type, args.reducer, args.metadata)
@@ -0,0 +1,85 @@
+from embedding import embed_counts
+from metrics import incr
+
+SPECIAL_ROWS = ['N_unmapped', 'N_multimapping', 'N_noFeature', 'N_ambiguous']
+
+
+def describe(source):
+    """Printable name of a path or file-like source."""
+    return source if isinstance(source, str) else getattr(source, "name", "upload")
+
+
+def process_file_in_chunks(filepath, chunk_size=10000):
+    """
+    Process a large gene counts TSV file in chunks.
+    filepath may also be a binary file-like object, e.g. an upload stream,
+    which is parsed as it is read without touching the disk.
+    Returns a DataFrame of processed gene counts.
+    """
+    import pandas as pd
+    try:
+        chunks = []
+        processed_rows = 0
+
+        for chunk_num, chunk in enumerate(
+            pd.read_csv(filepath, sep='\t', header=1, chunksize=chunk_size)
+        ):
+            try:
+                chunk = chunk.set_index(chunk.columns[0])
+                if 'unstranded' not in chunk.columns:
+                    raise ValueError(f"No 'unstranded' column found in chunk {chunk_num}")
+
+                processed_chunk = (
+                    chunk[['unstranded']]
+                    .loc[~chunk.index.isin(SPECIAL_ROWS)]
+                    .apply(pd.to_numeric, errors='coerce')
+                    .dropna()
+                    .loc[lambda x: x['unstranded'] != 0]
+                )
+                if not processed_chunk.empty:
+                    chunks.append(processed_chunk)
+
+                processed_rows += len(chunk)
+            except Exception as e:
+                print(f"Error processing chunk {chunk_num} of {describe(filepath)}: {e}")
+                continue
+
+        final_df = pd.concat(chunks) if chunks else pd.DataFrame()
+        chunks.clear()
+        incr("parsed_rows", processed_rows)
+        return final_df
+
+    except Exception as e:
+        print(f"Failed to process file {describe(filepath)}: {e}")
+        return None
+
+
+def compute_embedding(processed_data, reference_genes=None):
+    """
+    Compute an embedding vector from the processed data.
+    Here we simply convert the 'unstranded' column values to a float32 numpy array.
+    """
+    try:
+        if reference_genes is not None:
+            # Align to reference, filling missing genes with 0.
+            processed_data = processed_data.reindex(reference_genes, fill_value=0)
+        return processed_data['unstranded'].values.astype("float32")
+    except Exception as e:
+        print(f"Error computing embedding: {e}")
+        return None
+
+
+def embed_counts_file(source, reference_genes, reducer=None):
+    """
+    Parse a STAR counts file (path or stream) and embed it like an ingested
+    case: aligned to reference_genes, then passed through the reducer.
+    Returns the embedding or None if the file could not be parsed.
+    """
+    import pandas as pd
+    processed_data = process_file_in_chunks(source)
+    if processed_data is None or processed_data.empty:
+        return None
+    counts = compute_embedding(processed_data, pd.Index(reference_genes))
+    if counts is None:
+        return None
+    return embed_counts(counts, reducer)
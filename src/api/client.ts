@@ -3,7 +3,7 @@ import { API_CONFIG } from './config';
 
 // Create axios instances with default configurations
 export const gdcClient = axios.create({
-  baseURL: API_CONFIG.GDC.BASE_URL,
+  baseURL: API_CONFIG.GDC.PROXY_URL,
   params: API_CONFIG.GDC.DEFAULT_PARAMS
 });
 
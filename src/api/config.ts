@@ -1,6 +1,8 @@
 export const API_CONFIG = {
     GDC: {
       BASE_URL: 'https://api.gdc.cancer.gov',
+      // Metadata queries go through the backend's caching proxy; file downloads use BASE_URL.
+      PROXY_URL: '/api/gdc',
       ENDPOINTS: {
         PROJECTS: '/projects',
         CASES: '/cases',